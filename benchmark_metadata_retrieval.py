@@ -0,0 +1,91 @@
+"""
+benchmark_metadata_retrieval.py:
+Compares the two ways Storer can hydrate Pinecone matches:
+  - the default path, which looks up title, url and content in the
+    sqlite chunk store one id at a time, and
+  - metadata_content mode, which stores the chunk text (compressed if it
+    would exceed Pinecone's metadata limit) with each vector and reads it
+    back from the query response.
+
+The storage half of the report only needs an existing chunk store. The
+latency half times the sqlite lookups against unpacking the same chunks
+from metadata, which is the work that is left on the hot path once the
+chunk store is skipped.
+
+To run:
+python benchmark_metadata_retrieval.py gem_wiki_50.db
+"""
+
+import json
+import random
+import sqlite3
+import statistics
+import sys
+import time
+
+import chatbotter as cb
+
+
+DB_PATH = sys.argv[1] if len(sys.argv) > 1 else 'gem_wiki_50.db'
+TOP_N = 100  # matches hydrated per query, as in get_pinecone_matches
+ROUNDS = 20
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+storage = cb.Storer.__new__(cb.Storer)  # skip Pinecone setup; only the chunk store is used
+storage.db_path = DB_PATH
+storage.overwrite_db = False
+storage.compress_content = False
+storage.compressor = None
+storage.debug = False
+storage.setup_database()
+
+conn = sqlite3.connect(DB_PATH)
+ids = [row[0] for row in conn.execute("SELECT unique_id FROM ArticleChunks")]
+conn.close()
+chunks = storage.get_article_chunks(ids)
+rows = [(unique_id, *chunks[unique_id]) for unique_id in ids]
+if not rows:
+    sys.exit(f"No chunks found in {DB_PATH}")
+
+# Storage: what each vector would carry in Pinecone.
+plain_bytes = 0
+stored_bytes = 0
+compressed = 0
+too_large = 0
+packed = {}
+for unique_id, title, url, content in rows:
+    metadata = cb.pack_content_metadata(title, url, content)
+    packed[unique_id] = metadata
+    plain_bytes += len(json.dumps({"title": title, "url": url}).encode('utf-8'))
+    stored_bytes += len(json.dumps(metadata).encode('utf-8'))
+    if "content_z" in metadata:
+        compressed += 1
+    elif "content" not in metadata:
+        too_large += 1
+
+print(f"Chunks: {len(rows)}")
+print(f"Metadata without content: {plain_bytes / len(rows):,.0f} bytes/vector, {plain_bytes / 2**20:,.2f} MiB total")
+print(f"Metadata with content:    {stored_bytes / len(rows):,.0f} bytes/vector, {stored_bytes / 2**20:,.2f} MiB total")
+print(f"Stored compressed: {compressed}, too large for metadata (sqlite fallback): {too_large}")
+
+# Latency: hydrating TOP_N matches per query.
+sqlite_times = []
+metadata_times = []
+for _ in range(ROUNDS):
+    sample = random.choices(ids, k=TOP_N)
+    start = time.perf_counter()
+    for unique_id in sample:
+        storage.get_article_chunk(unique_id)
+    sqlite_times.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    for unique_id in sample:
+        cb.unpack_content_metadata(packed[unique_id])
+    metadata_times.append((time.perf_counter() - start) * 1000)
+
+for label, times in [("sqlite per-id lookups", sqlite_times), ("metadata unpacking", metadata_times)]:
+    print(f"{label:>22}: p50 {statistics.median(times):.2f} ms, p95 {percentile(times, 95):.2f} ms per {TOP_N} matches")
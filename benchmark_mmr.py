@@ -0,0 +1,98 @@
+"""
+benchmark_mmr.py:
+Measures the Maximal Marginal Relevance stage that Storer and SocialData
+run with mmr=True:
+  - latency: chatbotter.mmr_order over k candidates, which is what the
+    stage adds to each query (the target is under a millisecond at k=100),
+  - diversity: how many of the first PROMPT_CHUNKS candidates, about what
+    fits in query_message's token budget, are near-duplicates of one
+    ranked above them, in plain relevance order and in MMR order.
+
+The diversity half uses candidates made of clusters of near-identical
+vectors, like a section repeated across wiki pages or an email quoted in
+several replies. Given an embeddings CSV (as written by the embedding_*
+scripts), it also ranks the top k chunks for sample queries taken from
+the corpus itself.
+
+To run:
+python benchmark_mmr.py
+python benchmark_mmr.py gem_wiki_embeddings.csv
+"""
+
+import ast
+import statistics
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import chatbotter as cb
+
+
+EMBEDDINGS_PATH = sys.argv[1] if len(sys.argv) > 1 else None
+CANDIDATES = [20, 50, 100, 200]
+DIMENSIONS = [512, 1536]
+ROUNDS = 200
+TARGET_SECONDS = 0.001  # at k=100
+MMR_LAMBDA = 0.7
+PROMPT_CHUNKS = 10
+DUPLICATE_SIMILARITY = 0.95
+SAMPLE_QUERIES = 50
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def duplicates(vectors: np.ndarray, order) -> int:
+    """How many of the first PROMPT_CHUNKS in order are near-duplicates of one before them."""
+    chosen = cb.LocalIndex.normalized(vectors[list(order)[:PROMPT_CHUNKS]])
+    similarity = chosen @ chosen.T
+    return int(sum((similarity[i, :i] >= DUPLICATE_SIMILARITY).any() for i in range(len(chosen))))
+
+
+rng = np.random.default_rng(0)
+
+print(f"Latency of mmr_order, lambda={MMR_LAMBDA}, {ROUNDS} rounds:")
+for dimensions in DIMENSIONS:
+    for k in CANDIDATES:
+        vectors = rng.standard_normal((k, dimensions)).astype(np.float32)
+        query = rng.standard_normal(dimensions).astype(np.float32)
+        cb.mmr_order(query, vectors, MMR_LAMBDA)  # warm up
+        times = []
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            cb.mmr_order(query, vectors, MMR_LAMBDA)
+            times.append(time.perf_counter() - start)
+        verdict = ""
+        if k == 100:
+            verdict = " (ok)" if statistics.median(times) < TARGET_SECONDS else " (over target)"
+        print(f"  d={dimensions:>5}, k={k:>4}: p50 {statistics.median(times) * 1000:7.3f} ms, "
+              f"p95 {percentile(times, 95) * 1000:7.3f} ms{verdict}")
+
+# Synthetic candidates: 25 topics, each chunk repeated four times with small changes.
+dimensions = 1536
+topics = rng.standard_normal((25, dimensions)).astype(np.float32)
+vectors = np.repeat(topics, 4, axis=0) + 0.05 * rng.standard_normal((100, dimensions)).astype(np.float32)
+query = topics.mean(axis=0) + rng.standard_normal(dimensions).astype(np.float32)
+relevance_order = np.argsort(-(cb.LocalIndex.normalized(vectors) @ query))
+print(f"\nNear-duplicates among the first {PROMPT_CHUNKS} of 100 clustered candidates:")
+print(f"  relevance order: {duplicates(vectors, relevance_order)}")
+print(f"  MMR order:       {duplicates(vectors, cb.mmr_order(query, vectors, MMR_LAMBDA))}")
+
+if EMBEDDINGS_PATH:
+    df = pd.read_csv(EMBEDDINGS_PATH)
+    embeddings = np.array(df['embedding'].apply(ast.literal_eval).tolist(), dtype=np.float32)
+    index = cb.LocalIndex(embeddings)
+    plain, diverse = [], []
+    for position in rng.choice(len(embeddings), size=min(SAMPLE_QUERIES, len(embeddings)), replace=False):
+        indices, _ = index.search(embeddings[position], top_n=100)
+        candidates = embeddings[indices]
+        plain.append(duplicates(candidates, range(len(candidates))))
+        diverse.append(duplicates(candidates, cb.mmr_order(embeddings[position], candidates, MMR_LAMBDA)))
+    print(f"\nNear-duplicates among the first {PROMPT_CHUNKS} of the top 100 in {EMBEDDINGS_PATH}, "
+          f"mean over {len(plain)} queries:")
+    print(f"  relevance order: {statistics.fmean(plain):.2f}")
+    print(f"  MMR order:       {statistics.fmean(diverse):.2f}")
@@ -0,0 +1,96 @@
+"""
+benchmark_quantization.py:
+Measures memory, search latency and recall@k of the LocalIndex storage
+modes (float32, float16 and per-vector-scaled int8 with exact rescoring)
+against exact float32 search.
+
+The row-by-row scipy cosine search that Asker used before LocalIndex is
+timed on a few queries as a baseline.
+
+The evaluation set is the GEM questions below, embedded with the OpenAI API
+when OPENAI_API_KEY is set. Without a key, a sample of the corpus' own chunk
+embeddings is used as queries instead.
+
+To run:
+python benchmark_quantization.py data/embedding_gem_wiki.csv
+"""
+
+import ast
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import spatial
+
+import chatbotter as cb
+
+
+EMBEDDINGS_PATH = sys.argv[1] if len(sys.argv) > 1 else "data/embedding_gem_wiki.csv"
+EMBEDDING_MODEL = "text-embedding-3-small"
+TOP_K = 10
+SAMPLE_QUERIES = 200
+BASELINE_QUERIES = 3
+QUESTIONS = [
+    'Where is the SUKELCO Solar Power Plant located?',
+    'Tell me about the Peace River Area 2 Oil and Gas Project.',
+    'What coal-burning power plants have been retired since 2020?',
+    'Tell me about the Nelson Dewey Generating Facility.',
+    'What nonprofits in Wisconsin are advocating for renewable energy?',
+    'What companies in Wisconsin are investing in renewable energy?',
+    'What coal-burning power plants have been shut down in Wisconsin?',
+    'What are some solar power plants that are currently operating in Colorado?',
+    'Name some organizations that are advocating for renewable energy in the United States.',
+    'What are some front groups for the fossil fuel industry?',
+    'Describe the activities of the fossil fuel industry\'s front groups.',
+    'What are some effective ways to advocate for action on climate change?',
+    'Name some innovative businesses that are working to address climate change.',
+    'Tell me about Arch Coal.',
+    'What are some fossil fuel companies that have filed for bankruptcy?',
+]
+
+
+def load_queries(embeddings: np.ndarray) -> np.ndarray:
+    if os.environ.get('OPENAI_API_KEY'):
+        from openai import OpenAI
+        response = OpenAI().embeddings.create(model=EMBEDDING_MODEL, input=QUESTIONS)
+        return np.array([e.embedding for e in response.data], dtype=np.float32)
+    print("OPENAI_API_KEY is not set; using a sample of chunk embeddings as queries.")
+    rng = np.random.default_rng(0)
+    return embeddings[rng.choice(len(embeddings), size=min(SAMPLE_QUERIES, len(embeddings)), replace=False)]
+
+
+df = pd.read_csv(EMBEDDINGS_PATH)
+embeddings = np.array(df['embedding'].apply(ast.literal_eval).tolist(), dtype=np.float32)
+queries = load_queries(embeddings)
+print(f"{len(embeddings)} vectors of {embeddings.shape[1]} dimensions, {len(queries)} queries, recall@{TOP_K}")
+
+times = []
+for q in queries[:BASELINE_QUERIES]:
+    start = time.perf_counter()
+    relatednesses = [1 - spatial.distance.cosine(q, row) for row in embeddings]
+    sorted(range(len(relatednesses)), key=relatednesses.__getitem__, reverse=True)[:TOP_K]
+    times.append((time.perf_counter() - start) * 1000)
+# Lists of Python floats cost a 24-byte float object plus an 8-byte pointer per value.
+print(f"{'lists':>8}: {embeddings.size * 32 / 2**20:8.1f} MiB in memory, "
+      f"p50 {statistics.median(times):.2f} ms (row-by-row scipy cosine)")
+
+exact = cb.LocalIndex(embeddings)
+truth = [set(exact.search(q, top_n=TOP_K)[0].tolist()) for q in queries]
+
+with tempfile.TemporaryDirectory() as tmp:
+    for quantization in [None, "float16", "int8"]:
+        index = cb.LocalIndex(embeddings, quantization=quantization,
+            vectors_path=os.path.join(tmp, f"{quantization}.npy") if quantization else None)
+        times = []
+        hits = 0
+        for q, expected in zip(queries, truth):
+            start = time.perf_counter()
+            indices, scores = index.search(q, top_n=TOP_K)
+            times.append((time.perf_counter() - start) * 1000)
+            hits += len(expected.intersection(indices.tolist()))
+        print(f"{quantization or 'float32':>8}: {index.nbytes / 2**20:8.1f} MiB in memory, "
+              f"p50 {statistics.median(times):.2f} ms, recall@{TOP_K} {hits / (TOP_K * len(queries)):.3f}")
@@ -0,0 +1,73 @@
+"""
+benchmark_reduced_dimensions.py:
+Measures what shortening text-embedding-3 vectors costs in recall and saves
+in index size and search time. For each reduced size it reports:
+  - one-stage search over the shortened vectors only, and
+  - two-stage search, where a 4x shortlist from the shortened vectors is
+    reranked against the full-size vectors,
+with recall@k measured against exact full-size search.
+
+Shortened vectors are the leading components of the stored full-size ones,
+renormalized, which is what the API returns for the `dimensions` parameter,
+so no API calls are needed. A sample of chunk embeddings serves as queries.
+The numbers only mean something for real text-embedding-3 vectors.
+
+To run:
+python benchmark_reduced_dimensions.py data/embedding_gem_wiki.csv
+"""
+
+import ast
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import chatbotter as cb
+
+
+EMBEDDINGS_PATH = sys.argv[1] if len(sys.argv) > 1 else "data/embedding_gem_wiki.csv"
+DIMENSIONS = [256, 512, 1024]
+TOP_K = 10
+SAMPLE_QUERIES = 200
+
+
+def measure(index, queries, truth):
+    times = []
+    hits = 0
+    for q, expected in zip(queries, truth):
+        start = time.perf_counter()
+        indices, scores = index.search(q, top_n=TOP_K)
+        times.append((time.perf_counter() - start) * 1000)
+        hits += len(expected.intersection(indices.tolist()))
+    return statistics.median(times), hits / (TOP_K * len(queries))
+
+
+df = pd.read_csv(EMBEDDINGS_PATH)
+embeddings = np.array(df['embedding'].apply(ast.literal_eval).tolist(), dtype=np.float32)
+rng = np.random.default_rng(0)
+queries = embeddings[rng.choice(len(embeddings), size=min(SAMPLE_QUERIES, len(embeddings)), replace=False)]
+print(f"{len(embeddings)} vectors of {embeddings.shape[1]} dimensions, {len(queries)} queries, recall@{TOP_K}")
+
+full = cb.LocalIndex(embeddings)
+truth = [set(full.search(q, top_n=TOP_K)[0].tolist()) for q in queries]
+latency, recall = measure(full, queries, truth)
+print(f"{embeddings.shape[1]:>5} dims: {full.nbytes / 2**20:8.1f} MiB, p50 {latency:.2f} ms")
+
+with tempfile.TemporaryDirectory() as tmp:
+    vectors_path = os.path.join(tmp, "vectors.npy")
+    for dimensions in DIMENSIONS:
+        if dimensions >= embeddings.shape[1]:
+            continue
+        # A multiplier of 1 reranks only the final top_k, so membership (and
+        # recall) is decided by the shortened vectors alone.
+        one_stage = cb.LocalIndex(embeddings, vectors_path=vectors_path, dimensions=dimensions, rescore_multiplier=1)
+        two_stage = cb.LocalIndex(vectors_path=vectors_path, dimensions=dimensions, rescore_multiplier=4)
+        latency1, recall1 = measure(one_stage, queries, truth)
+        latency2, recall2 = measure(two_stage, queries, truth)
+        print(f"{dimensions:>5} dims: {one_stage.nbytes / 2**20:8.1f} MiB, "
+              f"one-stage p50 {latency1:.2f} ms recall {recall1:.3f}, "
+              f"two-stage p50 {latency2:.2f} ms recall {recall2:.3f}")
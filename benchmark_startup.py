@@ -0,0 +1,83 @@
+"""
+benchmark_startup.py:
+Measures how long the Flask apps take to start, against a target of one
+second per gunicorn worker:
+  - cold start: a fresh interpreter importing the app module and creating
+    the app, which is what each worker pays without --preload,
+  - preloaded start: forking a process that has already imported the app
+    and creating the app in the child, which is what each worker pays with
+    gunicorn --preload,
+  - warm-up: how long after the first /ready call the Shellbot services are
+    ready. This one needs OPENAI_API_KEY and PINECONE_API_KEY (and the
+    Postgres settings) and is skipped without them.
+
+To run:
+python benchmark_startup.py
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+TARGET_SECONDS = 1.0
+RUNS = 5
+APPS = ['shellbot_flask', 'question_answering_embeddings_gem_flask']
+
+COLD_START = """
+import time
+start = time.perf_counter()
+import {module}
+if hasattr({module}, 'create_app'):
+    {module}.create_app()
+print(time.perf_counter() - start)
+"""
+
+PRELOADED_START = """
+import os, sys, time
+import {module}
+read_end, write_end = os.pipe()
+start = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    if hasattr({module}, 'create_app'):
+        {module}.create_app()
+    os.write(write_end, b'x')
+    os._exit(0)
+os.read(read_end, 1)
+print(time.perf_counter() - start)
+os.waitpid(pid, 0)
+"""
+
+
+def run(code: str) -> float:
+    # Starting up makes no API calls, but the OpenAI client wants a key to exist.
+    env = {**os.environ, 'OPENAI_API_KEY': os.environ.get('OPENAI_API_KEY', 'unused')}
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+for module in APPS:
+    cold = [run(COLD_START.format(module=module)) for _ in range(RUNS)]
+    preloaded = [run(PRELOADED_START.format(module=module)) for _ in range(RUNS)]
+    for label, times in [("cold start", cold), ("preloaded start", preloaded)]:
+        median = statistics.median(times)
+        verdict = "ok" if median < TARGET_SECONDS else "over target"
+        print(f"{module:>40} {label:>16}: p50 {median * 1000:7.1f} ms, max {max(times) * 1000:7.1f} ms ({verdict})")
+
+if os.environ.get('OPENAI_API_KEY') and os.environ.get('PINECONE_API_KEY'):
+    import shellbot_flask
+    client = shellbot_flask.app.test_client()
+    start = time.perf_counter()
+    while client.get('/ready').status_code != 200:
+        if 'error' in shellbot_flask.services:
+            sys.exit(f"Warm-up failed: {shellbot_flask.services['error']}")
+        time.sleep(0.05)
+    print(f"{'shellbot_flask':>40} {'warm-up':>16}: {(time.perf_counter() - start) * 1000:7.1f} ms to /ready")
+else:
+    print("OPENAI_API_KEY or PINECONE_API_KEY is not set; skipping the warm-up measurement.")
@@ -0,0 +1,242 @@
+"""
+benchmark_suite.py:
+End-to-end benchmarks that run offline, against the local OpenAI,
+Pinecone and MediaWiki stand-ins in fake_services.py. At each corpus size
+it times:
+  - ingestion: WikiExtractor listing, parsing and chunking the wiki,
+    Embedder embedding the chunks, and Storer upserting the vectors and
+    storing the chunks,
+  - retrieval: Storer.get_pinecone_matches, plain and coarse-to-fine
+    (pages first, through the title namespace), and
+    Asker.strings_ranked_by_relatedness over the same chunks loaded from
+    CSV, with the share of queries whose source chunk comes back first,
+  - answering: Asker.ask from question to answer, one question at a
+    time, and the same questions through Asker.ask_many,
+along with the per-stage histograms from chatbotter.metrics.
+
+The results are written as JSON. Given an earlier report, the two are
+compared and the script exits with status 1 if any timing got more than
+TOLERANCE slower, so it can guard against regressions in CI.
+
+The fake services answer instantly unless the *_LATENCY settings below
+are raised, so by default the numbers are the code's own overhead plus
+local HTTP round trips. tiktoken still needs its encoding files, which it
+downloads on first use and caches (see TIKTOKEN_CACHE_DIR).
+
+To run:
+python benchmark_suite.py benchmark_report.json
+python benchmark_suite.py benchmark_report_new.json benchmark_report.json
+"""
+
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+# Keep the fake index's host out of the real Pinecone host cache.
+WORK_DIR = tempfile.mkdtemp(prefix="benchmark_suite_")
+os.environ['PINECONE_INDEX_CACHE'] = os.path.join(WORK_DIR, "pinecone_indexes.json")
+os.environ.setdefault('PINECONE_API_KEY', 'fake')
+
+from openai import OpenAI
+
+import chatbotter as cb
+from fake_services import FakeMediaWiki, FakeOpenAI, FakePinecone
+
+
+REPORT_PATH = sys.argv[1] if len(sys.argv) > 1 else "benchmark_report.json"
+BASELINE_PATH = sys.argv[2] if len(sys.argv) > 2 else None
+CORPUS_SIZES = [10, 50, 200]  # wiki pages; each makes about five chunks
+QUERIES = 20
+TOP_N = 20
+ASK_MANY_CONCURRENCY = 8
+TOLERANCE = 0.25  # a timing regresses when it is this much slower than the baseline...
+MIN_DELTA = 0.002  # ...and slower by at least this many seconds
+OPENAI_LATENCY = 0.0  # seconds added to each call by the fake services
+PINECONE_LATENCY = 0.0
+MEDIAWIKI_LATENCY = 0.0
+COMPLETION_WORDS = 150
+EMBEDDING_MODEL = "text-embedding-3-small"
+INDEX_NAME = "benchmark-suite"
+
+
+def summary(times: list[float]) -> dict:
+    times = sorted(times)
+    return {
+        "count": len(times),
+        "p50": statistics.median(times),
+        "p95": times[min(len(times) - 1, int(round(0.95 * (len(times) - 1))))],
+        "mean": statistics.fmean(times),
+    }
+
+
+def timed_calls(function, queries) -> tuple[dict, list]:
+    times = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(function(query))
+        times.append(time.perf_counter() - start)
+    return summary(times), results
+
+
+def make_queries(strings: list[str], n: int) -> list[tuple[str, str]]:
+    """Questions made from a run of words in randomly chosen chunks, paired with the chunk."""
+    rng = random.Random(0)
+    queries = []
+    for string in rng.sample(strings, min(n, len(strings))):
+        words = string.split()
+        start = rng.randrange(max(1, len(words) - 12))
+        queries.append((f"What does the wiki say about {' '.join(words[start:start + 12])}?", string))
+    return queries
+
+
+def run_size(pages: int, fake_openai, fake_pinecone) -> dict:
+    openai_client = OpenAI(api_key="fake", base_url=fake_openai.url + "/v1")
+    fake_pinecone.reset()
+    cb.save_index_host(INDEX_NAME, fake_pinecone.url)
+    cb.metrics.reset()
+    requests_before = {"openai": fake_openai.requests, "pinecone": fake_pinecone.requests}
+    result = {"pages": pages}
+
+    with FakeMediaWiki(pages=pages, latency=MEDIAWIKI_LATENCY) as wiki:
+        start = time.perf_counter()
+        extractor = cb.WikiExtractor(site_name=wiki.host, url=wiki.api_url)
+        strings, urls = extractor.compile_wiki_strings()
+        extract_seconds = time.perf_counter() - start
+        result["requests"] = {"mediawiki": wiki.requests}
+
+    start = time.perf_counter()
+    df = cb.Embedder(openai_client, embedding_model=EMBEDDING_MODEL).compile_embeddings(strings, urls)
+    embed_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    storer = cb.Storer(openai_client, df, db_path=os.path.join(WORK_DIR, f"chunks_{pages}.db"),
+        pinecone_index_name=INDEX_NAME, embedding_model=EMBEDDING_MODEL, overwrite_db=True)
+    store_seconds = time.perf_counter() - start
+
+    csv_path = os.path.join(WORK_DIR, f"embeddings_{pages}.csv")
+    df[['text', 'embedding']].to_csv(csv_path, index=False)
+    local_asker = cb.Asker(openai_client, embedding_model=EMBEDDING_MODEL)
+    start = time.perf_counter()
+    local_asker.load_embeddings_from_csv(csv_path)
+    load_seconds = time.perf_counter() - start
+
+    result["chunks"] = len(strings)
+    result["ingest"] = {
+        "extract_seconds": extract_seconds,
+        "embed_seconds": embed_seconds,
+        "store_seconds": store_seconds,
+        "load_csv_seconds": load_seconds,
+    }
+
+    queries = make_queries(strings, QUERIES)
+    questions = [question for question, source in queries]
+    pinecone_timing, matches = timed_calls(lambda q: storer.get_pinecone_matches(q, top_n=TOP_N), questions)
+    storer.coarse_to_fine = True
+    coarse_timing, coarse_matches = timed_calls(lambda q: storer.get_pinecone_matches(q, top_n=TOP_N), questions)
+    storer.coarse_to_fine = False
+    local_timing, ranked = timed_calls(lambda q: local_asker.strings_ranked_by_relatedness(q, top_n=TOP_N), questions)
+    result["retrieval"] = {
+        "get_pinecone_matches": pinecone_timing,
+        "get_pinecone_matches_coarse_to_fine": coarse_timing,
+        "strings_ranked_by_relatedness": local_timing,
+        "pinecone_hit_rate": statistics.fmean(
+            len(m) > 0 and m.content.iloc[0] == source for m, (q, source) in zip(matches, queries)),
+        "coarse_to_fine_hit_rate": statistics.fmean(
+            len(m) > 0 and m.content.iloc[0] == source for m, (q, source) in zip(coarse_matches, queries)),
+        "local_hit_rate": statistics.fmean(
+            len(r[0]) > 0 and r[0][0] == source for r, (q, source) in zip(ranked, queries)),
+    }
+
+    asker = cb.Asker(openai_client, storage=storer, embedding_model=EMBEDDING_MODEL)
+    result["ask"], answers = timed_calls(lambda q: asker.ask(q), questions)
+    start = time.perf_counter()
+    list(asker.ask_many(questions, concurrency=ASK_MANY_CONCURRENCY))
+    result["ask_many_seconds"] = time.perf_counter() - start
+
+    result["stages"] = {series: values for series, values in cb.metrics.snapshot().items()
+        if series.startswith("chatbotter_stage_seconds")}
+    result["requests"]["openai"] = fake_openai.requests - requests_before["openai"]
+    result["requests"]["pinecone"] = fake_pinecone.requests - requests_before["pinecone"]
+    return result
+
+
+def timings(report: dict) -> dict:
+    """Flattens a report to {name: seconds}, taking p50 for distributions."""
+    flat = {}
+    for result in report["results"]:
+        prefix = f"{result['pages']} pages"
+        for name, seconds in result["ingest"].items():
+            flat[f"{prefix} ingest {name}"] = seconds
+        for name in ["get_pinecone_matches", "get_pinecone_matches_coarse_to_fine", "strings_ranked_by_relatedness"]:
+            if name in result["retrieval"]:
+                flat[f"{prefix} retrieval {name} p50"] = result["retrieval"][name]["p50"]
+        flat[f"{prefix} ask p50"] = result["ask"]["p50"]
+        if "ask_many_seconds" in result:
+            flat[f"{prefix} ask_many"] = result["ask_many_seconds"]
+    return flat
+
+
+def compare(report: dict, baseline: dict) -> list[str]:
+    current, previous = timings(report), timings(baseline)
+    regressions = []
+    for name, seconds in current.items():
+        if name not in previous:
+            continue
+        before = previous[name]
+        slower = seconds > before * (1 + TOLERANCE) and seconds - before > MIN_DELTA
+        change = (seconds - before) / before * 100 if before else 0
+        print(f"{name:>60}: {before * 1000:9.2f} ms -> {seconds * 1000:9.2f} ms ({change:+6.1f}%)"
+              f"{'  REGRESSION' if slower else ''}")
+        if slower:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    report = {
+        "generated": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "settings": {
+            "corpus_sizes": CORPUS_SIZES,
+            "queries": QUERIES,
+            "top_n": TOP_N,
+            "openai_latency": OPENAI_LATENCY,
+            "pinecone_latency": PINECONE_LATENCY,
+            "mediawiki_latency": MEDIAWIKI_LATENCY,
+            "completion_words": COMPLETION_WORDS,
+        },
+        "results": [],
+    }
+    with FakeOpenAI(latency=OPENAI_LATENCY, completion_words=COMPLETION_WORDS) as fake_openai, \
+            FakePinecone(latency=PINECONE_LATENCY) as fake_pinecone:
+        for pages in CORPUS_SIZES:
+            result = run_size(pages, fake_openai, fake_pinecone)
+            report["results"].append(result)
+            ingest = result["ingest"]
+            print(f"{pages:>5} pages, {result['chunks']:>5} chunks: "
+                  f"extract {ingest['extract_seconds']:.2f} s, embed {ingest['embed_seconds']:.2f} s, "
+                  f"store {ingest['store_seconds']:.2f} s; "
+                  f"pinecone p50 {result['retrieval']['get_pinecone_matches']['p50'] * 1000:.1f} ms, "
+                  f"coarse-to-fine p50 {result['retrieval']['get_pinecone_matches_coarse_to_fine']['p50'] * 1000:.1f} ms, "
+                  f"local p50 {result['retrieval']['strings_ranked_by_relatedness']['p50'] * 1000:.1f} ms, "
+                  f"ask p50 {result['ask']['p50'] * 1000:.1f} ms, "
+                  f"ask_many {result['ask_many_seconds']:.2f} s for {QUERIES}")
+
+    shutil.rmtree(WORK_DIR, ignore_errors=True)
+    with open(REPORT_PATH, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {REPORT_PATH}")
+
+    if BASELINE_PATH:
+        with open(BASELINE_PATH) as f:
+            regressions = compare(report, json.load(f))
+        if regressions:
+            sys.exit(f"{len(regressions)} timings regressed by more than {TOLERANCE:.0%}.")
@@ -5,35 +5,40 @@ This produces a verbose chapter with a lot of redundancy.
 
 
 from openai import OpenAI # for calling the OpenAI API
+from chatbotter import CompletionCache, create_completion
 
 # Set your API key here
 openai_client = OpenAI(
   organization='org-M7JuSsksoyQIdQOGaTgA2wkk',
   project='proj_E0H6uUDUEkSZfn0jdmqy206G',
 )
+# Rerunning with the same description reuses the earlier completions.
+completion_cache = CompletionCache()
 
 def generate_chapter_outline(description):
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    response_message = create_completion(
+        openai_client,
+        "gpt-4o",
+        [
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": f"Generate a detailed outline for a chapter based on this description: {description}. Include subheads with several bullet points under each subhead."}
         ],
+        cache=completion_cache,
         temperature=0
     )
-    response_message = response.choices[0].message.content
     return response_message
 
 def expand_bullet_point(bullet_point):
-    response = openai_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
+    response_message = create_completion(
+        openai_client,
+        "gpt-4o",
+        [
             {"role": "system", "content": "You are a helpful assistant."},
             {"role": "user", "content": f"Write 10 to 20 paragraphs expanding on this bullet point: {bullet_point}"}
         ],
+        cache=completion_cache,
         temperature=0
     )
-    response_message = response.choices[0].message.content
     return response_message
 
 def write_chapter(description):
@@ -8,26 +8,60 @@ https://cookbook.openai.com/examples/embedding_wikipedia_articles_for_search
 """
 
 # imports
-from openai import OpenAI # for calling the OpenAI API
-import mwclient  # for downloading example Wikipedia articles
+from openai import OpenAI, APIConnectionError, InternalServerError, RateLimitError # for calling the OpenAI API
 from typing import List, Iterator
-from mediawiki import MediaWiki
-import mwparserfromhell  # for splitting Wikipedia articles into sections
 import os  # for environment variables
 import pandas as pd  # for DataFrames to store article sections and embeddings
 import re  # for cutting <ref> links out of Wikipedia articles
 import tiktoken  # for counting tokens
 from pinecone import Pinecone, ServerlessSpec
+from pinecone.exceptions import NotFoundException
 import hashlib
 import time
 import numpy as np
 import sqlite3
 import itertools
 import ast  # for converting embeddings saved as strings back to arrays
-from scipy import spatial  # for calculating vector similarities for search
 import json
+import random
+import base64
+import zlib
+import urllib.parse
+import threading
+import asyncio
+import collections
+import bisect
+import functools
+import concurrent.futures
+import queue
+import atexit
+import fcntl
+import msgspec
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 from psycopg2 import sql
+try:
+    import zstandard  # optional, only needed for compressed content storage
+except ImportError:
+    zstandard = None
+# mwclient, mediawiki and mwparserfromhell (for WikiExtractor) and scipy are
+# imported where they're used, which keeps the web apps quick to start.
+
+# Pinecone rejects vectors whose metadata exceeds 40 KB.
+PINECONE_METADATA_LIMIT = 40960
+
+# Output sizes of the OpenAI embedding models, so creating an index doesn't
+# take a probe request to find out.
+EMBEDDING_DIMENSIONS = {
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+    "text-embedding-ada-002": 1536,
+}
+
+# Where the hosts of Pinecone indexes are remembered, so connecting to an
+# index needs no control-plane requests after the first time.
+PINECONE_INDEX_CACHE = os.getenv('PINECONE_INDEX_CACHE', '.pinecone_indexes.json')
 
 
 #### HELPER FUNCTIONS ###
@@ -44,6 +78,477 @@ def pretty_print(messages):
     print()
 
 
+def pack_content_metadata(
+    title: str,
+    url: str,
+    content: str,
+    limit: int = PINECONE_METADATA_LIMIT
+) -> dict:
+    """
+    Return Pinecone metadata that carries the chunk text along with its
+    title and url. Text that would push the metadata over the size limit
+    is stored zlib-compressed and base64-encoded under "content_z". If even
+    the compressed form is too big, the text is left out and readers fall
+    back to the chunk store.
+    """
+    metadata = {"title": title, "url": url}
+    # Allow for the JSON key, quotes and escaping overhead.
+    overhead = len(json.dumps(metadata).encode('utf-8')) + 64
+    if overhead + len(json.dumps(content).encode('utf-8')) <= limit:
+        metadata["content"] = content
+        return metadata
+    packed = base64.b64encode(zlib.compress(content.encode('utf-8'), 9)).decode('ascii')
+    if overhead + len(packed) <= limit:
+        metadata["content_z"] = packed
+    return metadata
+
+
+def unpack_content_metadata(metadata) -> str:
+    """Return the chunk text stored by pack_content_metadata, or None."""
+    if not metadata:
+        return None
+    if "content" in metadata:
+        return metadata["content"]
+    if "content_z" in metadata:
+        return zlib.decompress(base64.b64decode(metadata["content_z"])).decode('utf-8')
+    return None
+
+
+def embedding_dimensions(openai_client, model: str, dimensions: int = None) -> int:
+    """The size of the model's embeddings, asking the API only for unknown models."""
+    if dimensions:
+        return dimensions
+    if model in EMBEDDING_DIMENSIONS:
+        return EMBEDDING_DIMENSIONS[model]
+    response = openai_client.embeddings.create(input="Hello!", model=model)
+    return len(response.data[0].embedding)
+
+
+def cached_index_host(index_name: str) -> str:
+    try:
+        with open(PINECONE_INDEX_CACHE) as f:
+            return json.load(f).get(index_name)
+    except (OSError, ValueError):
+        return None
+
+
+def save_index_host(index_name: str, host: str):
+    try:
+        with open(PINECONE_INDEX_CACHE) as f:
+            hosts = json.load(f)
+    except (OSError, ValueError):
+        hosts = {}
+    hosts[index_name] = host
+    tmp_path = f"{PINECONE_INDEX_CACHE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(hosts, f, indent=2)
+    os.replace(tmp_path, PINECONE_INDEX_CACHE)
+
+
+def forget_index_host(index_name: str):
+    try:
+        with open(PINECONE_INDEX_CACHE) as f:
+            hosts = json.load(f)
+    except (OSError, ValueError):
+        return
+    if hosts.pop(index_name, None) is None:
+        return
+    tmp_path = f"{PINECONE_INDEX_CACHE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(hosts, f, indent=2)
+    os.replace(tmp_path, PINECONE_INDEX_CACHE)
+
+
+class PineconeIndex:
+    """
+    A Pinecone index connected through a host from the index host cache.
+    If the data plane answers a call with 404 Not Found, because the index
+    was deleted or recreated with a new host since it was cached, the host
+    is looked up again with describe_index, the cache is updated and the
+    call is retried once. Other attributes are those of pinecone.Index.
+    """
+    def __init__(self, pinecone: Pinecone, index_name: str, host: str) -> None:
+        self.pinecone = pinecone
+        self.index_name = index_name
+        self.index = pinecone.Index(index_name, host=host)
+        self.lock = threading.Lock()
+
+    def reconnect(self, stale_index):
+        with self.lock:
+            if self.index is not stale_index:
+                return  # another thread already reconnected
+            forget_index_host(self.index_name)
+            host = self.pinecone.describe_index(self.index_name).host
+            save_index_host(self.index_name, host)
+            self.index = self.pinecone.Index(self.index_name, host=host)
+
+    def __getattr__(self, name):
+        index = self.index
+        attribute = getattr(index, name)
+        if not callable(attribute):
+            return attribute
+        @functools.wraps(attribute)
+        def call(*args, **kwargs):
+            try:
+                return attribute(*args, **kwargs)
+            except NotFoundException:
+                self.reconnect(index)
+                return getattr(self.index, name)(*args, **kwargs)
+        return call
+
+
+def cosine_similarity(x, y) -> float:
+    from scipy import spatial  # for calculating vector similarities for search
+    return 1 - spatial.distance.cosine(x, y)
+
+
+def truncate_embedding(embedding, dimensions: int) -> list[float]:
+    """
+    Shortens a text-embedding-3 vector to its first `dimensions` components
+    and renormalizes it, which gives the same vector the API returns when
+    asked for that many dimensions.
+    """
+    vector = np.asarray(embedding, dtype=np.float32)[:dimensions]
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def rerank_matches(matches, vectors: dict, query_embedding, top_n: int) -> list:
+    """
+    Rescores a shortlist of Pinecone matches against their full-size vectors
+    (a dict from id to vector) and returns the best top_n. Matches without a
+    full vector keep their index score.
+    """
+    if vectors:
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+        for match in matches:
+            if match.id in vectors:
+                vector = vectors[match.id]
+                match.score = float(vector @ query / np.linalg.norm(vector))
+        matches = sorted(matches, key=lambda match: match.score, reverse=True)
+    return matches[:top_n]
+
+
+def mmr_order(query_embedding, vectors, diversity_lambda: float = 0.7, k: int = None) -> np.ndarray:
+    """
+    Orders candidates (the rows of vectors) by Maximal Marginal Relevance:
+    each next candidate maximizes diversity_lambda times its similarity to
+    the query minus (1 - diversity_lambda) times its highest similarity to
+    the candidates already chosen. Returns the positions of the first k
+    (by default all) candidates in that order.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    n = len(vectors)
+    k = n if k is None else min(k, n)
+    order = np.empty(k, dtype=np.intp)
+    if k == 0:
+        return order
+    query = np.asarray(query_embedding, dtype=np.float32)
+    # All pairwise similarities up front, in one matrix product; the norms
+    # come from its diagonal, which is cheaper than normalizing the vectors.
+    similarity = vectors @ vectors.T
+    norms = np.sqrt(np.diagonal(similarity))
+    norms[norms == 0] = 1
+    similarity /= norms[:, None]
+    similarity /= norms[None, :]
+    similarity *= 1 - diversity_lambda
+    relevance = (vectors @ query) / (norms * (np.linalg.norm(query) or 1))
+    relevance *= diversity_lambda
+    # The first pick is the most relevant; after that, redundancy holds each
+    # candidate's highest similarity to the ones chosen so far.
+    best = int(relevance.argmax())
+    order[0] = best
+    relevance[best] = -np.inf
+    redundancy = similarity[best].copy()
+    scores = np.empty(n, dtype=np.float32)
+    for step in range(1, k):
+        np.subtract(relevance, redundancy, out=scores)
+        best = int(scores.argmax())
+        order[step] = best
+        relevance[best] = -np.inf
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return order
+
+
+def mmr_matches(matches, vectors: dict, query_embedding, diversity_lambda: float = 0.7, key = None) -> list:
+    """
+    Reorders Pinecone matches by Maximal Marginal Relevance, using their
+    vectors (a dict from id to vector), so near-duplicates of a match
+    already chosen move down the list. Matches without a vector keep their
+    order after the others. key gets the id of a match, if it isn't match.id.
+    """
+    if key is None:
+        key = lambda match: match.id
+    ranked = [match for match in matches if key(match) in vectors]
+    if not ranked:
+        return matches
+    order = mmr_order(query_embedding, np.stack([np.asarray(vectors[key(match)], dtype=np.float32) for match in ranked]),
+        diversity_lambda)
+    return [ranked[i] for i in order] + [match for match in matches if key(match) not in vectors]
+
+
+def simhash(text: str, shingle_words: int = 3) -> int:
+    """
+    A 64-bit SimHash fingerprint of the text's overlapping runs of
+    shingle_words words, case-insensitive: texts that share most of their
+    wording get fingerprints that differ in only a few bits. It is built
+    on Python's hash(), so fingerprints can only be compared within one process.
+    """
+    words = text.lower().split()
+    shingles = zip(*(words[i:] for i in range(shingle_words))) if len(words) >= shingle_words else [tuple(words)]
+    hashes = np.fromiter(map(hash, shingles), dtype=np.int64)
+    # One row of 64 bits per shingle; each bit of the fingerprint is the majority vote of its column.
+    votes = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=0)
+    return int.from_bytes(np.packbits(votes * 2 > len(hashes)).tobytes(), 'big')
+
+
+def hamming_distance(x: int, y: int) -> int:
+    return (x ^ y).bit_count()
+
+
+class Histogram:
+    """
+    A Prometheus-style histogram: counts of observations at or below each
+    bucket bound, plus their sum. Observing is a bisect and a few adds.
+    """
+    def __init__(self, buckets) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Estimates a quantile by interpolating within its bucket."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            count, total = self.count, self.sum
+        return {
+            "count": count,
+            "sum": total,
+            "mean": total / count if count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Timer:
+    """Context manager that observes the seconds spent inside it."""
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    """
+    Latency histograms, counters and gauges for a process, readable from
+    Python with snapshot() and in the Prometheus text format with render().
+    Gauges come from collector functions, called at read time, that return
+    (name, labels, value) tuples.
+    """
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self) -> None:
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = collections.Counter()  # (name, labels) -> value
+        self.help = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def histogram(self, name: str, help: str = "", buckets = None, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram(buckets or self.default_buckets))
+                if help:
+                    self.help.setdefault(name, help)
+        return histogram
+
+    def observe(self, name: str, value: float, **labels):
+        self.histogram(name, **labels).observe(value)
+
+    def timer(self, name: str, **labels) -> Timer:
+        return Timer(self.histogram(name, **labels))
+
+    def increment(self, name: str, value: float = 1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def reset(self):
+        """Forgets all observations, e.g. between benchmark runs."""
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def register_collector(self, collector):
+        self.collectors.append(collector)
+
+    def gauges(self) -> list:
+        return [gauge for collector in self.collectors for gauge in collector()]
+
+    @staticmethod
+    def series(name: str, labels) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+    def snapshot(self) -> dict:
+        """Histogram summaries, counters and gauges, keyed by series name."""
+        with self.lock:
+            histograms = list(self.histograms.items())
+            counters = list(self.counters.items())
+        result = {self.series(name, labels): h.snapshot() for (name, labels), h in histograms}
+        result.update({self.series(name, labels): value for (name, labels), value in counters})
+        result.update({self.series(name, tuple(sorted(labels.items()))): value for name, labels, value in self.gauges()})
+        return result
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), histogram in histograms:
+            header(name, "histogram")
+            with histogram.lock:
+                counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+            cumulative = 0
+            for bound, n in zip(histogram.buckets + ("+Inf", ), counts):
+                cumulative += n
+                lines.append(f"{self.series(name + '_bucket', labels + (('le', bound), ))} {cumulative}")
+            lines.append(f"{self.series(name + '_sum', labels)} {total}")
+            lines.append(f"{self.series(name + '_count', labels)} {count}")
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{self.series(name, labels)} {value}")
+        for name, labels, value in sorted(self.gauges(), key=lambda gauge: gauge[0]):
+            header(name, "gauge")
+            lines.append(f"{self.series(name, tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# The process-wide registry that the classes below report to.
+metrics = MetricsRegistry()
+metrics.help.update({
+    "chatbotter_stage_seconds": "Time spent in each stage of answering a question.",
+    "chatbotter_ttft_seconds": "Time to the first streamed completion token.",
+    "chatbotter_db_pool_wait_seconds": "Time spent waiting for a pooled Postgres connection.",
+})
+
+
+def stage_timer(stage: str) -> Timer:
+    """Times one stage of answering a question, e.g. with stage_timer("embed"): ..."""
+    return metrics.timer("chatbotter_stage_seconds", stage=stage)
+
+
+def timed(stage: str):
+    """Decorator form of stage_timer, for plain and async functions."""
+    def decorate(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with stage_timer(stage):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with stage_timer(stage):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class ContentCompressor:
+    """
+    Compresses chunk text with zstd using a dictionary trained on the corpus.
+    Chunks are short and share a lot of boilerplate (wiki templates, email
+    quoting, signatures), which a shared dictionary captures far better than
+    compressing each chunk on its own.
+    """
+    def __init__(
+        self,
+        dictionary: bytes = None,
+        level: int = 9
+    ) -> None:
+        if zstandard is None:
+            raise ImportError("Compressed content storage requires the zstandard package.")
+        self.dictionary = dictionary
+        self.level = level
+        self.zstd_dict = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        # zstd compressor objects aren't thread safe, so keep one per thread.
+        self.local = threading.local()
+
+    @classmethod
+    def train(
+        cls,
+        samples: list[str],
+        dict_size: int = 112640,
+        level: int = 9
+    ):
+        """Train a dictionary on sample chunks and return a compressor that uses it."""
+        encoded = [sample.encode('utf-8') for sample in samples if sample]
+        try:
+            dictionary = zstandard.train_dictionary(dict_size, encoded, level=level).as_bytes()
+        except zstandard.ZstdError as e:
+            # Too few or too uniform samples; plain zstd still helps.
+            print(f"Could not train a compression dictionary: {e}")
+            dictionary = None
+        return cls(dictionary, level=level)
+
+    def compressor(self):
+        if not hasattr(self.local, 'compressor'):
+            self.local.compressor = zstandard.ZstdCompressor(level=self.level, dict_data=self.zstd_dict)
+            self.local.decompressor = zstandard.ZstdDecompressor(dict_data=self.zstd_dict)
+        return self.local.compressor, self.local.decompressor
+
+    def compress(self, text: str) -> bytes:
+        compressor, decompressor = self.compressor()
+        return compressor.compress(text.encode('utf-8'))
+
+    def decompress(self, data: bytes) -> str:
+        compressor, decompressor = self.compressor()
+        return decompressor.decompress(bytes(data)).decode('utf-8')
+
+
 # Models a simple batch generator that make chunks out of an input DataFrame
 class WikiExtractor:
     def __init__(self,
@@ -54,8 +559,11 @@ class WikiExtractor:
         limit = False,
         debug = False
     ) -> None:
+        import mwclient  # for downloading example Wikipedia articles
+        from mediawiki import MediaWiki
         self.site_name = site_name
-        self.site = mwclient.Site(site_name)
+        # mwclient takes the scheme separately; follow the API url's (http for local test wikis).
+        self.site = mwclient.Site(site_name, scheme=urllib.parse.urlsplit(url).scheme or 'https')
         self.gw = MediaWiki(url=url, user_agent=user_agent)
         self.url = url
         self.user_agent = user_agent
@@ -101,11 +609,12 @@ class WikiExtractor:
 
     def titles_from_category(
         self,
-        category: mwclient.listing.Category,
+        category: "mwclient.listing.Category",
         category_names,
         max_depth: int
     ) -> set[str]:
         """Return a set of page titles in a given Wiki category and its subcategories."""
+        import mwclient
         titles = set()
         for cm in category.members():
             if type(cm) == mwclient.page.Page:
@@ -118,7 +627,7 @@ class WikiExtractor:
         return titles, category_names
 
     def all_subsections_from_section(
-        self, section: mwparserfromhell.wikicode.Wikicode,
+        self, section: "mwparserfromhell.wikicode.Wikicode",
         parent_titles: list[str],
     ) -> list[tuple[list[str], str]]:
         """
@@ -156,6 +665,7 @@ class WikiExtractor:
         """
         page = self.site.pages[title]
         text = page.text()
+        import mwparserfromhell  # for splitting Wikipedia articles into sections
         parsed_text = mwparserfromhell.parse(text)
         headings = [str(h) for h in parsed_text.filter_headings()]
         if headings:
@@ -336,6 +846,113 @@ class WikiExtractor:
         return strings, urls
 
 
+class EmbeddingEngine:
+    """
+    Embeds many texts with as few requests as the API allows. Texts are
+    packed in order into requests of at most max_inputs texts and max_tokens
+    tokens, up to concurrency requests are in flight at once, and the
+    embeddings come back in the order of the texts. Requests that hit a
+    rate limit, a server error or a dropped connection are retried after an
+    exponential, jittered backoff (or the server's Retry-After), up to
+    max_retries times. Texts longer than max_input_tokens are truncated, and
+    empty ones are sent as a single space, since the API rejects both.
+    """
+    def __init__(
+        self,
+        openai_client,
+        embedding_model: str = "text-embedding-3-small",
+        max_inputs: int = 2048,
+        max_tokens: int = 100000,
+        max_input_tokens: int = 8191,
+        concurrency: int = 8,
+        max_retries: int = 6,
+        base_delay: float = 1,
+        max_delay: float = 60,
+        debug = False
+    ) -> None:
+        self.openai_client = openai_client
+        self.embedding_model = embedding_model
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.max_input_tokens = max_input_tokens
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.debug = debug
+        # The tokenizer of the text-embedding-3 and ada-002 models.
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.requests = 0
+        self.retries = 0
+
+    def pack(self, texts: list[str]) -> tuple[list[str], list[tuple[int, int]]]:
+        """
+        Returns the texts as they will be sent, and the (start, end) slices
+        of them that make up each request.
+        """
+        prepared = []
+        batches = []
+        start = 0
+        tokens = 0
+        for i, (text, encoded) in enumerate(zip(texts, self.encoding.encode_ordinary_batch(texts))):
+            if len(encoded) > self.max_input_tokens:
+                encoded = encoded[:self.max_input_tokens]
+                text = self.encoding.decode(encoded)
+            prepared.append(text if text.strip() else " ")
+            if i > start and (i - start >= self.max_inputs or tokens + len(encoded) > self.max_tokens):
+                batches.append((start, i))
+                start, tokens = i, 0
+            tokens += max(len(encoded), 1)
+        if start < len(texts):
+            batches.append((start, len(texts)))
+        return prepared, batches
+
+    def request(self, inputs: list[str], extra_args: dict) -> list[list[float]]:
+        for attempt in range(self.max_retries + 1):
+            try:
+                # Timed apart from "embed", the per-question embedding, so
+                # bulk ingestion doesn't skew the answering latencies.
+                with stage_timer("ingest_embed"):
+                    response = self.openai_client.embeddings.create(
+                        model=self.embedding_model, input=inputs, **extra_args)
+                self.requests += 1
+                return [e.embedding for e in sorted(response.data, key=lambda e: e.index)]
+            except (RateLimitError, InternalServerError, APIConnectionError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1)
+                retry_after = getattr(getattr(e, 'response', None), 'headers', {}).get('retry-after')
+                if retry_after:
+                    try:
+                        delay = max(delay, float(retry_after))
+                    except ValueError:
+                        pass
+                self.retries += 1
+                if self.debug:
+                    print(f"Embedding request of {len(inputs)} texts failed ({e.__class__.__name__}); retrying in {delay:.1f} s")
+                time.sleep(delay)
+
+    def embed(self, texts, **extra_args) -> list[list[float]]:
+        """Returns one embedding per text, in order. extra_args go to embeddings.create (e.g. dimensions)."""
+        texts = list(texts)
+        prepared, batches = self.pack(texts)
+        embeddings = [None] * len(texts)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            futures = {executor.submit(self.request, prepared[start:end], extra_args): (start, end)
+                for start, end in batches}
+            done = 0
+            for future in concurrent.futures.as_completed(futures):
+                start, end = futures[future]
+                embeddings[start:end] = future.result()
+                done += end - start
+                if self.debug:
+                    print(f"Embedded {done} of {len(texts)} texts")
+        finally:
+            executor.shutdown(cancel_futures=True)
+        return embeddings
+
+
 class Embedder:
     def __init__(
         self,
@@ -343,12 +960,40 @@ class Embedder:
         batch_size = 1000,
         embedding_model = "text-embedding-3-small",
         gpt_model: str = "gpt-4o",  # selects which tokenizer to use
+        dimensions: int = None,
+        keep_full_embeddings = False,
+        use_batch_api = False,
+        batch_dir = 'embedding_batches',
+        batch_file_requests = 50000,
+        poll_interval: float = 5,
+        max_poll_interval: float = 300,
+        max_batch_attempts: int = 3,
+        concurrency: int = 4,
         debug = False
     ) -> None:
         self.openai_client = openai_client
+        # Without the Batch API, chunks are embedded by an EmbeddingEngine in
+        # requests of at most batch_size chunks, concurrency at a time.
         self.batch_size = batch_size
+        self.concurrency = concurrency
         self.embedding_model = embedding_model
         self.gpt_model = gpt_model
+        # Reduced embedding size for the primary index (None for the model's
+        # full size). With keep_full_embeddings the full vectors are kept in
+        # a "full_embedding" column for reranking.
+        self.dimensions = dimensions
+        self.keep_full_embeddings = keep_full_embeddings
+        # With use_batch_api, chunks are embedded through the Batch API: the
+        # requests are written to JSONL files of at most batch_file_requests
+        # lines in batch_dir, submitted, and polled every poll_interval
+        # seconds, backing off to max_poll_interval. Requests that fail are
+        # resubmitted, up to max_batch_attempts submissions in all.
+        self.use_batch_api = use_batch_api
+        self.batch_dir = batch_dir
+        self.batch_file_requests = batch_file_requests
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_batch_attempts = max_batch_attempts
         self.debug = debug
         self.urls = {}
 
@@ -372,20 +1017,23 @@ class Embedder:
         return hash_object.hexdigest()
 
     def compile_embeddings(self, strings, urls):
-        embeddings = []
         self.urls = urls
-        for batch_start in range(0, len(strings), self.batch_size):
-            batch_end = batch_start + self.batch_size
-            batch = strings[batch_start:batch_end]
-            if self.debug:
-                print(f"Batch {batch_start} to {batch_end-1}")
-            response = self.openai_client.embeddings.create(model=self.embedding_model, input=batch)
-            for i, be in enumerate(response.data):
-                assert i == be.index  # double check embeddings are in same order as input
-            batch_embeddings = [e.embedding for e in response.data]
-            embeddings.extend(batch_embeddings)
+        # Full-size vectors can be shortened locally, so only ask the API for
+        # reduced ones when the full vectors aren't wanted.
+        extra_args = {}
+        if self.dimensions and not self.keep_full_embeddings:
+            extra_args['dimensions'] = self.dimensions
+        if self.use_batch_api:
+            embeddings = self.batch_embeddings(strings, extra_args)
+        else:
+            engine = EmbeddingEngine(self.openai_client, self.embedding_model, max_inputs=self.batch_size,
+                concurrency=self.concurrency, debug=self.debug)
+            embeddings = engine.embed(strings, **extra_args)
 
         df = pd.DataFrame({"text": strings, "embedding": embeddings})
+        if self.dimensions and self.keep_full_embeddings:
+            df["full_embedding"] = df["embedding"]
+            df["embedding"] = df["full_embedding"].apply(lambda e: truncate_embedding(e, self.dimensions))
         df["title"] = df['text'].apply(self.get_first_line)
         df["url"] = df['title'].apply(self.get_url)
         df["vector_id"] = df.apply(lambda row: self.generate_vector_id(row['url'] + row['text']), axis=1)
@@ -400,6 +1048,93 @@ class Embedder:
 
         return df
 
+    def batch_embeddings(self, strings, extra_args) -> list:
+        """
+        Embeds strings through the Batch API, in the order given. Each
+        request's custom_id is its string's position, which is how results
+        are matched back up; only the requests that failed are resubmitted.
+        """
+        requests = {f"chunk-{i}": {
+            "custom_id": f"chunk-{i}",
+            "method": "POST",
+            "url": "/v1/embeddings",
+            "body": {"model": self.embedding_model, "input": string, **extra_args},
+        } for i, string in enumerate(strings)}
+        embeddings = {}
+        remaining = list(requests)
+        for attempt in range(self.max_batch_attempts):
+            if not remaining:
+                break
+            if self.debug:
+                print(f"Submitting {len(remaining)} embedding requests to the Batch API (attempt {attempt + 1}).")
+            paths = self.write_batch_files([requests[custom_id] for custom_id in remaining], attempt)
+            for batch in self.wait_for_batches([self.submit_batch(path) for path in paths]):
+                self.read_batch_results(batch, embeddings)
+            remaining = [custom_id for custom_id in remaining if custom_id not in embeddings]
+        if remaining:
+            raise RuntimeError(f"{len(remaining)} embedding requests still failed after "
+                f"{self.max_batch_attempts} Batch API submissions, e.g. {remaining[:5]}")
+        return [embeddings[f"chunk-{i}"] for i in range(len(strings))]
+
+    def write_batch_files(self, requests, attempt: int = 0) -> list[str]:
+        """Writes the requests to JSONL files of at most batch_file_requests lines each."""
+        os.makedirs(self.batch_dir, exist_ok=True)
+        stamp = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        paths = []
+        for n, start in enumerate(range(0, len(requests), self.batch_file_requests)):
+            path = os.path.join(self.batch_dir, f"embeddings-{stamp}-{attempt}-{n:03d}.jsonl")
+            with open(path, "w") as f:
+                for request in requests[start:start + self.batch_file_requests]:
+                    f.write(json.dumps(request) + "\n")
+            paths.append(path)
+        return paths
+
+    def submit_batch(self, path):
+        with open(path, "rb") as f:
+            input_file = self.openai_client.files.create(file=f, purpose="batch")
+        batch = self.openai_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/embeddings",
+            completion_window="24h"
+        )
+        if self.debug:
+            print(f"Submitted {path} as {batch.id}")
+        return batch
+
+    def wait_for_batches(self, batches) -> list:
+        """Polls until every batch has finished, doubling the wait between polls up to max_poll_interval."""
+        pending = [batch.id for batch in batches]
+        finished = []
+        interval = self.poll_interval
+        while pending:
+            for batch_id in list(pending):
+                batch = self.openai_client.batches.retrieve(batch_id)
+                if batch.status in ("completed", "failed", "expired", "cancelled"):
+                    if self.debug:
+                        print(f"{batch_id} {batch.status}: {batch.request_counts}")
+                    pending.remove(batch_id)
+                    finished.append(batch)
+            if pending:
+                time.sleep(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+        return finished
+
+    def read_batch_results(self, batch, embeddings: dict):
+        """
+        Streams a finished batch's output file into embeddings, keyed by
+        custom_id. Failed requests are in the error file, or missing if the
+        batch expired or failed, and are left out.
+        """
+        if not batch.output_file_id:
+            return
+        with self.openai_client.files.with_streaming_response.content(batch.output_file_id) as response:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                result = json.loads(line)
+                if result.get("response") and result["response"]["status_code"] == 200:
+                    embeddings[result["custom_id"]] = result["response"]["body"]["data"][0]["embedding"]
+
 
 # Models a simple batch generator that make chunks out of an input DataFrame
 class BatchGenerator:
@@ -423,6 +1158,11 @@ class BatchGenerator:
 
 
 class Storer:
+    # corpus_version() reads the stored version at most this often, in seconds.
+    corpus_version_ttl = 30
+    corpus_version_cache = None
+    corpus_version_checked = 0
+
     def __init__(
         self,
         openai_client,
@@ -432,6 +1172,15 @@ class Storer:
         embedding_model = "text-embedding-3-small",
         overwrite_db = False,
         overwrite_pinecone = False,
+        metadata_content = False,
+        compress_content = False,
+        dimensions: int = None,
+        rerank = False,
+        rerank_multiplier: int = 4,
+        mmr = False,
+        mmr_lambda: float = 0.7,
+        coarse_to_fine = False,
+        title_top_k: int = 20,
         debug = False
     ) -> None:
         self.openai_client = openai_client
@@ -439,8 +1188,30 @@ class Storer:
         self.db_path = db_path
         self.pinecone_index_name = pinecone_index_name
         self.embedding_model = embedding_model
+        # Reduced embedding size for the Pinecone index (None for the model's
+        # full size). With rerank, a shortlist of rerank_multiplier * top_n
+        # matches is rescored against full-size vectors kept in sqlite.
+        self.dimensions = dimensions
+        self.rerank = rerank
+        self.rerank_multiplier = rerank_multiplier
+        # With mmr, matches are reordered by Maximal Marginal Relevance, so
+        # near-duplicate chunks don't crowd others out of the prompt;
+        # mmr_lambda trades relevance (1) against diversity (0).
+        self.mmr = mmr
+        self.mmr_lambda = mmr_lambda
+        # With coarse_to_fine, queries first find the title_top_k closest pages
+        # in the title namespace and then search only those pages' chunks.
+        self.coarse_to_fine = coarse_to_fine
+        self.title_top_k = title_top_k
         self.overwrite_db = overwrite_db
         self.overwrite_pinecone = overwrite_pinecone
+        # When True, chunk text is stored as Pinecone metadata and returned
+        # with each match, so queries don't go back to sqlite.
+        self.metadata_content = metadata_content
+        # When True, chunk text is stored zstd-compressed in content_z
+        # using a dictionary trained on the corpus.
+        self.compress_content = compress_content
+        self.compressor = None
         self.debug = debug
         self.setup_database()
         self.setup_pinecone()
@@ -458,86 +1229,291 @@ class Storer:
                 unique_id TEXT PRIMARY KEY,
                 title TEXT,
                 content TEXT,
-                url TEXT
+                url TEXT,
+                content_z BLOB
+            )
+            ''')
+            c.execute('''
+            CREATE TABLE IF NOT EXISTS StoreMetadata (
+                key TEXT PRIMARY KEY,
+                value BLOB
             )
             ''')
             conn.commit()
             conn.close()
+        conn = sqlite3.connect(self.db_path)
+        c = conn.cursor()
+        columns = [row[1] for row in c.execute("PRAGMA table_info(ArticleChunks)")]
+        if 'content_z' not in columns and self.compress_content:
+            # Databases built before content_z existed need the new column.
+            c.execute("ALTER TABLE ArticleChunks ADD COLUMN content_z BLOB")
+            conn.commit()
+            columns.append('content_z')
+        c.execute("CREATE TABLE IF NOT EXISTS StoreMetadata (key TEXT PRIMARY KEY, value BLOB)")
+        conn.commit()
+        conn.close()
+        self.has_content_z = 'content_z' in columns
+
+    def get_compressor(self, samples = None):
+        """
+        Returns the ContentCompressor for this database, loading its dictionary
+        from StoreMetadata. If there is none yet and samples are given, a new
+        dictionary is trained on them and saved.
+        """
+        if self.compressor is not None:
+            return self.compressor
+        conn = sqlite3.connect(self.db_path)
+        try:
+            row = conn.execute("SELECT value FROM StoreMetadata WHERE key = 'zstd_dictionary'").fetchone()
+        except sqlite3.OperationalError:
+            row = None  # no StoreMetadata table, so nothing was ever compressed
+        if row is not None:
+            self.compressor = ContentCompressor(row[0] or None)
+        elif samples is not None:
+            self.compressor = ContentCompressor.train(samples)
+            conn.execute("INSERT OR REPLACE INTO StoreMetadata (key, value) VALUES ('zstd_dictionary', ?)",
+                (self.compressor.dictionary, ))
+            conn.commit()
+        conn.close()
+        return self.compressor
+
+    def corpus_version(self) -> str:
+        """
+        Identifies the data loaded into this store, for caches of answers
+        drawn from it. upsert_data changes it, and other processes see the
+        change within corpus_version_ttl seconds.
+        """
+        if time.monotonic() - self.corpus_version_checked > self.corpus_version_ttl:
+            conn = sqlite3.connect(self.db_path)
+            row = conn.execute("SELECT value FROM StoreMetadata WHERE key = 'corpus_version'").fetchone()
+            conn.close()
+            self.corpus_version_cache = row[0] if row else ""
+            self.corpus_version_checked = time.monotonic()
+        return self.corpus_version_cache
+
+    def bump_corpus_version(self):
+        version = str(time.time_ns())
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT OR REPLACE INTO StoreMetadata (key, value) VALUES ('corpus_version', ?)", (version, ))
+        conn.commit()
+        conn.close()
+        self.corpus_version_cache = version
+        self.corpus_version_checked = time.monotonic()
+
+    def compress_database(self):
+        """
+        Compresses the content of every chunk already in the database with a
+        dictionary trained on that content, then vacuums the file so it shrinks.
+        """
+        self.compress_content = True
+        self.setup_database()
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT unique_id, content FROM ArticleChunks WHERE content IS NOT NULL").fetchall()
+        compressor = self.get_compressor(samples=[content for unique_id, content in rows])
+        conn.executemany("UPDATE ArticleChunks SET content = NULL, content_z = ? WHERE unique_id = ?",
+            [(compressor.compress(content), unique_id) for unique_id, content in rows])
+        conn.commit()
+        conn.execute("VACUUM")
+        conn.close()
+        if self.debug:
+            print(f"Compressed {len(rows)} chunks in {self.db_path}.")
 
     def setup_pinecone(self):
         # Check whether the index with the same name already exists - if so, delete it
         pinecone_api_key = os.environ.get('PINECONE_API_KEY')
         pinecone = Pinecone(api_key=pinecone_api_key)
-        if self.pinecone_index_name in pinecone.list_indexes() and self.overwrite_pinecone:
-            pinecone.delete_index(self.pinecone_index_name)
-
-        # Creates index if it doesn't already exist.
-        if self.pinecone_index_name not in pinecone.list_indexes().names():
-            # if does not exist, create index
-            spec = ServerlessSpec(
-                cloud="aws",
-                region="us-east-1"
-            )
-            # Calculate length of embedding based on the embedding model.
-            response = self.openai_client.embeddings.create(
-              input="Hello!",
-              model=self.embedding_model
-            )
-            embedding_length = len(response.data[0].embedding)
-            pinecone.create_index(
-                self.pinecone_index_name,
-                dimension=embedding_length,
-                metric='cosine',
-                spec=spec
-            )
-            # wait for index to be initialized
-            while not pinecone.describe_index(self.pinecone_index_name).status['ready']:
-                time.sleep(1)
+        # A known index host means the index exists; skip the control plane.
+        host = None if self.overwrite_pinecone else cached_index_host(self.pinecone_index_name)
+        if host is None:
+            index_names = pinecone.list_indexes().names()
+            if self.pinecone_index_name in index_names and self.overwrite_pinecone:
+                pinecone.delete_index(self.pinecone_index_name)
+                index_names.remove(self.pinecone_index_name)
+
+            # Creates index if it doesn't already exist.
+            if self.pinecone_index_name not in index_names:
+                # if does not exist, create index
+                spec = ServerlessSpec(
+                    cloud="aws",
+                    region="us-east-1"
+                )
+                pinecone.create_index(
+                    self.pinecone_index_name,
+                    dimension=embedding_dimensions(self.openai_client, self.embedding_model, self.dimensions),
+                    metric='cosine',
+                    spec=spec
+                )
+                # wait for index to be initialized
+                while not pinecone.describe_index(self.pinecone_index_name).status['ready']:
+                    time.sleep(1)
+            host = pinecone.describe_index(self.pinecone_index_name).host
+            save_index_host(self.pinecone_index_name, host)
 
         # connect to index
-        self.pinecone_index = pinecone.Index(self.pinecone_index_name)
-        time.sleep(1)
+        self.pinecone_index = PineconeIndex(pinecone, self.pinecone_index_name, host)
         if self.debug:
             # view index stats
             print(self.pinecone_index.describe_index_stats())
             # Confirm our index was created
             print(pinecone.list_indexes())
 
+    def embedding_args(self) -> dict:
+        """
+        Extra embeddings.create arguments for queries: full size when
+        reranking (the vector is shortened locally for the Pinecone query),
+        otherwise the index's size.
+        """
+        if self.dimensions and not self.rerank:
+            return {'dimensions': self.dimensions}
+        return {}
+
+    def embed_query(self, query: str) -> list[float]:
+        with stage_timer("embed"):
+            res = self.openai_client.embeddings.create(input=[query], model=self.embedding_model, **self.embedding_args())
+        return res.data[0].embedding
+
+    def index_vector(self, embedding) -> list[float]:
+        """Shortens a full-size embedding to the index's dimensions if needed."""
+        if self.dimensions and len(embedding) > self.dimensions:
+            return truncate_embedding(embedding, self.dimensions)
+        return embedding
+
+    def save_full_embeddings(self, vector_ids, embeddings):
+        """Keeps full-size vectors in sqlite for reranking reduced-dimension matches."""
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("CREATE TABLE IF NOT EXISTS FullEmbeddings (unique_id TEXT PRIMARY KEY, embedding BLOB)")
+        conn.executemany("INSERT OR REPLACE INTO FullEmbeddings (unique_id, embedding) VALUES (?, ?)",
+            [(vector_id, np.asarray(embedding, dtype=np.float32).tobytes())
+                for vector_id, embedding in zip(vector_ids, embeddings)])
+        conn.commit()
+        conn.close()
+
+    def get_full_embeddings(self, unique_ids) -> dict:
+        """Returns a dict mapping each unique_id that has a full-size vector to that vector."""
+        vectors = {}
+        if len(unique_ids) == 0:
+            return vectors
+        conn = sqlite3.connect(self.db_path)
+        placeholders = ", ".join("?" for _ in unique_ids)
+        try:
+            for unique_id, blob in conn.execute(
+                    f"SELECT unique_id, embedding FROM FullEmbeddings WHERE unique_id IN ({placeholders})",
+                    list(unique_ids)):
+                vectors[unique_id] = np.frombuffer(blob, dtype=np.float32)
+        except sqlite3.OperationalError:
+            pass  # no FullEmbeddings table, so nothing to rerank with
+        conn.close()
+        return vectors
+
     def upsert_data(self):
         # Upsert content vectors in content namespace - this can take a few minutes
         if self.debug:
             print("Uploading vectors to content namespace..")
+        if 'full_embedding' in self.df.columns:
+            self.save_full_embeddings(self.df.vector_id, self.df.full_embedding)
+        elif self.dimensions and len(self.df.embedding.iloc[0]) > self.dimensions:
+            # Full-size vectors were passed in; keep them and index shortened ones.
+            self.save_full_embeddings(self.df.vector_id, self.df.embedding)
+        if self.compress_content:
+            compressor = self.get_compressor(samples=list(self.df.text))
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
         df_batcher = BatchGenerator(200)
         for batch_df in df_batcher(self.df):
-            self.pinecone_index.upsert(vectors=zip(
-                batch_df.vector_id, batch_df.embedding,
-                [{**a, **b} for a, b in zip(
+            if self.metadata_content:
+                metadatas = [pack_content_metadata(t, u, x) for t, u, x in zip(
+                    batch_df.title, batch_df.url, batch_df.text)]
+            else:
+                metadatas = [{**a, **b} for a, b in zip(
                     [{ "title": t } for t in batch_df.title ],
                     [{ "url": u } for u in batch_df.url ])
                 ]
-            ), namespace='content')
+            self.pinecone_index.upsert(vectors=list(zip(
+                batch_df.vector_id, [self.index_vector(e) for e in batch_df.embedding], metadatas
+            )), namespace='content')
             for rownum, row in batch_df.iterrows():
-                c.execute('''
-                INSERT INTO ArticleChunks (unique_id, title, content, url)
-                VALUES (?, ?, ?, ?)
-                ''', (row['vector_id'], row['title'], row['text'], row['url']))
+                if self.compress_content:
+                    c.execute('''
+                    INSERT INTO ArticleChunks (unique_id, title, content_z, url)
+                    VALUES (?, ?, ?, ?)
+                    ''', (row['vector_id'], row['title'], compressor.compress(row['text']), row['url']))
+                else:
+                    c.execute('''
+                    INSERT INTO ArticleChunks (unique_id, title, content, url)
+                    VALUES (?, ?, ?, ?)
+                    ''', (row['vector_id'], row['title'], row['text'], row['url']))
                 if self.debug:
                     print("Inserted row ", rownum, row['vector_id'], row['title'])
         conn.commit()
         conn.close()
+        self.upsert_title_vectors()
+        self.bump_corpus_version()
         if self.debug:
             print("Records inserted successfully.")
 
             # Check index size for each namespace to confirm all of our docs have loaded
             print(self.pinecone_index.describe_index_stats())
 
+    def upsert_title_vectors(self):
+        """
+        Upserts one vector per page to the title namespace, for
+        coarse-to-fine retrieval: the mean of the page's chunk embeddings,
+        which needs no embedding calls and stands for everything on the page
+        rather than just its title. A page's vector is computed from its
+        chunks in this Storer's DataFrame, so each page should be stored in one go.
+        """
+        if self.debug:
+            print("Uploading vectors to title namespace..")
+        column = 'full_embedding' if 'full_embedding' in self.df.columns else 'embedding'
+        pages = []
+        for title, group in self.df.groupby('title', sort=False):
+            vector = np.mean(np.asarray(group[column].tolist(), dtype=np.float32), axis=0)
+            vector /= np.linalg.norm(vector) or 1
+            pages.append((self.title_vector_id(title), self.index_vector(vector.tolist()),
+                {"title": title, "url": group['url'].iloc[0], "chunks": len(group)}))
+        for start in range(0, len(pages), 200):
+            self.pinecone_index.upsert(vectors=pages[start:start + 200], namespace='title')
+
+    @staticmethod
+    def title_vector_id(title: str) -> str:
+        return hashlib.sha256(f"title:{title}".encode('utf-8')).hexdigest()
+
+    def page_filter(self, query_embedding) -> dict:
+        """
+        A metadata filter for the pages whose title vectors are closest to
+        the query, or None if the title namespace is empty (an index
+        populated before it had one).
+        """
+        with stage_timer("title_search"):
+            result = self.pinecone_index.query(
+                namespace='title',
+                vector=self.index_vector(query_embedding),
+                top_k=self.title_top_k,
+                include_metadata=True
+            )
+        titles = [m.metadata['title'] for m in result.matches if m.metadata and 'title' in m.metadata]
+        if not titles:
+            return None
+        return {"title": {"$in": titles}}
+
+    def select_chunks_query(self, where: str) -> str:
+        # Older databases have no content_z column.
+        if self.has_content_z:
+            return f"SELECT unique_id, title, url, content, content_z FROM ArticleChunks WHERE {where}"
+        return f"SELECT unique_id, title, url, content, NULL FROM ArticleChunks WHERE {where}"
+
+    def hydrate_row(self, row):
+        """Turns a selected row into (title, url, content), decompressing if needed."""
+        unique_id, title, url, content, content_z = row
+        if content_z is not None:
+            content = self.get_compressor().decompress(content_z)
+        return (title, url, content)
+
     def get_article_chunk(self, unique_id):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         # SQL query to retrieve the row with the specified unique_id
-        query = "SELECT title, url, content FROM ArticleChunks WHERE unique_id = ?"
+        query = self.select_chunks_query("unique_id = ?")
         try:
             # Execute the query and fetch the row
             cursor.execute(query, (unique_id, ))
@@ -546,7 +1522,7 @@ class Storer:
 
             # Check if a row was found
             if row:
-                return row
+                return self.hydrate_row(row)
             else:
                 print(f"No row found with unique_id = {unique_id}")
                 return ['', '', '']
@@ -554,48 +1530,102 @@ class Storer:
             print(f"An error occurred: {e}")
             return None
 
+    def get_article_chunks(self, unique_ids) -> dict:
+        """
+        Bulk version of get_article_chunk: fetches all of the given chunks in
+        one query and returns a dict mapping each unique_id to (title, url, content).
+        """
+        chunks = {}
+        if len(unique_ids) == 0:
+            return chunks
+        conn = sqlite3.connect(self.db_path)
+        try:
+            placeholders = ", ".join("?" for _ in unique_ids)
+            for row in conn.execute(self.select_chunks_query(f"unique_id IN ({placeholders})"), list(unique_ids)):
+                chunks[row[0]] = self.hydrate_row(row)
+        except sqlite3.Error as e:
+            print(f"An error occurred: {e}")
+        conn.close()
+        return chunks
+
     # search function
     def get_pinecone_matches(
         self,
         query: str,
-        top_n: int = 100
+        top_n: int = 100,
+        query_embedding = None,
+        filter: dict = None
     ) -> tuple[list[str], list[float]]:
-        """Returns a list of strings and relatednesses, sorted from most related to least."""
-        query_embedding_response = self.openai_client.embeddings.create(
-            model=self.embedding_model,
-            input=query,
-        )
-        query_embedding = query_embedding_response.data[0].embedding
-
-        res = self.openai_client.embeddings.create(input=[query], model=self.embedding_model)
-        embedded_query = res.data[0].embedding
+        """
+        Returns a list of strings and relatednesses, sorted from most related
+        to least. A filter, in Pinecone's metadata filter syntax, restricts
+        the chunks searched.
+        """
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        if self.coarse_to_fine:
+            page_filter = self.page_filter(query_embedding)
+            if page_filter is not None:
+                filter = page_filter if filter is None else {"$and": [page_filter, filter]}
 
         # Query namespace passed as parameter using title vector
-        query_result = self.pinecone_index.query(
-            namespace='content',
-            vector=embedded_query,
-            top_k=top_n
-        )
+        with stage_timer("vector_search"):
+            query_result = self.pinecone_index.query(
+                namespace='content',
+                vector=self.index_vector(query_embedding),
+                top_k=top_n * self.rerank_multiplier if self.rerank else top_n,
+                include_metadata=self.metadata_content,
+                # Without rerank, MMR uses the index's own vectors.
+                include_values=self.mmr and not self.rerank,
+                filter=filter
+            )
+
+        if self.debug:
+            print(f'\nMost similar results to {query} in "content" namespace:\n')
+            if not query_result.matches:
+                print('no query result')
 
-        print(f'\nMost similar results to {query} in "content" namespace:\n')
-        if not query_result.matches:
-            print('no query result')
-        
         matches = query_result.matches
+        if self.rerank:
+            with stage_timer("rerank"):
+                vectors = self.get_full_embeddings([m.id for m in matches])
+                matches = rerank_matches(matches, vectors, query_embedding, top_n)
+        if self.mmr:
+            with stage_timer("mmr"):
+                if self.rerank:
+                    matches = mmr_matches(matches, vectors, query_embedding, self.mmr_lambda)
+                else:
+                    matches = mmr_matches(matches, {m.id: m.values for m in matches if m.values},
+                        self.index_vector(query_embedding), self.mmr_lambda)
+        with stage_timer("hydrate"):
+            return self.matches_to_df(matches)
+
+    def matches_to_df(self, matches) -> pd.DataFrame:
+        """
+        Turns Pinecone matches into a DataFrame of ids, scores, titles, urls
+        and content. In metadata_content mode the text comes back with the
+        match; otherwise (or if a match carries no text) it is looked up in
+        the sqlite chunk store, all missing ids in one query.
+        """
         ids = [res.id for res in matches]
         scores = [res.score for res in matches]
         df = pd.DataFrame({'id':ids, 
                            'score':scores,
                            })
-        
-        df['title'], df['url'], df['content'] = zip(*df['id'].apply(lambda x: self.get_article_chunk(x)))
-
-        counter = 0
-        # for k,v in df.iterrows():
-        #     counter += 1
-        #     print(f'{v.title} (score = {v.score})')
-
-        # print('\n')
+        if df.empty:
+            df['title'], df['url'], df['content'] = [], [], []
+            return df
+        rows = {}
+        for res in matches:
+            content = unpack_content_metadata(res.metadata) if self.metadata_content else None
+            if content is not None:
+                rows[res.id] = (res.metadata.get('title', ''), res.metadata.get('url', ''), content)
+        missing = [id for id in ids if id not in rows]
+        rows.update(self.get_article_chunks(missing))
+        for id in missing:
+            if id not in rows:
+                print(f"No row found with unique_id = {id}")
+        df['title'], df['url'], df['content'] = zip(*[rows.get(id, ('', '', '')) for id in ids])
         return df
 
     def query_article(self, query, namespace, top_k=5):
@@ -603,14 +1633,14 @@ class Storer:
          namespace and prints results.'''
 
         # Use the OpenAI client to create vector embeddings based on the title column
-        res = self.openai_client.embeddings.create(input=[query], model=self.embedding_model)
-        embedded_query = res.data[0].embedding
+        embedded_query = self.index_vector(self.embed_query(query))
 
         # Query namespace passed as parameter using title vector
         query_result = self.pinecone_index.query(
             namespace=namespace,
             vector=embedded_query,
-            top_k=top_k
+            top_k=top_k,
+            include_metadata=self.metadata_content
         )
 
         # Print query results 
@@ -619,13 +1649,7 @@ class Storer:
             if not query_result.matches:
                 print('no query result')
         
-        matches = query_result.matches
-        ids = [res.id for res in matches]
-        scores = [res.score for res in matches]
-        df = pd.DataFrame({'id':ids, 
-                           'score':scores
-                           })
-        df['title'], df['url'], df['content'] = zip(*df['id'].apply(lambda x: self.get_article_chunk(x)))
+        df = self.matches_to_df(query_result.matches)
         
         if self.debug:
             counter = 0
@@ -638,6 +1662,492 @@ class Storer:
         return df
 
 
+class LocalIndex:
+    """
+    Brute-force cosine similarity index over a matrix of embeddings, for the
+    CSV-based (non-Pinecone) search paths.
+
+    With quantization=None the normalized float32 matrix is held in memory.
+    With "float16" or "int8" (one scale per vector) only the quantized matrix
+    is held in memory. With dimensions set, the in-memory matrix holds only
+    the first `dimensions` components of each vector (renormalized). Either
+    way the in-memory matrix is searched for a shortlist of
+    rescore_multiplier * top_n candidates, which are then rescored exactly
+    against full-precision vectors memory-mapped from vectors_path.
+    """
+    # Rows widened to float32 at a time when scoring quantized vectors.
+    block_size = 256
+    # Queries scored together by search_many; the scores take len(self) * 4 bytes per query.
+    query_block_size = 64
+
+    def __init__(
+        self,
+        embeddings = None,
+        quantization: str = None,
+        vectors_path: str = None,
+        rescore_multiplier: int = 4,
+        dimensions: int = None
+    ) -> None:
+        if quantization not in (None, "float16", "int8"):
+            raise ValueError(f"Unknown quantization: {quantization}")
+        if (quantization or dimensions) and not vectors_path:
+            raise ValueError("Quantized or reduced-dimension indexes need a vectors_path for exact rescoring.")
+        self.quantization = quantization
+        self.vectors_path = vectors_path
+        self.rescore_multiplier = rescore_multiplier
+        self.dimensions = dimensions
+        if embeddings is not None:
+            vectors = self.normalized(np.asarray(embeddings, dtype=np.float32))
+            if vectors_path:
+                np.save(vectors_path, vectors)
+        else:
+            vectors = np.load(vectors_path, mmap_mode='r')
+        self.build(vectors)
+
+    @staticmethod
+    def normalized(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    @property
+    def rescores(self) -> bool:
+        return bool(self.quantization or self.dimensions)
+
+    def build(self, vectors: np.ndarray):
+        self.scales = None
+        if self.dimensions:
+            vectors = self.normalized(np.asarray(vectors[:, :self.dimensions], dtype=np.float32))
+        if self.quantization is None:
+            self.matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        elif self.quantization == "float16":
+            self.matrix = vectors.astype(np.float16)
+        else:
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self.matrix = np.round(vectors / scales[:, None]).astype(np.int8)
+            self.scales = scales.astype(np.float32)
+        # Full-precision vectors stay on disk and are paged in only for rescoring.
+        self.full = np.load(self.vectors_path, mmap_mode='r') if self.rescores else self.matrix
+
+    def __len__(self) -> int:
+        return self.matrix.shape[0]
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held in memory by the searchable matrix."""
+        return self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def approximate_scores(self, query: np.ndarray) -> np.ndarray:
+        """Scores every row against a query vector, or against each column of a matrix of queries."""
+        if self.quantization is None:
+            return self.matrix @ query
+        # Widen the quantized rows a cache-sized block at a time; NumPy has no
+        # fast float16 or int8 matrix-vector product of its own.
+        scores = np.empty((len(self), ) + query.shape[1:], dtype=np.float32)
+        buffer = np.empty((self.block_size, self.matrix.shape[1]), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            block = self.matrix[start:start + self.block_size]
+            np.copyto(buffer[:len(block)], block)
+            scores[start:start + len(block)] = buffer[:len(block)] @ query
+        if self.scales is not None:
+            scores *= self.scales.reshape((-1, ) + (1, ) * (query.ndim - 1))
+        return scores
+
+    def top_indices(self, scores: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, len(scores))
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        return candidates[np.argsort(-scores[candidates])]
+
+    def search(self, query_embedding, top_n: int = 100) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the row indices and cosine similarities of the top_n closest vectors."""
+        if len(self) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+        query = self.normalized(np.asarray(query_embedding, dtype=np.float32))
+        primary_query = self.normalized(query[:self.dimensions]) if self.dimensions else query
+        scores = np.asarray(self.approximate_scores(primary_query), dtype=np.float32)
+        return self.ranked(scores, query, top_n)
+
+    def ranked(self, scores: np.ndarray, query: np.ndarray, top_n: int) -> tuple[np.ndarray, np.ndarray]:
+        """The top_n rows by approximate scores, rescored exactly against the full vectors if needed."""
+        if not self.rescores:
+            indices = self.top_indices(scores, top_n)
+            return indices, scores[indices]
+        candidates = np.sort(self.top_indices(scores, top_n * self.rescore_multiplier))
+        exact = np.asarray(self.full[candidates], dtype=np.float32) @ query
+        order = np.argsort(-exact)[:top_n]
+        return candidates[order], exact[order]
+
+    def search_many(self, query_embeddings, top_n: int = 100) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Like search, for many queries at once. Each block of query_block_size
+        queries is scored against the whole index in one matrix product.
+        """
+        queries = self.normalized(np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1))
+        if len(self) == 0:
+            return [(np.array([], dtype=np.int64), np.array([], dtype=np.float32)) for _ in queries]
+        primary = self.normalized(queries[:, :self.dimensions]) if self.dimensions else queries
+        results = []
+        for start in range(0, len(queries), self.query_block_size):
+            block = primary[start:start + self.query_block_size]
+            scores = np.asarray(self.approximate_scores(np.ascontiguousarray(block.T)), dtype=np.float32)
+            for i in range(len(block)):
+                results.append(self.ranked(np.ascontiguousarray(scores[:, i]), queries[start + i], top_n))
+        return results
+
+
+class CompletionCache:
+    """
+    A persistent cache of chat completions, keyed by a sha256 hash of the
+    model, messages and other request parameters, for the temperature=0
+    calls that send the same prompt again and again. Entries are kept in a
+    sqlite file shared by every process, expire after ttl seconds, and
+    beyond max_entries the least recently used are evicted.
+    """
+    def __init__(
+        self,
+        db_path: str = None,
+        ttl: float = 7 * 24 * 60 * 60,
+        max_entries: int = 10000,
+        prune_every: int = 100
+    ) -> None:
+        self.db_path = db_path if db_path is not None else os.getenv('SHELLBOT_COMPLETION_CACHE', 'completion_cache.db')
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.local = threading.local()
+        conn = self.connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS Completions (
+                key TEXT PRIMARY KEY,
+                content TEXT,
+                created REAL,
+                last_used REAL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS Completions_last_used ON Completions (last_used)")
+        conn.commit()
+
+    def connection(self):
+        # sqlite connections can't be shared between threads.
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.conn = sqlite3.connect(self.db_path, timeout=30)
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    @staticmethod
+    def key(model, messages, **params) -> str:
+        request = json.dumps({"model": model, "messages": messages, **params}, sort_keys=True)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        conn = self.connection()
+        row = conn.execute("SELECT content, created FROM Completions WHERE key = ?", (key, )).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            self.misses += 1
+            metrics.increment("chatbotter_completion_cache_lookups_total", result="miss")
+            return None
+        conn.execute("UPDATE Completions SET last_used = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+        self.hits += 1
+        metrics.increment("chatbotter_completion_cache_lookups_total", result="hit")
+        return row[0]
+
+    def set(self, key, content):
+        now = time.time()
+        conn = self.connection()
+        conn.execute("INSERT OR REPLACE INTO Completions (key, content, created, last_used) VALUES (?, ?, ?, ?)",
+            (key, content, now, now))
+        conn.commit()
+        self.writes += 1
+        if self.writes % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        """Deletes expired completions, then the least recently used beyond max_entries."""
+        conn = self.connection()
+        conn.execute("DELETE FROM Completions WHERE created < ?", (time.time() - self.ttl, ))
+        conn.execute('''
+            DELETE FROM Completions WHERE key IN (
+                SELECT key FROM Completions ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_entries, ))
+        conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+        }
+
+
+def create_completion(openai_client, model, messages, cache: CompletionCache = None, **params) -> str:
+    """
+    Returns the text of a chat completion, from the cache when the same
+    request has been made before. Only temperature=0 requests are cached,
+    since only those are meant to give the same answer every time.
+    """
+    cacheable = cache is not None and params.get('temperature') == 0
+    if cacheable:
+        key = cache.key(model, messages, **params)
+        content = cache.get(key)
+        if content is not None:
+            return content
+    with stage_timer("completion"):
+        response = openai_client.chat.completions.create(model=model, messages=messages, **params)
+    content = response.choices[0].message.content
+    if cacheable and content is not None:
+        cache.set(key, content)
+    return content
+
+
+async def acreate_completion(async_openai_client, model, messages, cache: CompletionCache = None, **params) -> str:
+    """
+    Async version of create_completion, sharing its cache. The sqlite
+    lookups run in a worker thread so they don't block the event loop.
+    """
+    cacheable = cache is not None and params.get('temperature') == 0
+    if cacheable:
+        key = cache.key(model, messages, **params)
+        content = await asyncio.to_thread(cache.get, key)
+        if content is not None:
+            return content
+    with stage_timer("completion"):
+        response = await async_openai_client.chat.completions.create(model=model, messages=messages, **params)
+    content = response.choices[0].message.content
+    if cacheable and content is not None:
+        await asyncio.to_thread(cache.set, key, content)
+    return content
+
+
+class AnswerCache:
+    """
+    Remembers answers by the embedding of the question they answered, so a
+    rewording of a recent question gets the same answer and references
+    without another completion. A cached answer is used when the new
+    question's cosine similarity to the cached one is at least threshold
+    and it was answered with the same model, against the same corpus
+    version and in the same conversation context (see
+    Asker.answer_context), so an answer shaped by one conversation is not
+    served to another. Entries expire after ttl seconds; beyond max_entries the least
+    recently used are evicted. When the corpus version changes (the data
+    was re-indexed), answers from older versions are dropped.
+    """
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        ttl: float = 24 * 60 * 60,
+        max_entries: int = 1000
+    ) -> None:
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.matrix = None  # one normalized question embedding per slot
+        self.entries = collections.OrderedDict()  # slot -> entry, least recently used first
+        self.corpus_version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def lookup(self, embedding, corpus_version, model, context: str = ""):
+        """Returns the cached (response, references, articles) for a close enough question, or None."""
+        query = LocalIndex.normalized(np.asarray(embedding, dtype=np.float32)[None, :])[0]
+        with self.lock:
+            if corpus_version != self.corpus_version:
+                self.entries.clear()
+                self.corpus_version = corpus_version
+            now = time.time()
+            for slot in [slot for slot, entry in self.entries.items() if now - entry["created"] > self.ttl]:
+                del self.entries[slot]
+            slots = [slot for slot, entry in self.entries.items()
+                if entry["model"] == model and entry["context"] == context]
+            if slots and self.matrix.shape[1] == len(query):
+                scores = self.matrix[slots] @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.entries.move_to_end(slots[best])
+                    self.hits += 1
+                    metrics.increment("chatbotter_answer_cache_lookups_total", result="hit")
+                    return self.entries[slots[best]]["answer"]
+            self.misses += 1
+            metrics.increment("chatbotter_answer_cache_lookups_total", result="miss")
+            return None
+
+    def store(self, embedding, corpus_version, model, answer, context: str = ""):
+        query = LocalIndex.normalized(np.asarray(embedding, dtype=np.float32)[None, :])[0]
+        with self.lock:
+            if self.corpus_version is None:
+                self.corpus_version = corpus_version
+            elif corpus_version != self.corpus_version:
+                return  # answered against data that has since been re-indexed
+            if self.matrix is None or self.matrix.shape[1] != len(query):
+                self.matrix = np.zeros((self.max_entries, len(query)), dtype=np.float32)
+                self.entries.clear()
+            if len(self.entries) >= self.max_entries:
+                slot, _ = self.entries.popitem(last=False)
+            else:
+                slot = next(slot for slot in range(self.max_entries) if slot not in self.entries)
+            self.matrix[slot] = query
+            self.entries[slot] = {"model": model, "context": context, "created": time.time(), "answer": answer}
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else None,
+            }
+
+
+class RetrievalCache:
+    """
+    Remembers each conversation's last retrieval from storage, since
+    consecutive turns usually ask about the same topic. When a new turn's
+    query embedding has cosine similarity of at least reuse_threshold to
+    the one the matches were retrieved for, the matches are used again as
+    they are; at least extend_threshold, only the extend_top_n best matches
+    are searched for and hydrated, and the rest of the earlier matches fill
+    in after them; below that (a change of topic) there is a fresh search.
+    Entries live in the process, expire after ttl seconds, and beyond
+    max_sessions the least recently used are evicted.
+    """
+    def __init__(
+        self,
+        reuse_threshold: float = 0.95,
+        extend_threshold: float = 0.8,
+        extend_top_n: int = 20,
+        ttl: float = 30 * 60,
+        max_sessions: int = 1000
+    ) -> None:
+        self.reuse_threshold = reuse_threshold
+        self.extend_threshold = extend_threshold
+        self.extend_top_n = extend_top_n
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.entries = collections.OrderedDict()  # session id -> entry, least recently used first
+        self.lock = threading.Lock()
+        self.lookups = collections.Counter()
+        self.saved_seconds = 0.0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def matches(self, session_id, embedding, corpus_version, search, top_n: int = 100, scope = None) -> pd.DataFrame:
+        """
+        Returns the session's matches for the query embedding, calling
+        search(n) for the n best matches from storage when they can't all be
+        reused. Matches are only reused for the same scope, such as the
+        metadata filter the search applies. The time saved is estimated
+        from how long the session's last full search took.
+        """
+        query = LocalIndex.normalized(np.asarray(embedding, dtype=np.float32)[None, :])[0]
+        with self.lock:
+            entry = self.entries.get(session_id)
+            if entry is not None and (time.time() - entry["created"] > self.ttl
+                    or entry["corpus_version"] != corpus_version or entry["scope"] != scope
+                    or len(entry["embedding"]) != len(query)):
+                del self.entries[session_id]
+                entry = None
+            similarity = float(entry["embedding"] @ query) if entry is not None else -1.0
+        if similarity >= self.reuse_threshold:
+            self.record("reuse", entry["seconds"])
+            with self.lock:
+                self.entries.move_to_end(session_id)
+            return entry["matches"]
+        start = time.perf_counter()
+        if similarity >= self.extend_threshold:
+            fresh = search(self.extend_top_n)
+            earlier = entry["matches"][~entry["matches"]["id"].isin(fresh["id"])]
+            df = pd.concat([fresh, earlier], ignore_index=True).head(top_n)
+            self.record("extend", entry["seconds"] - (time.perf_counter() - start))
+            return df
+        df = search(top_n)
+        self.record("miss", 0.0)
+        with self.lock:
+            # Later turns are compared with the query of the last full search, so a
+            # conversation that drifts step by step still gets a fresh search eventually.
+            self.entries[session_id] = {"embedding": query, "matches": df, "corpus_version": corpus_version,
+                "scope": scope, "seconds": time.perf_counter() - start, "created": time.time()}
+            self.entries.move_to_end(session_id)
+            while len(self.entries) > self.max_sessions:
+                self.entries.popitem(last=False)
+        return df
+
+    def record(self, result: str, saved: float):
+        saved = max(saved, 0.0)
+        with self.lock:
+            self.lookups[result] += 1
+            self.saved_seconds += saved
+        metrics.increment("chatbotter_retrieval_cache_lookups_total", result=result)
+        metrics.increment("chatbotter_retrieval_cache_saved_seconds_total", saved)
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = sum(self.lookups.values())
+            return {
+                "sessions": len(self.entries),
+                "reused": self.lookups["reuse"],
+                "extended": self.lookups["extend"],
+                "misses": self.lookups["miss"],
+                "hit_rate": (self.lookups["reuse"] + self.lookups["extend"]) / lookups if lookups else None,
+                "saved_seconds": self.saved_seconds,
+            }
+
+
+class ConversationHistory:
+    """
+    A conversation as the Asker sees it: the most recent messages verbatim,
+    plus a rolling summary of the older ones. Asker.remember adds each turn
+    and folds the oldest messages into the summary once the recent ones go
+    over its token budget, so the history stays about the same size however
+    long the conversation runs.
+    """
+    def __init__(self, messages: list[dict] = None, summary: str = "", session_id: str = None) -> None:
+        self.messages = messages if messages is not None else []
+        self.summary = summary
+        # Not saved with the history; SessionStore.get sets it from the key.
+        self.session_id = session_id
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __bool__(self):
+        return bool(self.messages or self.summary)
+
+    def add(self, role: str, content: str):
+        self.messages.append({"role": role, "content": content})
+
+    def transcript(self, messages: list[dict] = None) -> str:
+        """The messages (by default all of the recent ones) as "role: content" lines."""
+        if messages is None:
+            messages = self.messages
+        return "".join(f"{m['role']}: {m['content']}\n" for m in messages)
+
+    def to_dict(self, max_messages: int = None) -> dict:
+        messages = self.messages if max_messages is None else self.messages[-max_messages:]
+        return {"summary": self.summary, "messages": messages}
+
+    @classmethod
+    def from_dict(cls, data) -> "ConversationHistory":
+        # Sessions saved before histories had summaries are plain lists of messages.
+        if isinstance(data, list):
+            return cls(data)
+        return cls(data.get("messages", []), data.get("summary", ""))
+
+
 class Asker:
     def __init__(
         self,
@@ -648,9 +2158,19 @@ class Asker:
         gpt_model: str = "gpt-4o",  # selects which tokenizer to use
         introduction: str = 'Use the below articles from the Global Energy Monitor wiki to answer questions. If the answer cannot be found in the articles, write "I could not find an answer."',
         string_divider: str = 'Global Energy Monitor section:',
+        async_openai_client = None,
+        answer_cache: AnswerCache = None,
+        completion_cache: CompletionCache = None,
+        retrieval_cache: RetrievalCache = None,
+        dedupe_distance: int = 6,
+        condense_model: str = "gpt-4o-mini",
+        history_window_tokens: int = 1000,
+        history_summary_tokens: int = 200,
         debug = False
     ) -> None:
         self.openai_client = openai_client
+        # An openai.AsyncOpenAI client, needed only for aask.
+        self.async_openai_client = async_openai_client
         self.embedding_model = embedding_model
         self.gpt_model = gpt_model
         self.debug = debug
@@ -658,11 +2178,50 @@ class Asker:
         self.string_divider = string_divider
         self.df = df
         self.storage = storage
-
-    def load_embeddings_from_csv(self, embeddings_path):
-        df = pd.read_csv(embeddings_path)
-        # convert embeddings from CSV str type back to list type
-        df['embedding'] = df['embedding'].apply(ast.literal_eval)
+        self.local_index = None
+        self.local_corpus_version = None
+        # Answers are looked up here before retrieval and completion, if set.
+        self.answer_cache = answer_cache
+        # temperature=0 completions are looked up here by an exact hash of the request, if set.
+        self.completion_cache = completion_cache
+        # Each conversation's last matches from storage are reused from here, if set.
+        self.retrieval_cache = retrieval_cache
+        # Chunks whose SimHash fingerprints differ from one already in the
+        # prompt by at most this many of 64 bits are left out (None keeps them).
+        self.dedupe_distance = dedupe_distance
+        self.encoding = None
+        # Follow-up questions are rewritten as standalone questions with this
+        # model, and conversation summaries are written with it.
+        self.condense_model = condense_model
+        # A ConversationHistory keeps this many tokens of recent messages
+        # verbatim, and a summary of at most history_summary_tokens.
+        self.history_window_tokens = history_window_tokens
+        self.history_summary_tokens = history_summary_tokens
+        # Time to first token of recent ask_stream calls, in seconds.
+        self.ttft_samples = collections.deque(maxlen=1000)
+
+    def load_embeddings_from_csv(self, embeddings_path, quantization = None, dimensions = None):
+        """
+        Loads texts and embeddings from a CSV file and builds a LocalIndex over
+        them. With quantization ("float16" or "int8") or reduced dimensions the
+        embeddings are not kept in the DataFrame; full-precision vectors are
+        cached next to the CSV in a .npy file, which later loads skip re-parsing.
+        """
+        reduced = quantization or dimensions
+        vectors_path = embeddings_path + ".f32.npy" if reduced else None
+        if (vectors_path and os.path.exists(vectors_path)
+                and os.path.getmtime(vectors_path) >= os.path.getmtime(embeddings_path)):
+            df = pd.read_csv(embeddings_path, usecols=['text'])
+            self.local_index = LocalIndex(quantization=quantization, vectors_path=vectors_path, dimensions=dimensions)
+        else:
+            df = pd.read_csv(embeddings_path)
+            # convert embeddings from CSV str type back to list type
+            df['embedding'] = df['embedding'].apply(ast.literal_eval)
+            self.local_index = LocalIndex(df['embedding'].tolist(), quantization=quantization,
+                vectors_path=vectors_path, dimensions=dimensions)
+            if reduced:
+                df = df.drop(columns=['embedding'])
+        self.local_corpus_version = f"{embeddings_path}:{os.path.getmtime(embeddings_path)}"
         # the dataframe has two columns: "text" and "embedding"
         if self.debug:
             print(df)
@@ -678,120 +2237,784 @@ class Asker:
         #     print(string)
         self,
         query: str,
-        relatedness_fn=lambda x, y: 1 - spatial.distance.cosine(x, y),
-        top_n: int = 100
+        relatedness_fn=cosine_similarity,
+        top_n: int = 100,
+        query_embedding = None
     ) -> tuple[list[str], list[float]]:
         """Returns a list of strings and relatednesses, sorted from most related to least."""
-        query_embedding_response = self.openai_client.embeddings.create(
-            model=self.embedding_model,
-            input=query,
-        )
-        query_embedding = query_embedding_response.data[0].embedding
-        strings_and_relatednesses = [
-            (row["text"], relatedness_fn(query_embedding, row["embedding"]))
-            for i, row in self.df.iterrows()
-        ]
-        strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        if self.local_index is not None:
+            with stage_timer("vector_search"):
+                indices, relatednesses = self.local_index.search(query_embedding, top_n=top_n)
+                strings = self.df['text'].to_numpy()[indices]
+            return tuple(strings), tuple(relatednesses.tolist())
+        with stage_timer("vector_search"):
+            strings_and_relatednesses = [
+                (row["text"], relatedness_fn(query_embedding, row["embedding"]))
+                for i, row in self.df.iterrows()
+            ]
+            strings_and_relatednesses.sort(key=lambda x: x[1], reverse=True)
         strings, relatednesses = zip(*strings_and_relatednesses)
         return strings[:top_n], relatednesses[:top_n]
 
+    def embed_query(self, query: str) -> list[float]:
+        if self.storage:
+            return self.storage.embed_query(query)
+        with stage_timer("embed"):
+            query_embedding_response = self.openai_client.embeddings.create(
+                model=self.embedding_model,
+                input=query,
+            )
+        return query_embedding_response.data[0].embedding
+
+    async def aembed_query(self, query: str) -> list[float]:
+        if self.storage:
+            model, extra_args = self.storage.embedding_model, self.storage.embedding_args()
+        else:
+            model, extra_args = self.embedding_model, {}
+        with stage_timer("embed"):
+            response = await self.async_openai_client.embeddings.create(model=model, input=[query], **extra_args)
+        return response.data[0].embedding
+
+    def embed_queries(self, queries: list[str], batch_size: int = 1000) -> list[list[float]]:
+        """Embeds many queries with one embeddings request per batch_size queries."""
+        if self.storage:
+            model, extra_args = self.storage.embedding_model, self.storage.embedding_args()
+        else:
+            model, extra_args = self.embedding_model, {}
+        embeddings = []
+        for start in range(0, len(queries), batch_size):
+            with stage_timer("embed"):
+                response = self.openai_client.embeddings.create(
+                    model=model, input=queries[start:start + batch_size], **extra_args)
+            embeddings.extend(e.embedding for e in sorted(response.data, key=lambda e: e.index))
+        return embeddings
+
     def num_tokens(self, text: str) -> int:
         """Return the number of tokens in a string."""
-        encoding = tiktoken.encoding_for_model(self.gpt_model)
-        return len(encoding.encode(text))
+        if self.encoding is None:
+            self.encoding = tiktoken.encoding_for_model(self.gpt_model)
+        return len(self.encoding.encode(text))
 
     def query_message(
         self,
         query: str,
         token_budget: int,
-        storage = None
+        storage = None,
+        query_embedding = None,
+        session_id = None
     ) -> str:
-        """Return a message for GPT, with relevant source texts pulled from a dataframe."""
+        """
+        Return a message for GPT, with relevant source texts pulled from a
+        dataframe. Given a session id and a retrieval cache, matches from
+        storage may be reused from the conversation's previous turn.
+        """
         articles = {}
         if self.storage:
-            df = self.storage.get_pinecone_matches(query)
-            question = f"\n\nQuestion: {query}"
-            message = self.introduction
-            for k,v in df.iterrows():
-                string = v.content
-                title = v.title
-                url = v.url
-                articles[title] = url
-                next_article = f'\n\n{self.string_divider}\n"""\n{string}\n"""'
-                if (
-                    self.num_tokens(message + next_article + question)
-                    > token_budget
-                ):
-                    break
-                else:
-                    message += next_article
-        else:
-            strings, relatednesses = self.strings_ranked_by_relatedness(query)
-            question = f"\n\nQuestion: {query}"
-            message = self.introduction
-            for string in strings:
+            df = self.storage_matches(query, query_embedding, session_id)
+            return self.pack_message(query, zip(df.content, df.title, df.url), token_budget, articles), articles
+        strings, relatednesses = self.strings_ranked_by_relatedness(query, query_embedding=query_embedding)
+        return self.message_from_strings(query, strings, token_budget), articles
+
+    def storage_matches(self, query: str, query_embedding = None, session_id = None) -> pd.DataFrame:
+        if self.retrieval_cache is None or session_id is None:
+            return self.storage.get_pinecone_matches(query, query_embedding=query_embedding)
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        # A question about another platform or year needs another search, however similar it reads.
+        scope = self.storage.extract_filter(query) if getattr(self.storage, 'auto_filter', False) else None
+        return self.retrieval_cache.matches(session_id, query_embedding, self.corpus_version(),
+            lambda top_n: self.storage.get_pinecone_matches(query, top_n=top_n, query_embedding=query_embedding),
+            scope=scope)
+
+    def message_from_strings(self, query: str, strings, token_budget: int) -> str:
+        """Fits as many of the ranked strings as the token budget allows into a message for GPT."""
+        return self.pack_message(query, ((string, None, None) for string in strings), token_budget)
+
+    def pack_message(self, query: str, chunks, token_budget: int, articles: dict = None) -> str:
+        """
+        Fits as many of the ranked (text, title, url) chunks as the token
+        budget allows into a message for GPT, adding the title and url of
+        each one used to articles. With dedupe_distance set, a chunk whose
+        SimHash is within that many bits of one already in the message is
+        left out before it is tokenized, and only its reference is kept.
+        Each chunk is tokenized once and the counts are added up, rather than
+        tokenizing the whole message again for every chunk.
+        """
+        question = f"\n\nQuestion: {query}"
+        message = self.introduction
+        fingerprints = []
+        with stage_timer("build_prompt"):
+            tokens = self.num_tokens(message) + self.num_tokens(question)
+            for string, title, url in chunks:
+                if self.dedupe_distance is not None:
+                    fingerprint = simhash(string)
+                    if any(hamming_distance(fingerprint, kept) <= self.dedupe_distance for kept in fingerprints):
+                        metrics.increment("chatbotter_near_duplicate_chunks_total")
+                        if articles is not None:
+                            articles[title] = url
+                        continue
                 next_article = f'\n\n{self.string_divider}\n"""\n{string}\n"""'
-                if (
-                    self.num_tokens(message + next_article + question)
-                    > token_budget
-                ):
+                next_tokens = self.num_tokens(next_article)
+                if tokens + next_tokens > token_budget:
                     break
-                else:
-                    message += next_article
-        return message + question, articles
-
-    def add_to_history(self, conversation_history, role, content):
-        conversation_history.append({"role": role, "content": content})
-
-    def build_contextual_input(self, conversation_history, user_query):
-        # Concatenate previous messages and the current query
+                message += next_article
+                tokens += next_tokens
+                if articles is not None:
+                    articles[title] = url
+                if self.dedupe_distance is not None:
+                    fingerprints.append(fingerprint)
+        return message + question
+
+    def standalone_query(self, query: str, conversation_history: ConversationHistory = None) -> str:
+        """
+        Rewrites a follow-up question as one that can be understood without
+        the conversation, for retrieval and for the prompt. Returns the query
+        unchanged when there is no conversation yet.
+        """
+        if not conversation_history:
+            return query
         context = ""
-        for message in conversation_history[-10:]:  # Use the last 10 messages for context
-            context += f"{message['role']}: {message['content']}\n"
-        context += f"user: {user_query}\n"
-        return context
+        if conversation_history.summary:
+            context += f"Summary of the earlier conversation:\n{conversation_history.summary}\n\n"
+        context += f"Recent messages:\n{conversation_history.transcript()}\nFollow-up question: {query}"
+        messages = [
+            {"role": "system", "content": "Rewrite the follow-up question as a standalone question that can be understood without the conversation. Keep the names and details it refers to. Reply with the question only."},
+            {"role": "user", "content": context},
+        ]
+        with stage_timer("condense"):
+            standalone = create_completion(
+                self.openai_client,
+                self.condense_model,
+                messages,
+                cache=self.completion_cache,
+                temperature=0,
+                max_tokens=100
+            )
+        return standalone.strip() if standalone else query
+
+    def chat_messages(self, message: str, conversation_history: ConversationHistory = None) -> list[dict]:
+        """
+        The messages for the answering completion: the introduction, the
+        conversation so far (its summary and the recent messages, which
+        remember keeps within history_window_tokens) as earlier turns, and
+        the packed prompt from query_message.
+        """
+        messages = [{"role": "system", "content": self.introduction}]
+        if conversation_history:
+            if conversation_history.summary:
+                messages.append({"role": "system",
+                    "content": f"Summary of the earlier conversation:\n{conversation_history.summary}"})
+            messages.extend({"role": m["role"], "content": m["content"]} for m in conversation_history.messages)
+        messages.append({"role": "user", "content": message})
+        return messages
+
+    def remember(self, conversation_history: ConversationHistory, query: str, answer: str):
+        """
+        Adds a question and its answer to the conversation history. Once the
+        recent messages go over history_window_tokens, the oldest are folded
+        into the summary until they are back under half of it, so the
+        summary is rewritten every few turns rather than every turn.
+        """
+        conversation_history.add("user", query)
+        conversation_history.add("assistant", answer)
+        tokens = [self.num_tokens(m["content"]) for m in conversation_history.messages]
+        if sum(tokens) <= self.history_window_tokens:
+            return
+        folded = 0
+        # The latest question and answer always stay verbatim.
+        while folded < len(tokens) - 2 and sum(tokens[folded:]) > self.history_window_tokens // 2:
+            folded += 1
+        if folded == 0:
+            return  # only the latest question and answer, which are over budget on their own
+        old_messages = conversation_history.messages[:folded]
+        messages = [
+            {"role": "system", "content": f"You keep a running summary of a conversation. Update the summary with the new messages, keeping the names, facts and open questions that later messages may refer to. Use at most {self.history_summary_tokens * 3 // 4} words."},
+            {"role": "user", "content": f"Summary so far:\n{conversation_history.summary or '(none)'}\n\nNew messages:\n{conversation_history.transcript(old_messages)}"},
+        ]
+        with stage_timer("summarize"):
+            summary = create_completion(
+                self.openai_client,
+                self.condense_model,
+                messages,
+                cache=self.completion_cache,
+                temperature=0,
+                max_tokens=self.history_summary_tokens
+            )
+        conversation_history.summary = (summary or conversation_history.summary).strip()
+        del conversation_history.messages[:folded]
 
+    @timed("ask")
     def ask(
         self,
         query,
         model = None,
-        conversation_history = [],
+        conversation_history: ConversationHistory = None,
         token_budget: int = 4096 - 500
     ):
-        """Answers a query using GPT and a dataframe of relevant texts and embeddings."""
+        """
+        Answers a query using GPT and a dataframe of relevant texts and
+        embeddings. Given a ConversationHistory, a follow-up question is
+        first rewritten as a standalone one, and the question and answer are
+        added to the history.
+        """
         if not model:
             model = self.gpt_model
-        if len(conversation_history) > 0:
-            self.add_to_history(conversation_history, "user", query)
-            for m in conversation_history:
-                print(m)
-            contextual_input = self.build_contextual_input(conversation_history, query)
-            message, articles = self.query_message(contextual_input, token_budget=token_budget)
-            if message == "I could not find an answer.":
-                return self.ask(query, model, [], token_budget)
-        else:
-            message, articles = self.query_message(query, token_budget=token_budget)
+        retrieval_query = self.standalone_query(query, conversation_history)
+        context = self.answer_context(conversation_history)
+        cached, query_embedding = self.cached_answer(retrieval_query, model, context)
+        if cached:
+            if conversation_history is not None:
+                self.remember(conversation_history, query, cached[0])
+            return cached
+        message, articles = self.query_message(retrieval_query, token_budget=token_budget,
+            query_embedding=query_embedding, session_id=getattr(conversation_history, 'session_id', None))
         if self.debug:
             print(message)
-        messages = [
-            {"role": "system", "content": self.introduction},
-            {"role": "user", "content": message},
-        ]
+        messages = self.chat_messages(message, conversation_history)
 
-        response = self.openai_client.chat.completions.create(
-            model=model,
-            messages=messages,
+        response_message = create_completion(
+            self.openai_client,
+            model,
+            messages,
+            cache=self.completion_cache,
             temperature=0
         )
-        response_message = response.choices[0].message.content
 
+        # print(response_message)
+        answer = (response_message, self.format_references(articles), articles)
+        self.cache_answer(query_embedding, model, answer, context)
+        if conversation_history is not None:
+            self.remember(conversation_history, query, response_message)
+        return answer
+
+    def ask_many(
+        self,
+        queries: list[str],
+        concurrency: int = 8,
+        model = None,
+        token_budget: int = 4096 - 500
+    ):
+        """
+        Answers a list of independent questions, yielding (position, answer)
+        pairs in the order the answers complete, where answer is what ask
+        would return for queries[position].
+
+        Repeated questions are answered once. All of the questions are
+        embedded up front in batched requests and, with a local index,
+        ranked with one matrix product per block of questions; retrieval
+        from storage and the completions then run on up to concurrency threads.
+        """
+        if not model:
+            model = self.gpt_model
+        positions = collections.defaultdict(list)
+        for position, query in enumerate(queries):
+            positions[query].append(position)
+        distinct = list(positions)
+        embeddings = self.embed_queries(distinct)
+
+        pending = []
+        for query, query_embedding in zip(distinct, embeddings):
+            if self.answer_cache is not None:
+                with stage_timer("answer_cache"):
+                    cached = self.answer_cache.lookup(query_embedding, self.corpus_version(), model)
+                if cached:
+                    for position in positions[query]:
+                        yield position, cached
+                    continue
+            pending.append((query, query_embedding))
+
+        ranked_strings = {}
+        if not self.storage and self.local_index is not None and pending:
+            with stage_timer("vector_search"):
+                ranked = self.local_index.search_many([e for q, e in pending])
+            texts = self.df['text'].to_numpy()
+            for (query, query_embedding), (indices, relatednesses) in zip(pending, ranked):
+                ranked_strings[query] = texts[indices]
+
+        def answer(query, query_embedding):
+            if query in ranked_strings:
+                message, articles = self.message_from_strings(query, ranked_strings[query], token_budget), {}
+            else:
+                message, articles = self.query_message(query, token_budget=token_budget, query_embedding=query_embedding)
+            response_message = create_completion(
+                self.openai_client,
+                model,
+                [
+                    {"role": "system", "content": self.introduction},
+                    {"role": "user", "content": message},
+                ],
+                cache=self.completion_cache,
+                temperature=0
+            )
+            result = (response_message, self.format_references(articles), articles)
+            self.cache_answer(query_embedding, model, result)
+            return result
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            futures = {executor.submit(answer, query, query_embedding): query for query, query_embedding in pending}
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                for position in positions[futures[future]]:
+                    yield position, result
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def corpus_version(self):
+        """Identifies the indexed data that answers come from; changes when it is re-indexed."""
+        if self.storage:
+            return self.storage.corpus_version()
+        return self.local_corpus_version
+
+    @staticmethod
+    def answer_context(conversation_history: ConversationHistory = None) -> str:
+        """
+        Identifies the conversation that chat_messages sends along with a
+        question: a hash of its summary and recent messages, or "" when
+        there is none yet. Answers are only reused within the same context.
+        """
+        if not conversation_history:
+            return ""
+        context = json.dumps([conversation_history.summary, conversation_history.messages], sort_keys=True)
+        return hashlib.sha256(context.encode('utf-8')).hexdigest()
+
+    def cached_answer(self, retrieval_query, model, context: str = ""):
+        """
+        Embeds the retrieval query and looks it up in the answer cache.
+        Returns (answer or None, embedding), or (None, None) without a cache.
+        """
+        if self.answer_cache is None:
+            return None, None
+        query_embedding = self.embed_query(retrieval_query)
+        with stage_timer("answer_cache"):
+            return self.answer_cache.lookup(query_embedding, self.corpus_version(), model, context), query_embedding
+
+    def cache_answer(self, query_embedding, model, answer, context: str = ""):
+        # Unanswered questions are left out, since callers retry those differently.
+        if self.answer_cache is None or query_embedding is None:
+            return
+        if answer[0].strip() == "I could not find an answer.":
+            return
+        self.answer_cache.store(query_embedding, self.corpus_version(), model, answer, context)
+
+    def ask_stream(
+        self,
+        query,
+        model = None,
+        conversation_history: ConversationHistory = None,
+        token_budget: int = 4096 - 500
+    ):
+        """
+        Streaming version of ask. Yields {"type": "delta", "content": ...}
+        events as completion tokens arrive, then one {"type": "done", ...}
+        event with the full response, the references, the articles and the
+        time to first token in seconds. The question and answer are added to
+        the conversation history after the "done" event, so summarizing it
+        doesn't hold up the answer.
+        """
+        start = time.perf_counter()
+        if not model:
+            model = self.gpt_model
+        retrieval_query = self.standalone_query(query, conversation_history)
+        context = self.answer_context(conversation_history)
+        cached, query_embedding = self.cached_answer(retrieval_query, model, context)
+        if cached:
+            response_message, references, articles = cached
+            ttft = time.perf_counter() - start
+            self.record_ttft(ttft)
+            yield {"type": "delta", "content": response_message}
+            yield {"type": "done", "response": response_message, "references": references,
+                "articles": articles, "ttft": ttft}
+            if conversation_history is not None:
+                self.remember(conversation_history, query, response_message)
+            return
+        message, articles = self.query_message(retrieval_query, token_budget=token_budget,
+            query_embedding=query_embedding, session_id=getattr(conversation_history, 'session_id', None))
+        if self.debug:
+            print(message)
+        messages = self.chat_messages(message, conversation_history)
+        completion_start = time.perf_counter()
+        stream = self.openai_client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=0,
+            stream=True
+        )
+        ttft = None
+        pieces = []
+        for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if ttft is None:
+                ttft = time.perf_counter() - start
+                self.record_ttft(ttft)
+            pieces.append(chunk.choices[0].delta.content)
+            yield {"type": "delta", "content": chunk.choices[0].delta.content}
+        metrics.observe("chatbotter_stage_seconds", time.perf_counter() - completion_start, stage="completion")
+        answer = ("".join(pieces), self.format_references(articles), articles)
+        self.cache_answer(query_embedding, model, answer, context)
+        yield {
+            "type": "done",
+            "response": answer[0],
+            "references": answer[1],
+            "articles": articles,
+            "ttft": ttft
+        }
+        if conversation_history is not None:
+            self.remember(conversation_history, query, answer[0])
+
+    def record_ttft(self, ttft: float):
+        # Kept for /stream_stats and observed for /metrics, so the two agree.
+        self.ttft_samples.append(ttft)
+        metrics.observe("chatbotter_ttft_seconds", ttft)
+
+    def ttft_summary(self) -> dict:
+        """Count, p50 and p95 of recent ask_stream times to first token, in seconds."""
+        samples = sorted(self.ttft_samples)
+        if not samples:
+            return {"count": 0, "p50": None, "p95": None}
+        return {
+            "count": len(samples),
+            "p50": samples[len(samples) // 2],
+            "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        }
+
+    def format_references(self, articles) -> str:
         references = "<p><b>For more information:</b></p><ul>"
         for title, url in articles.items():
             references += "<li><a href=\"" + url  + "\">" + title + "</a></li>"
         references += "</ul>"
+        return references
+
+    @timed("ask")
+    async def aask(
+        self,
+        query,
+        model = None,
+        conversation_history: ConversationHistory = None,
+        token_budget: int = 4096 - 500
+    ):
+        """
+        Async version of ask, for ASGI servers. The embedding and completion
+        calls go through async_openai_client; retrieval and prompt packing use
+        blocking clients (Pinecone, sqlite, psycopg2, tiktoken) and run in a
+        worker thread, so the event loop keeps serving other conversations.
+        So do rewriting a follow-up question and summarizing the
+        conversation history, which may use the completion cache.
+        """
+        if not model:
+            model = self.gpt_model
+        retrieval_query = await asyncio.to_thread(self.standalone_query, query, conversation_history)
+        query_embedding = await self.aembed_query(retrieval_query)
+        context = self.answer_context(conversation_history)
+        if self.answer_cache is not None:
+            cached = self.answer_cache.lookup(query_embedding, await asyncio.to_thread(self.corpus_version), model, context)
+            if cached:
+                if conversation_history is not None:
+                    await asyncio.to_thread(self.remember, conversation_history, query, cached[0])
+                return cached
+        message, articles = await asyncio.to_thread(
+            self.query_message, retrieval_query, token_budget, query_embedding=query_embedding,
+            session_id=getattr(conversation_history, 'session_id', None))
+        if self.debug:
+            print(message)
+        messages = self.chat_messages(message, conversation_history)
+        response_message = await acreate_completion(
+            self.async_openai_client,
+            model,
+            messages,
+            cache=self.completion_cache,
+            temperature=0
+        )
+        answer = (response_message, self.format_references(articles), articles)
+        await asyncio.to_thread(self.cache_answer, query_embedding, model, answer, context)
+        if conversation_history is not None:
+            await asyncio.to_thread(self.remember, conversation_history, query, response_message)
+        return answer
+
+
+class ConnectionPool:
+    """
+    A thread-safe pool of psycopg2 connections, so a chat turn reuses an
+    open connection instead of paying for TCP, TLS and authentication on
+    every query. Connections idle for longer than health_check_after
+    seconds are checked with SELECT 1 before being handed out, and
+    connections older than max_lifetime seconds are closed and replaced.
+    When all size connections are in use, callers wait up to timeout
+    seconds for one to come back.
+
+    The size, lifetime and timeout default to the SHELLBOT_DB_POOL_SIZE,
+    SHELLBOT_DB_POOL_MAX_LIFETIME and SHELLBOT_DB_POOL_TIMEOUT environment
+    variables. Each gunicorn worker is its own process with its own pool, so
+    the database sees up to workers * size connections.
+    """
+    def __init__(
+        self,
+        size: int = None,
+        max_lifetime: float = None,
+        timeout: float = None,
+        health_check_after: float = 30,
+        **connect_args
+    ) -> None:
+        self.size = size if size is not None else int(os.getenv('SHELLBOT_DB_POOL_SIZE', 5))
+        self.max_lifetime = max_lifetime if max_lifetime is not None else float(os.getenv('SHELLBOT_DB_POOL_MAX_LIFETIME', 1800))
+        self.timeout = timeout if timeout is not None else float(os.getenv('SHELLBOT_DB_POOL_TIMEOUT', 30))
+        self.health_check_after = health_check_after
+        self.connect_args = connect_args
+        self.idle = []  # (connection, opened at, returned at), most recently returned last
+        self.opened = {}  # id(connection) -> time it was opened
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.stats = {
+            "checkouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "timeouts": 0,
+            "connections_opened": 0,
+            "connections_recycled": 0,
+            "health_check_failures": 0,
+        }
+
+    def connect(self):
+        conn = psycopg2.connect(**self.connect_args)
+        with self.lock:
+            self.opened[id(conn)] = time.monotonic()
+            self.stats["connections_opened"] += 1
+        return conn
+
+    def discard(self, conn, reason = None):
+        with self.lock:
+            self.opened.pop(id(conn), None)
+            if reason:
+                self.stats[reason] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def healthy(self, conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            self.discard(conn, "health_check_failures")
+            return False
+
+    def getconn(self):
+        """Checks out a raw connection; give it back with putconn."""
+        start = time.perf_counter()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.stats["timeouts"] += 1
+            raise psycopg2.pool.PoolError(f"No database connection became free within {self.timeout} seconds")
+        waited = time.perf_counter() - start
+        try:
+            while True:
+                with self.lock:
+                    entry = self.idle.pop() if self.idle else None
+                if entry is None:
+                    conn = self.connect()
+                    break
+                conn, opened, returned = entry
+                now = time.monotonic()
+                if conn.closed or now - opened > self.max_lifetime:
+                    self.discard(conn, "connections_recycled")
+                elif now - returned <= self.health_check_after or self.healthy(conn):
+                    break
+        except Exception:
+            self.slots.release()
+            raise
+        metrics.observe("chatbotter_db_pool_wait_seconds", waited)
+        with self.lock:
+            self.stats["checkouts"] += 1
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+        return conn
+
+    def putconn(self, conn):
+        """Returns a connection, rolling back anything left uncommitted."""
+        try:
+            if not conn.closed:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+        if conn.closed:
+            self.discard(conn)
+        else:
+            with self.lock:
+                self.idle.append((conn, self.opened.get(id(conn), time.monotonic()), time.monotonic()))
+        self.slots.release()
+
+    def connection(self):
+        """Checks out a connection wrapped so that close() returns it to the pool."""
+        return PooledConnection(self, self.getconn())
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                **self.stats,
+                "size": self.size,
+                "open": len(self.opened),
+                "idle": len(self.idle),
+            }
+
+    def closeall(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn, opened, returned in idle:
+            self.discard(conn)
+
+
+class PooledConnection:
+    """
+    A pooled psycopg2 connection that goes back to its pool on close(), so
+    code written against plain connections can use the pool unchanged.
+    """
+    def __init__(self, pool: ConnectionPool, conn) -> None:
+        self.pool = pool
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def close(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            self.pool.putconn(conn)
+
+    def __del__(self):
+        # Returns connections that were dropped without close() on an error path.
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+shared_pools = {}
+shared_pools_lock = threading.Lock()
+
+
+def shared_pool(**connect_args) -> ConnectionPool:
+    """
+    Returns the process-wide ConnectionPool for these connection arguments,
+    creating it on first use. Pools are per process, so a worker forked from
+    a preloading parent opens its own connections.
+    """
+    key = (os.getpid(), tuple(sorted((k, str(v)) for k, v in connect_args.items())))
+    with shared_pools_lock:
+        if key not in shared_pools:
+            shared_pools[key] = ConnectionPool(**connect_args)
+        return shared_pools[key]
+
+
+def pool_metrics() -> dict:
+    """Metrics of this process's shared pools, keyed by database name."""
+    with shared_pools_lock:
+        pools = [(key, pool) for key, pool in shared_pools.items() if key[0] == os.getpid()]
+    return {pool.connect_args.get('dbname'): pool.metrics() for key, pool in pools}
+
+
+def pool_gauges():
+    """The shared pools' metrics as (name, labels, value) gauges for the metrics registry."""
+    return [
+        (f"chatbotter_db_pool_{name}", {"database": database}, value)
+        for database, values in pool_metrics().items()
+        for name, value in values.items()
+    ]
 
-        # print(response_message)
-        return response_message, references, articles
+
+metrics.register_collector(pool_gauges)
+
+
+class SessionStore:
+    """
+    ConversationHistory objects keyed by session id, kept in a sqlite file
+    so that every worker process on the host sees the same sessions and they
+    survive restarts. Each history keeps its summary and at most its last
+    max_messages messages; sessions unused for ttl seconds expire, and
+    beyond max_sessions the least recently used are evicted.
+    """
+    def __init__(
+        self,
+        db_path: str = None,
+        max_messages: int = 40,
+        ttl: float = 24 * 60 * 60,
+        max_sessions: int = 10000,
+        prune_every: int = 100
+    ) -> None:
+        self.db_path = db_path if db_path is not None else os.getenv('SHELLBOT_SESSION_DB', 'shellbot_sessions.db')
+        self.max_messages = max_messages
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.prune_every = prune_every
+        self.writes = 0
+        self.encoder = msgspec.msgpack.Encoder()
+        self.decoder = msgspec.msgpack.Decoder()
+        self.local = threading.local()
+        conn = self.connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS Sessions (
+                session_id TEXT PRIMARY KEY,
+                history BLOB,
+                last_used REAL
+            )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS Sessions_last_used ON Sessions (last_used)")
+        conn.commit()
+
+    def connection(self):
+        # sqlite connections can't be shared between threads.
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.conn = sqlite3.connect(self.db_path, timeout=30)
+            self.local.pid = os.getpid()
+        return self.local.conn
+
+    def get(self, session_id):
+        """Returns the session's history, or None if there is no such session or it has expired."""
+        if not session_id:
+            return None
+        conn = self.connection()
+        row = conn.execute("SELECT history, last_used FROM Sessions WHERE session_id = ?", (session_id, )).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        conn.execute("UPDATE Sessions SET last_used = ? WHERE session_id = ?", (time.time(), session_id))
+        conn.commit()
+        history = ConversationHistory.from_dict(self.decoder.decode(row[0]))
+        history.session_id = session_id
+        return history
+
+    def save(self, session_id, history: ConversationHistory):
+        conn = self.connection()
+        conn.execute("INSERT OR REPLACE INTO Sessions (session_id, history, last_used) VALUES (?, ?, ?)",
+            (session_id, self.encoder.encode(history.to_dict(self.max_messages)), time.time()))
+        conn.commit()
+        self.writes += 1
+        if self.writes % self.prune_every == 0:
+            self.prune()
+
+    def delete(self, session_id):
+        conn = self.connection()
+        conn.execute("DELETE FROM Sessions WHERE session_id = ?", (session_id, ))
+        conn.commit()
+
+    def prune(self):
+        """Deletes expired sessions, then the least recently used beyond max_sessions."""
+        conn = self.connection()
+        conn.execute("DELETE FROM Sessions WHERE last_used < ?", (time.time() - self.ttl, ))
+        conn.execute('''
+            DELETE FROM Sessions WHERE session_id IN (
+                SELECT session_id FROM Sessions ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        ''', (self.max_sessions, ))
+        conn.commit()
+
+    def __len__(self):
+        return self.connection().execute("SELECT COUNT(*) FROM Sessions").fetchone()[0]
 
 
 class ConversationLogger:
@@ -806,6 +3029,11 @@ class ConversationLogger:
         logs_user = None,
         logs_password = None,
         overwrite_db = False,
+        write_behind = False,
+        queue_size: int = 10000,
+        flush_entries: int = 100,
+        flush_interval_ms: int = 500,
+        spool_path: str = "conversation_log_spool.jsonl",
         debug = False
 
     ) -> None:
@@ -817,18 +3045,41 @@ class ConversationLogger:
         self.logs_user = logs_user if logs_user is not None else os.getenv('SHELLBOT_USER')
         self.logs_password = logs_password if logs_password is not None else os.getenv('SHELLBOT_USER_PASSWORD')
         self.overwrite_db = overwrite_db
+        # With write_behind, post_entry only queues the entry, and a background
+        # thread inserts queued entries in batches of up to flush_entries, at
+        # least every flush_interval_ms. Entries that can't be written (Postgres
+        # down, or the queue full) go to the spool file, which is replayed once
+        # a write succeeds again. The spool file is shared by every worker
+        # process, and is locked with flock while it is written or replayed.
+        self.write_behind = write_behind
+        self.queue_size = queue_size
+        self.flush_entries = flush_entries
+        self.flush_interval_ms = flush_interval_ms
+        self.spool_path = spool_path
+        self.spool_lock = threading.Lock()
+        self.queue = None
+        self.writer = None
+        self.writer_pid = None
+        self.writer_lock = threading.Lock()
+        self.stats = {"queued": 0, "written": 0, "spooled": 0, "replayed": 0, "flushes": 0}
         self.debug = debug
-        self.setup_database()
+        # The entries table is created on first use rather than here, so
+        # constructing a logger doesn't touch the database.
+        self.database_ready = False
+        self.setup_lock = threading.Lock()
+        if self.write_behind:
+            atexit.register(self.close)
 
     def database_connection(self):
-        conn = psycopg2.connect(
+        # conn.close() hands the connection back to the shared pool.
+        conn = shared_pool(
             dbname=self.logs_database_name,
             user=self.logs_user,
             password=self.logs_password,
             host=self.db_host,
             port=self.db_port,
             sslmode='allow'
-        )
+        ).connection()
         cur = conn.cursor()
         return conn, cur
 
@@ -853,34 +3104,194 @@ class ConversationLogger:
         );
         """
         self.create_table('entries', create_table_query)
-
-    def post_entry(self, entry):
+        self.database_ready = True
+
+    def ensure_database(self):
+        if not self.database_ready:
+            with self.setup_lock:
+                if not self.database_ready:
+                    self.setup_database()
+
+    @timed("log_insert")
+    def insert_entries(self, entries):
+        """Inserts entries into the entries table in a single statement."""
+        self.ensure_database()
         conn, cur = self.database_connection()
-
-        # SQL query to insert the data
-        insert_query = """
+        psycopg2.extras.execute_values(cur, """
         INSERT INTO entries (session_id, entry_timestamp, user_input, bot_response)
-        VALUES (%s, %s, %s, %s);
-        """
-
-        # Execute the query with the data
-        cur.execute(insert_query, (
+        VALUES %s
+        """, [(
             entry['session_id'],
             entry['timestamp'],
             entry['user_input'],
             entry['bot_response']
-        ))
-
-        # Commit the transaction
+        ) for entry in entries], page_size=max(len(entries), 1))
         conn.commit()
-
-        # Close the cursor and connection
         cur.close()
         conn.close()
+
+    @timed("log_post")
+    def post_entry(self, entry):
+        if not self.write_behind:
+            self.insert_entries([entry])
+            if self.debug:
+                print("Entry posted successfully to the 'entries' table.")
+            return
+        if self.writer_pid != os.getpid() or not self.writer.is_alive():
+            # Not started yet, stopped, or this is a worker forked after it
+            # was started, which doesn't inherit the thread.
+            with self.writer_lock:
+                if self.writer_pid != os.getpid() or not self.writer.is_alive():
+                    self.start_writer()
+        try:
+            self.queue.put_nowait(entry)
+            self.stats["queued"] += 1
+        except queue.Full:
+            # The writer can't keep up; don't make the request wait for it.
+            self.spool([entry])
+
+    def start_writer(self):
+        if self.writer_pid != os.getpid():
+            # A restarted writer in the same process picks up what is still queued.
+            self.queue = queue.Queue(maxsize=self.queue_size)
+        self.writer = threading.Thread(target=self.write_entries, name="ConversationLogger writer", daemon=True)
+        self.writer_pid = os.getpid()
+        self.writer.start()
+
+    def write_entries(self):
+        """Background writer: drains the queue in batches until close() sends None."""
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0, deadline - time.monotonic())
+            try:
+                entry = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = False  # the flush interval is up
+            if entry is None:
+                self.safe_flush(batch)
+                return
+            if entry:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval_ms / 1000
+                batch.append(entry)
+            if batch and (len(batch) >= self.flush_entries or time.monotonic() >= deadline):
+                self.safe_flush(batch)
+                batch = []
+
+    def safe_flush(self, batch):
+        """Flushes a batch without letting an error stop the writer thread."""
+        try:
+            self.flush(batch)
+        except Exception as e:
+            print(f"Could not write or spool {len(batch)} log entries: {e!r}")
+            try:
+                self.spool(batch)
+            except Exception as e:
+                print(f"Dropped {len(batch)} log entries: {e!r}")
+
+    def flush(self, batch):
+        if not batch:
+            return
+        try:
+            self.insert_entries(batch)
+        except Exception as e:
+            # Postgres is down, or an entry can't be inserted as it is.
+            print(f"Could not write {len(batch)} log entries, spooling them to {self.spool_path}: {e}")
+            self.spool(batch)
+            return
+        self.stats["written"] += len(batch)
+        self.stats["flushes"] += 1
         if self.debug:
-            print("Entry posted successfully to the 'entries' table.")
+            print(f"Posted {len(batch)} entries to the 'entries' table.")
+        if os.path.exists(self.spool_path):
+            try:
+                self.replay_spool()
+            except Exception as e:
+                # The batch is written; the spool is tried again after the next one.
+                print(f"Could not replay {self.spool_path}: {e!r}")
+
+    def open_spool(self):
+        """
+        Opens the spool file for appending and takes its lock. If another
+        process renamed the file aside to replay it in the meantime, the new
+        one is opened instead, so no entry is written to a file being replayed.
+        """
+        while True:
+            f = open(self.spool_path, "a")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(self.spool_path).st_ino == os.fstat(f.fileno()).st_ino:
+                    return f
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def spool(self, entries):
+        # Serialized up front, so an entry that can't be doesn't leave a partial batch behind.
+        lines = "".join(json.dumps(entry, default=str) + "\n" for entry in entries)
+        with self.spool_lock:
+            with self.open_spool() as f:
+                f.write(lines)
+            self.stats["spooled"] += len(entries)
+
+    def replay_spool(self):
+        """
+        Inserts the entries from the spool file. The file is renamed aside
+        under its lock first, so other processes start a new one, and only
+        one of them replays each entry. Entries that still can't be inserted
+        are spooled again.
+        """
+        replay_path = f"{self.spool_path}.{os.getpid()}.replay"
+        with self.spool_lock:
+            try:
+                f = open(self.spool_path)
+            except FileNotFoundError:
+                return
+            with f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if os.stat(self.spool_path).st_ino != os.fstat(f.fileno()).st_ino:
+                        return  # another process is replaying it
+                except FileNotFoundError:
+                    return
+                os.rename(self.spool_path, replay_path)
+                entries = []
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # A line torn by a crash mid-write; the rest of the file is still good.
+                        if line.strip():
+                            print(f"Skipped an unreadable line in {self.spool_path}: {line[:80]!r}")
+        try:
+            if entries:
+                self.insert_entries(entries)
+        except Exception as e:
+            print(f"Could not replay {self.spool_path}: {e}")
+            self.spool(entries)
+            os.remove(replay_path)
+            return
+        os.remove(replay_path)
+        self.stats["replayed"] += len(entries)
+
+    def close(self, timeout: float = 10):
+        """Writes out whatever is still queued. Registered to run at exit."""
+        if self.writer is None or self.writer_pid != os.getpid() or not self.writer.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            # The writer is stuck; keep what it hasn't got to on disk.
+            entries = []
+            while not self.queue.empty():
+                entries.append(self.queue.get_nowait())
+            self.spool([entry for entry in entries if entry])
+            return
+        self.writer.join(timeout)
 
     def get_entries(self, limit=0):
+        self.ensure_database()
         conn, cur = self.database_connection()
 
         # SQL query to fetch all rows from the 'entries' table
@@ -22,7 +22,9 @@ openai_client = OpenAI(
     organization='org-M7JuSsksoyQIdQOGaTgA2wkk',
     project='proj_E0H6uUDUEkSZfn0jdmqy206G'
 )
-embedder = cb.Embedder(openai_client)
+# Full-wiki rebuilds go through the Batch API, which costs half as much and
+# isn't subject to the interactive rate limits, but can take hours.
+embedder = cb.Embedder(openai_client, use_batch_api = limit > 1000)
 df = embedder.compile_embeddings(wiki_strings, urls)
 df2 = pd.DataFrame({"text": df.text, "embedding": df.embedding})
 print(df2)
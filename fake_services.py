@@ -0,0 +1,643 @@
+"""
+fake_services.py:
+Local stand-ins for the services the chatbots call, so they can be
+benchmarked and exercised without API keys or network access:
+  - FakeOpenAI serves /v1/embeddings and /v1/chat/completions (streamed
+    or not), and the /v1/files and /v1/batches endpoints of the Batch API,
+    for openai.OpenAI(base_url=...),
+  - FakePinecone serves the Pinecone data plane (upsert, query, fetch,
+    delete, describe_index_stats) for pinecone.Index(host=...),
+  - FakeMediaWiki serves enough of api.php for mwclient and pymediawiki to
+    list, search and read a generated wiki.
+
+Each one runs an HTTP server on a free local port in a background thread,
+and delays every response by latency seconds (plus up to jitter seconds
+more), so the real client libraries, HTTP round trips and JSON payloads
+are all part of what gets measured.
+
+Embeddings are not random: each text is hashed word by word into a fixed
+random projection, so texts that share words have similar vectors and
+retrieval finds the chunks a question was written from.
+
+To use:
+with FakeOpenAI(latency=0.05) as fake_openai:
+    client = OpenAI(api_key="fake", base_url=fake_openai.url + "/v1")
+"""
+
+import base64
+import email.parser
+import email.policy
+import http.server
+import json
+import random
+import threading
+import time
+import urllib.parse
+import zlib
+
+import numpy as np
+
+from chatbotter import EMBEDDING_DIMENSIONS
+
+
+class FakeServer:
+    """
+    Runs handle(method, path, params, body) behind a threaded HTTP server.
+    body is the decoded JSON request body, or for multipart uploads a dict
+    of the parts' contents as bytes. handle returns (status, payload),
+    where payload is a dict or list to send as JSON, bytes to send as they
+    are, or an iterator of server-sent event strings to stream.
+    """
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        port: int = 0
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        service = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, as the real services allow
+            # Headers and body go out in separate writes, which Nagle's
+            # algorithm would hold back for a delayed ACK (~40 ms).
+            disable_nagle_algorithm = True
+
+            def respond(self, method):
+                split = urllib.parse.urlsplit(self.path)
+                params = urllib.parse.parse_qs(split.query)
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/x-www-form-urlencoded'):
+                    params.update(urllib.parse.parse_qs(raw.decode('utf-8')))
+                    body = None
+                elif content_type.startswith('multipart/form-data'):
+                    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                        f"Content-Type: {content_type}\r\n\r\n".encode('utf-8') + raw)
+                    body = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                        for part in message.iter_parts()}
+                else:
+                    body = json.loads(raw) if raw else None
+                service.requests += 1
+                service.wait()
+                try:
+                    status, payload = service.handle(method, split.path, params, body)
+                except Exception as e:
+                    status, payload = 500, {"error": {"message": repr(e)}}
+                if isinstance(payload, (dict, list)):
+                    data = json.dumps(payload).encode('utf-8')
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                elif isinstance(payload, bytes):
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                else:
+                    # Streamed responses end by closing the connection.
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Connection', 'close')
+                    self.end_headers()
+                    for event in payload:
+                        self.wfile.write(event.encode('utf-8'))
+                        self.wfile.flush()
+                    self.close_connection = True
+
+            def do_GET(self):
+                self.respond('GET')
+
+            def do_POST(self):
+                self.respond('POST')
+
+            def do_DELETE(self):
+                self.respond('DELETE')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def host(self) -> str:
+        return f"127.0.0.1:{self.server.server_address[1]}"
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}"
+
+    def wait(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def handle(self, method, path, params, body):
+        return 404, {"error": {"message": f"No route for {method} {path}"}}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class FakeOpenAI(FakeServer):
+    """
+    The OpenAI embeddings and chat completions endpoints. Completions are
+    completion_words words long; streamed ones arrive chunk_words words at
+    a time, chunk_delay seconds apart.
+
+    Embeddings requests are answered with a 429 rate limit error with
+    probability rate_limit_rate, for exercising retries.
+
+    Batches run in a background thread and complete batch_delay seconds
+    after they are created. Each request in a batch fails with a 500 with
+    probability batch_failure_rate, and lands in the batch's error file.
+    """
+    buckets = 2048  # words are hashed into this many buckets before projecting
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        completion_words: int = 150,
+        chunk_words: int = 3,
+        chunk_delay: float = 0.0,
+        batch_delay: float = 0.0,
+        batch_failure_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        port: int = 0
+    ) -> None:
+        super().__init__(latency=latency, jitter=jitter, port=port)
+        self.rate_limit_rate = rate_limit_rate
+        self.completion_words = completion_words
+        self.chunk_words = chunk_words
+        self.chunk_delay = chunk_delay
+        self.batch_delay = batch_delay
+        self.batch_failure_rate = batch_failure_rate
+        self.projections = {}  # dimensions -> (buckets, dimensions) matrix
+        self.projections_lock = threading.Lock()
+        self.usage = {"embedding_inputs": 0, "completions": 0, "batch_requests": 0}
+        self.files = {}  # id -> (file object, content)
+        self.batches = {}  # id -> batch object
+        self.batch_lock = threading.Lock()
+
+    def projection(self, dimensions: int) -> np.ndarray:
+        with self.projections_lock:
+            if dimensions not in self.projections:
+                rng = np.random.default_rng(dimensions)
+                self.projections[dimensions] = rng.standard_normal((self.buckets, dimensions), dtype=np.float32)
+            return self.projections[dimensions]
+
+    def embed(self, texts: list[str], model: str, dimensions: int = None) -> np.ndarray:
+        """Unit-length vectors; shortened ones are the renormalized leading components, as with the real API."""
+        full = EMBEDDING_DIMENSIONS.get(model, 1536)
+        counts = np.zeros((len(texts), self.buckets), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                counts[i, zlib.crc32(word.strip('.,;:!?"\'()').encode('utf-8')) % self.buckets] += 1
+        vectors = counts @ self.projection(full)
+        if dimensions:
+            vectors = vectors[:, :dimensions]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def completion_text(self, messages) -> str:
+        # Echo words from the prompt, so answers look like they draw on it.
+        words = " ".join(m.get("content") or "" for m in messages).split() or ["answer"]
+        rng = random.Random(len(words))
+        return " ".join(rng.choice(words) for _ in range(self.completion_words))
+
+    def handle(self, method, path, params, body):
+        if path.endswith("/embeddings"):
+            if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+                self.usage["rate_limited"] = self.usage.get("rate_limited", 0) + 1
+                return 429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            return 200, self.embeddings(body)
+        if path.endswith("/chat/completions"):
+            return 200, self.chat_completion(body)
+        parts = path.rstrip("/").split("/")
+        if parts[-1] == "files" and method == "POST":
+            return 200, self.create_file(body)
+        if parts[-1] == "content" and parts[-3] == "files":
+            return (200, self.files[parts[-2]][1]) if parts[-2] in self.files else (404, {"error": {"message": "No such file"}})
+        if parts[-1] == "batches" and method == "POST":
+            return 200, self.create_batch(body)
+        if parts[-2] == "batches":
+            with self.batch_lock:
+                batch = self.batches.get(parts[-1])
+            return (200, dict(batch)) if batch else (404, {"error": {"message": "No such batch"}})
+        return super().handle(method, path, params, body)
+
+    def create_file(self, body, filename: str = "upload.jsonl", purpose: str = None) -> dict:
+        content = body["file"] if isinstance(body, dict) else body
+        purpose = purpose or (body.get("purpose", b"batch").decode('utf-8') if isinstance(body, dict) else "batch")
+        with self.batch_lock:
+            file = {
+                "id": f"file-fake{len(self.files)}",
+                "object": "file",
+                "bytes": len(content),
+                "created_at": int(time.time()),
+                "filename": filename,
+                "purpose": purpose,
+                "status": "processed",
+            }
+            self.files[file["id"]] = (file, content)
+        return file
+
+    def create_batch(self, body) -> dict:
+        with self.batch_lock:
+            batch = {
+                "id": f"batch_fake{len(self.batches)}",
+                "object": "batch",
+                "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"],
+                "status": "in_progress",
+                "created_at": int(time.time()),
+                "output_file_id": None,
+                "error_file_id": None,
+                "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            }
+            self.batches[batch["id"]] = batch
+        threading.Thread(target=self.run_batch, args=(batch["id"], ), daemon=True).start()
+        return dict(batch)
+
+    def run_batch(self, batch_id: str):
+        time.sleep(self.batch_delay)
+        with self.batch_lock:
+            batch = self.batches[batch_id]
+        lines = [json.loads(line) for line in self.files[batch["input_file_id"]][1].splitlines() if line.strip()]
+        outputs, errors = [], []
+        for n, request in enumerate(lines):
+            self.usage["batch_requests"] += 1
+            if random.random() < self.batch_failure_rate:
+                errors.append({"id": f"batch_req_{n}", "custom_id": request["custom_id"],
+                    "response": {"status_code": 500, "request_id": f"req_{n}",
+                        "body": {"error": {"message": "The server had an error processing the request."}}},
+                    "error": None})
+                continue
+            body = self.embeddings(request["body"]) if request["url"].endswith("/embeddings") else self.chat_completion(request["body"])
+            outputs.append({"id": f"batch_req_{n}", "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": f"req_{n}", "body": body}, "error": None})
+
+        def jsonl(results) -> bytes:
+            return "".join(json.dumps(r) + "\n" for r in results).encode('utf-8')
+
+        output_file = self.create_file(jsonl(outputs), "batch_output.jsonl", "batch_output") if outputs else None
+        error_file = self.create_file(jsonl(errors), "batch_errors.jsonl", "batch_output") if errors else None
+        with self.batch_lock:
+            batch.update({
+                "status": "completed",
+                "output_file_id": output_file and output_file["id"],
+                "error_file_id": error_file and error_file["id"],
+                "request_counts": {"total": len(lines), "completed": len(outputs), "failed": len(errors)},
+            })
+
+    def embeddings(self, body) -> dict:
+        texts = body["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        self.usage["embedding_inputs"] += len(texts)
+        vectors = self.embed(texts, body["model"], body.get("dimensions"))
+        if body.get("encoding_format") == "base64":
+            encoded = [base64.b64encode(v.astype('<f4').tobytes()).decode('ascii') for v in vectors]
+        else:
+            encoded = vectors.tolist()
+        tokens = sum(len(t.split()) for t in texts)
+        return {
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": e} for i, e in enumerate(encoded)],
+            "model": body["model"],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def chat_completion(self, body):
+        self.usage["completions"] += 1
+        text = self.completion_text(body["messages"])
+        created = int(time.time())
+        if body.get("stream"):
+            return self.stream_completion(body["model"], text, created)
+        prompt_tokens = sum(len((m.get("content") or "").split()) for m in body["messages"])
+        return {
+            "id": f"chatcmpl-fake{self.requests}",
+            "object": "chat.completion",
+            "created": created,
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.completion_words,
+                "total_tokens": prompt_tokens + self.completion_words,
+            },
+        }
+
+    def stream_completion(self, model, text, created):
+        words = text.split(" ")
+
+        def chunk(delta, finish_reason = None):
+            return "data: " + json.dumps({
+                "id": f"chatcmpl-fake{self.requests}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }) + "\n\n"
+
+        yield chunk({"role": "assistant", "content": ""})
+        for start in range(0, len(words), self.chunk_words):
+            if self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            piece = " ".join(words[start:start + self.chunk_words])
+            yield chunk({"content": piece if start == 0 else " " + piece})
+        yield chunk({}, "stop")
+        yield "data: [DONE]\n\n"
+
+
+def matches_filter(metadata: dict, filter: dict) -> bool:
+    """Whether a vector's metadata passes a Pinecone metadata filter."""
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, f) for f in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(matches_filter(metadata, f) for f in condition):
+                return False
+            continue
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        value = metadata.get(key)
+        for op, operand in condition.items():
+            if op == "$exists":
+                passed = (key in metadata) == operand
+            elif value is None:
+                passed = op in ("$ne", "$nin")
+            elif isinstance(value, list):
+                # A list field matches if any of its values does ($ne and $nin: if all of them do).
+                test = all if op in ("$ne", "$nin") else any
+                passed = test(matches_filter({key: v}, {key: {op: operand}}) for v in value)
+            else:
+                passed = {
+                    "$eq": lambda: value == operand,
+                    "$ne": lambda: value != operand,
+                    "$in": lambda: value in operand,
+                    "$nin": lambda: value not in operand,
+                    "$gt": lambda: value > operand,
+                    "$gte": lambda: value >= operand,
+                    "$lt": lambda: value < operand,
+                    "$lte": lambda: value <= operand,
+                }[op]()
+            if not passed:
+                return False
+    return True
+
+
+class FakePinecone(FakeServer):
+    """
+    The data plane of one serverless Pinecone index, with exact cosine
+    search over each namespace. Queries can filter on metadata with
+    Pinecone's $eq, $ne, $in, $nin, $gt, $gte, $lt, $lte, $exists, $and
+    and $or operators.
+    """
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        port: int = 0
+    ) -> None:
+        super().__init__(latency=latency, jitter=jitter, port=port)
+        self.namespaces = {}  # namespace -> {id: (unit vector, values, metadata)}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.namespaces = {}
+
+    def handle(self, method, path, params, body):
+        if path == "/vectors/upsert":
+            return 200, self.upsert(body)
+        if path == "/query":
+            return 200, self.query(body)
+        if path == "/vectors/fetch":
+            return 200, self.fetch(params.get("ids", []), params.get("namespace", [""])[0])
+        if path == "/vectors/update":
+            return 200, self.update(body)
+        if path == "/vectors/delete":
+            return 200, self.delete(body or {})
+        if path == "/describe_index_stats":
+            return 200, self.describe_index_stats()
+        return super().handle(method, path, params, body)
+
+    def upsert(self, body) -> dict:
+        namespace = body.get("namespace", "")
+        with self.lock:
+            vectors = self.namespaces.setdefault(namespace, {})
+            for v in body["vectors"]:
+                unit = np.asarray(v["values"], dtype=np.float32)
+                unit /= np.linalg.norm(unit) or 1
+                vectors[v["id"]] = (unit, v["values"], v.get("metadata"))
+        return {"upsertedCount": len(body["vectors"])}
+
+    def query(self, body) -> dict:
+        namespace = body.get("namespace", "")
+        with self.lock:
+            items = list(self.namespaces.get(namespace, {}).items())
+        if body.get("filter"):
+            items = [item for item in items if matches_filter(item[1][2] or {}, body["filter"])]
+        matches = []
+        if items:
+            query = np.asarray(body["vector"], dtype=np.float32)
+            query /= np.linalg.norm(query) or 1
+            scores = np.stack([item[1][0] for item in items]) @ query
+            top_k = min(body.get("topK", 10), len(items))
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            for i in top[np.argsort(-scores[top])]:
+                id, (unit, values, metadata) = items[i]
+                match = {"id": id, "score": float(scores[i]), "values": values if body.get("includeValues") else []}
+                if body.get("includeMetadata") and metadata is not None:
+                    match["metadata"] = metadata
+                matches.append(match)
+        return {"matches": matches, "namespace": namespace, "usage": {"readUnits": 5}}
+
+    def fetch(self, ids, namespace) -> dict:
+        with self.lock:
+            vectors = self.namespaces.get(namespace, {})
+            found = {id: vectors[id] for id in ids if id in vectors}
+        return {
+            "vectors": {id: {"id": id, "values": values, **({"metadata": metadata} if metadata else {})}
+                for id, (unit, values, metadata) in found.items()},
+            "namespace": namespace,
+            "usage": {"readUnits": 1},
+        }
+
+    def update(self, body) -> dict:
+        namespace = body.get("namespace", "")
+        with self.lock:
+            vectors = self.namespaces.get(namespace, {})
+            if body["id"] in vectors:
+                unit, values, metadata = vectors[body["id"]]
+                if body.get("values"):
+                    values = body["values"]
+                    unit = np.asarray(values, dtype=np.float32)
+                    unit /= np.linalg.norm(unit) or 1
+                vectors[body["id"]] = (unit, values, {**(metadata or {}), **body.get("setMetadata", {})})
+        return {}
+
+    def delete(self, body) -> dict:
+        namespace = body.get("namespace", "")
+        with self.lock:
+            if body.get("deleteAll"):
+                self.namespaces.pop(namespace, None)
+            for id in body.get("ids", []):
+                self.namespaces.get(namespace, {}).pop(id, None)
+        return {}
+
+    def describe_index_stats(self) -> dict:
+        with self.lock:
+            counts = {namespace: len(vectors) for namespace, vectors in self.namespaces.items()}
+            dimension = next((len(v[1]) for vectors in self.namespaces.values() for v in vectors.values()), 0)
+        return {
+            "namespaces": {namespace: {"vectorCount": n} for namespace, n in counts.items()},
+            "dimension": dimension,
+            "indexFullness": 0.0,
+            "totalVectorCount": sum(counts.values()),
+        }
+
+
+class FakeMediaWiki(FakeServer):
+    """
+    api.php for a generated wiki of pages pages, all in Category:Benchmark,
+    each with a summary and sections sections of paragraphs paragraphs of
+    paragraph_words words. Point WikiExtractor at it with
+    site_name=wiki.host and url=wiki.api_url.
+    """
+    category = "Benchmark"
+
+    def __init__(
+        self,
+        pages: int = 50,
+        sections: int = 4,
+        paragraphs: int = 3,
+        paragraph_words: int = 120,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        port: int = 0
+    ) -> None:
+        super().__init__(latency=latency, jitter=jitter, port=port)
+        rng = random.Random(0)
+        self.vocabulary = [
+            "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 10)))
+            for _ in range(5000)
+        ]
+        self.titles = [f"Benchmark Page {n:05d}" for n in range(pages)]
+        self.texts = {title: self.page_text(title, random.Random(title), sections, paragraphs, paragraph_words)
+            for title in self.titles}
+
+    @property
+    def api_url(self) -> str:
+        return f"{self.url}/w/api.php"
+
+    def page_text(self, title, rng, sections, paragraphs, paragraph_words) -> str:
+        def paragraph():
+            return " ".join(rng.choice(self.vocabulary) for _ in range(paragraph_words)) + "."
+
+        parts = [f"'''{title}''' is a generated page. {paragraph()}"]
+        for s in range(sections):
+            parts.append(f"== Section {s} ==")
+            parts.extend(paragraph() for _ in range(paragraphs))
+        parts.append("== References ==\n<references />")
+        parts.append(f"[[Category:{self.category}]]")
+        return "\n\n".join(parts)
+
+    def page_url(self, title: str) -> str:
+        return f"{self.url}/wiki/{urllib.parse.quote(title.replace(' ', '_'))}"
+
+    def page_info(self, title: str) -> dict:
+        if title.startswith("Category:"):
+            return {"pageid": 1, "ns": 14, "title": title, "touched": "2024-01-01T00:00:00Z",
+                "lastrevid": 1, "length": 0, "protection": []}
+        if title not in self.texts:
+            return {"ns": 0, "title": title, "missing": ""}
+        return {"pageid": self.titles.index(title) + 2, "ns": 0, "title": title,
+            "touched": "2024-01-01T00:00:00Z", "lastrevid": 1,
+            "length": len(self.texts[title]), "protection": []}
+
+    def handle(self, method, path, params, body):
+        if not path.endswith("api.php"):
+            return super().handle(method, path, params, body)
+        params = {k: v[0] for k, v in params.items()}
+        if params.get("action") == "opensearch":
+            search = params.get("search", "")
+            limit = int(params.get("limit", 10))
+            titles = [t for t in self.titles if t.lower().startswith(search.lower())][:limit]
+            return 200, [search, titles, ["" for t in titles], [self.page_url(t) for t in titles]]
+        if params.get("action") == "query":
+            return 200, self.query(params)
+        return 200, {"error": {"code": "badvalue", "info": f"Unsupported action {params.get('action')}"}}
+
+    def query(self, params) -> dict:
+        meta = params.get("meta", "").split("|")
+        query = {"userinfo": {"id": 0, "name": "127.0.0.1", "anon": "", "groups": ["*"], "rights": ["read"]}}
+        result = {"batchcomplete": "", "query": query}
+        if "siteinfo" in meta:
+            query["general"] = {
+                "generator": "MediaWiki 1.39.0",
+                "server": self.url,
+                "base": self.page_url("Main Page"),
+                "sitename": "Benchmark Wiki",
+            }
+            query["namespaces"] = {
+                "0": {"id": 0, "*": ""},
+                "6": {"id": 6, "*": "File"},
+                "14": {"id": 14, "*": "Category"},
+            }
+            query["extensions"] = []
+
+        generator = params.get("generator")
+        if generator in ("allpages", "categorymembers"):
+            prefix = "gap" if generator == "allpages" else "gcm"
+            if generator == "categorymembers" and params.get("gcmtitle") != f"Category:{self.category}":
+                titles = []
+            else:
+                titles = self.titles
+            limit = params.get(f"{prefix}limit", "max")
+            limit = 500 if limit == "max" else int(limit)
+            start = int(params.get(f"{prefix}continue", 0))
+            query["pages"] = {str(self.page_info(t)["pageid"]): self.page_info(t) for t in titles[start:start + limit]}
+            if start + limit < len(titles):
+                result["continue"] = {f"{prefix}continue": str(start + limit), "continue": f"{prefix}continue||"}
+        elif "titles" in params:
+            pages = {}
+            for n, title in enumerate(params["titles"].split("|")):
+                info = self.page_info(title)
+                if "revisions" in params.get("prop", "") and "missing" not in info:
+                    info["revisions"] = [{
+                        "timestamp": "2024-01-01T00:00:00Z",
+                        "slots": {"main": {"contentmodel": "wikitext", "*": self.texts[title]}},
+                    }]
+                pages[str(info.get("pageid", -1 - n))] = info
+            query["pages"] = pages
+        return result
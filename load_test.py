@@ -0,0 +1,72 @@
+"""
+load_test.py:
+Load-tests a running Shellbot server's /chat endpoint. Each simulated user
+keeps its own session cookie and sends its questions one after another;
+the test is repeated at 1, 10 and 100 concurrent users and reports p50/p95
+latency and requests per second for each level.
+
+To run (against shellbot_asgi.py or shellbot_flask.py):
+uvicorn shellbot_asgi:app
+python load_test.py http://127.0.0.1:8000
+"""
+
+import asyncio
+import statistics
+import sys
+import time
+
+import httpx
+
+
+BASE_URL = sys.argv[1] if len(sys.argv) > 1 else "http://127.0.0.1:8000"
+CONCURRENCY_LEVELS = [1, 10, 100]
+QUESTIONS_PER_USER = 3
+TIMEOUT = 300
+QUESTIONS = [
+    "Tell me about Portage tennis.",
+    "What have you been doing with regard to artificial intelligence?",
+    "What do you think about climate change?",
+    "What books have you written?",
+]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+async def simulate_user(user_number, latencies, errors):
+    async with httpx.AsyncClient(base_url=BASE_URL, timeout=TIMEOUT) as client:
+        await client.get("/")  # picks up a session cookie
+        for i in range(QUESTIONS_PER_USER):
+            question = QUESTIONS[(user_number + i) % len(QUESTIONS)]
+            start = time.perf_counter()
+            try:
+                response = await client.post("/chat", json={"message": question})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError as e:
+                errors.append(e)
+
+
+async def run_level(users):
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*[simulate_user(n, latencies, errors) for n in range(users)])
+    elapsed = time.perf_counter() - start
+    if latencies:
+        print(f"{users:>4} users: p50 {statistics.median(latencies) * 1000:8.0f} ms, "
+              f"p95 {percentile(latencies, 95) * 1000:8.0f} ms, "
+              f"{len(latencies) / elapsed:6.2f} req/s, {len(errors)} errors")
+    else:
+        print(f"{users:>4} users: all {len(errors)} requests failed ({errors[0]!r})")
+
+
+async def main():
+    for users in CONCURRENCY_LEVELS:
+        await run_level(users)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -16,6 +16,7 @@ import tiktoken  # for counting tokens
 import os # for getting API token from env variable OPENAI_API_KEY
 from scipy import spatial  # for calculating vector similarities for search
 import json
+import threading
 
 
 # models
@@ -49,12 +50,33 @@ def pretty_print(messages):
 
 # download pre-chunked text and pre-computed embeddings
 embeddings_path = "data/gem_wisconsin.csv"
-
-df = pd.read_csv(embeddings_path)
-# convert embeddings from CSV str type back to list type
-df['embedding'] = df['embedding'].apply(ast.literal_eval)
-# the dataframe has two columns: "text" and "embedding"
-# print(df)
+# Parsed on first use rather than at import, so the app starts quickly.
+df = None
+df_lock = threading.Lock()
+
+
+def get_df() -> pd.DataFrame:
+    global df
+    if df is None:
+        with df_lock:
+            if df is None:
+                loaded = pd.read_csv(embeddings_path)
+                # convert embeddings from CSV str type back to list type
+                loaded['embedding'] = loaded['embedding'].apply(ast.literal_eval)
+                # the dataframe has two columns: "text" and "embedding"
+                # print(loaded)
+                df = loaded
+    return df
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    # Starts loading the embeddings on the first call; 503 until they are loaded.
+    if df is not None:
+        return jsonify({'ready': True})
+    if not df_lock.locked():
+        threading.Thread(target=get_df, daemon=True).start()
+    return jsonify({'ready': False}), 503
 
 # search function
 def strings_ranked_by_relatedness(
@@ -114,7 +136,7 @@ def chat():
     token_budget = 4096 - 500
     print_message = False
     query = request.json.get('message')
-    message = query_message(query, df, model=model, token_budget=token_budget)
+    message = query_message(query, get_df(), model=model, token_budget=token_budget)
     if print_message:
         print(message)
     messages = [
@@ -21,23 +21,29 @@ openai_client = OpenAI(
 embeddings_path = "data/embedding_gem_wiki.csv"
 embedder = cb.Embedder(openai_client)
 
-asker = cb.Asker(openai_client)
+asker = cb.Asker(openai_client, completion_cache = cb.CompletionCache())
 asker.load_embeddings_from_csv(embeddings_path)
-print(asker.ask('Where is the SUKELCO Solar Power Plant located?'))
-print(asker.ask('Tell me about the Peace River Area 2 Oil and Gas Project.'))
-print(asker.ask('What coal-burning power plants have been retired since 2020?'))
-print(asker.ask('Tell me about the Nelson Dewey Generating Facility.'))
-print(asker.ask('What nonprofits in Wisconsin are advocating for renewable energy?'))
-print(asker.ask('What companies in Wisconsin are investing in renewable energy?'))
-print(asker.ask('What coal-burning power plants have been shut down in Wisconsin?'))
-print(asker.ask('What coal-burning power plants have been retired since 2020?'))
-print(asker.ask('What companies in Wisconsin are investing in renewable energy?'))
-print(asker.ask('What are some solar power plants that are currently operating in Colorado?'))
-print(asker.ask('Name some organizations that are advocating for renewable energy in the United States.'))
-print(asker.ask('What are some front groups for the fossil fuel industry?'))
-print(asker.ask('Describe the activities of the fossil fuel industry\'s front groups.'))
-print(asker.ask('What are some effective ways to advocate for action on climate change?'))
-print(asker.ask('Name some innovative businesses that are working to address climate change.'))
-print(asker.ask('Tell me about Arch Coal.'))
-print(asker.ask('What are some fossil fuel companies that have filed for bankruptcy?'))
-print(asker.ask('I\'m working on a book about climate change and political polarization in the United States. Please review the articles in the GEM wiki and write an outline for a book chapter that will talk about organizations working to address the problem and the challenges that they are facing in today\'s political climate.'))
+questions = [
+    'Where is the SUKELCO Solar Power Plant located?',
+    'Tell me about the Peace River Area 2 Oil and Gas Project.',
+    'What coal-burning power plants have been retired since 2020?',
+    'Tell me about the Nelson Dewey Generating Facility.',
+    'What nonprofits in Wisconsin are advocating for renewable energy?',
+    'What companies in Wisconsin are investing in renewable energy?',
+    'What coal-burning power plants have been shut down in Wisconsin?',
+    'What coal-burning power plants have been retired since 2020?',
+    'What companies in Wisconsin are investing in renewable energy?',
+    'What are some solar power plants that are currently operating in Colorado?',
+    'Name some organizations that are advocating for renewable energy in the United States.',
+    'What are some front groups for the fossil fuel industry?',
+    'Describe the activities of the fossil fuel industry\'s front groups.',
+    'What are some effective ways to advocate for action on climate change?',
+    'Name some innovative businesses that are working to address climate change.',
+    'Tell me about Arch Coal.',
+    'What are some fossil fuel companies that have filed for bankruptcy?',
+    'I\'m working on a book about climate change and political polarization in the United States. Please review the articles in the GEM wiki and write an outline for a book chapter that will talk about organizations working to address the problem and the challenges that they are facing in today\'s political climate.',
+]
+# Repeated questions are answered once; answers print as they complete.
+for position, answer in asker.ask_many(questions, concurrency = 8):
+    print(questions[position])
+    print(answer)
@@ -22,7 +22,7 @@ storage = cb.Storer(
     pinecone_index_name = 'gem-wiki-10000'
 )
 
-asker = cb.Asker(openai_client, storage = storage)
+asker = cb.Asker(openai_client, storage = storage, completion_cache = cb.CompletionCache())
 print(asker.ask('What coal-burning power plants have been retired since 2020?')[0])
 print(asker.ask('What coal-burning power plants have been retired since 2020?')[1])
 print(asker.ask('What coal-burning power plants have been retired since 2020?')[2])
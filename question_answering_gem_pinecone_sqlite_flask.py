@@ -12,7 +12,7 @@ https://cookbook.openai.com/examples/embedding_wikipedia_articles_for_search
 """
 
 # imports
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 # import ast  # for converting embeddings saved as strings back to arrays
 # from scipy import spatial  # for calculating vector similarities for search
 # import json
@@ -30,12 +30,14 @@ import hashlib
 import time
 import numpy as np
 import sqlite3
+from chatbotter import CompletionCache, create_completion, metrics
 
 
 client = OpenAI(
   organization='org-M7JuSsksoyQIdQOGaTgA2wkk',
   project='proj_E0H6uUDUEkSZfn0jdmqy206G',
 )
+completion_cache = CompletionCache()
 
 # gw = MediaWiki(
 #     url='https://www.gem.wiki/w/api.php',
@@ -187,12 +189,13 @@ def chat():
         {"role": "system", "content": "You answer questions about sustainable energy and other activities related to climate change and global warming."},
         {"role": "user", "content": message},
     ]
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
+    response_message = create_completion(
+        client,
+        model,
+        messages,
+        cache=completion_cache,
         temperature=0
     )
-    response_message = response.choices[0].message.content
     # print(response_message)
 
     references = "<p><b>For more information:</b></p><ul>"
@@ -204,15 +207,20 @@ def chat():
         {"role": "system", "content": "You provide references to articles used to compile answers to questions from the GEM wiki."},
         {"role": "user", "content": references},
     ]
-    response2 = client.chat.completions.create(
-        model=model,
-        messages=messages2,
+    response_message2 = create_completion(
+        client,
+        model,
+        messages2,
+        cache=completion_cache,
         temperature=0
     )
-    response_message2 = response2.choices[0].message.content
 
     return jsonify({'response': response_message + references})
 
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
 if __name__ == '__main__':
     app.run(debug=True)
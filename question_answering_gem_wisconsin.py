@@ -21,7 +21,7 @@ openai_client = OpenAI(
 embeddings_path = "data/embedding_gem_wisconsin.csv"
 embedder = cb.Embedder(openai_client)
 
-asker = cb.Asker(openai_client)
+asker = cb.Asker(openai_client, completion_cache = cb.CompletionCache())
 asker.load_embeddings_from_csv(embeddings_path)
 print(asker.ask('Who provides financing to the Nelson Dewey Generating Facility?'))
 print(asker.ask('What are some activities in 2022 for RENEW Wisconsin?'))
@@ -10,7 +10,7 @@ For more information see:
 https://cookbook.openai.com/examples/embedding_wikipedia_articles_for_search
 """
 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 import chatbotter as cb
 from openai import OpenAI # for calling the OpenAI API
 
@@ -24,14 +24,17 @@ storage = cb.Storer(
     db_path = 'wikipedia-climate-change.db',
     pinecone_index_name = 'wikipedia-climate-change'
 )
-wiki_asker = cb.Asker(openai_client, storage = storage)
+completion_cache = cb.CompletionCache()
+wiki_asker = cb.Asker(openai_client, storage = storage, answer_cache = cb.AnswerCache(),
+    completion_cache = completion_cache)
 
 storage_gem = cb.Storer(
     openai_client, None,
     db_path = 'gem_wiki.db',
     pinecone_index_name = 'gem-wiki-10000'
 )
-gem_asker = cb.Asker(openai_client, storage = storage_gem)
+gem_asker = cb.Asker(openai_client, storage = storage_gem, answer_cache = cb.AnswerCache(),
+    completion_cache = completion_cache)
 
 
 app = Flask(__name__)
@@ -55,6 +58,17 @@ def chat():
 
     return jsonify({'response': response})
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        'gem': gem_asker.answer_cache.stats(),
+        'wikipedia': wiki_asker.answer_cache.stats()
+    })
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    return Response(cb.metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,270 @@
+"""
+shellbot_asgi.py:
+Serves the Shellbot chat from an ASGI app, so one worker can hold many
+in-flight conversations while they wait on OpenAI, Pinecone and Postgres.
+Answers come from Asker.aask; the conversation log is written behind by
+the logger's background thread.
+
+As in shellbot_flask, creating the app connects to nothing: the clients,
+the vector store and the logger are set up in the background once the
+worker starts, or on the first request that needs them. /ready answers
+200 once they can serve questions.
+
+To run:
+uvicorn shellbot_asgi:app --workers 2
+or
+uvicorn --factory shellbot_asgi:create_app --workers 2
+
+Set SHELLBOT_SECRET_KEY when running more than one worker, so they all
+accept each other's session cookies.
+"""
+
+import time
+started = time.perf_counter()
+
+from openai import OpenAI, AsyncOpenAI # for calling the OpenAI API
+from social_data import SocialData
+from chatbotter import Asker, AnswerCache, CompletionCache, ConversationHistory, ConversationLogger, RetrievalCache, SessionStore, metrics, pool_metrics
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.sessions import SessionMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+from starlette.templating import Jinja2Templates
+import asyncio
+import contextlib
+import os
+import json
+import threading
+from datetime import datetime
+
+
+# The Asker and the conversation logger, once set up
+services = {}
+services_lock = threading.Lock()
+warm_up_pid = None
+
+templates = Jinja2Templates(directory='templates')
+
+
+def get_services() -> dict:
+    """Sets up the clients, the vector store and the logger on first use. Blocks."""
+    if 'asker' not in services:
+        with services_lock:
+            if 'asker' not in services:
+                start = time.perf_counter()
+                openai_client = OpenAI(
+                  organization='org-M7JuSsksoyQIdQOGaTgA2wkk',
+                  project='proj_E0H6uUDUEkSZfn0jdmqy206G',
+                )
+                async_openai_client = AsyncOpenAI(
+                  organization='org-M7JuSsksoyQIdQOGaTgA2wkk',
+                  project='proj_E0H6uUDUEkSZfn0jdmqy206G',
+                )
+                sd = SocialData(
+                    openai_client,
+                    knowledge_db_name = 'shellbot_knowledge',
+                    pinecone_index_name = "shellbot-embeddings2",
+                    vector_store = os.getenv('SHELLBOT_VECTOR_STORE', 'pinecone'),
+                    auto_filter = True,
+                )
+                if sd.vector_store == 'pgvector':
+                    sd.setup_pgvector()
+                else:
+                    sd.setup_pinecone()
+                services['logger'] = ConversationLogger(write_behind = True)
+                services['asker'] = Asker(openai_client, storage = sd,
+                    introduction = 'Use the below messages which were written by Sheldon Rampton to answer questions as though you are Sheldon Rampton. If the answer cannot be found in the articles, write "I could not find an answer."',
+                    string_divider = 'Messages:',
+                    async_openai_client = async_openai_client,
+                    answer_cache = AnswerCache(),
+                    completion_cache = CompletionCache(),
+                    retrieval_cache = RetrievalCache()
+                )
+                services['warm_up_seconds'] = time.perf_counter() - start
+    return services
+
+
+async def aget_services() -> dict:
+    # Setting up blocks on the network, so it runs in a worker thread.
+    if 'asker' in services:
+        return services
+    return await asyncio.to_thread(get_services)
+
+
+def warm_up():
+    """Sets up the services in the background, once per worker process."""
+    global warm_up_pid
+    with services_lock:
+        if warm_up_pid == os.getpid():
+            return
+        warm_up_pid = os.getpid()
+
+    def run():
+        global warm_up_pid
+        try:
+            get_services()
+        except Exception as e:
+            services['error'] = repr(e)
+            print(f"Warm-up failed: {e}")
+            warm_up_pid = None  # let the next /ready try again
+
+    threading.Thread(target=run, name="shellbot warm-up", daemon=True).start()
+
+
+# SessionStore waits on sqlite locks, so its calls run in a worker thread
+# rather than on the event loop.
+
+async def new_session(request):
+    request.session.clear()
+    session_id = os.urandom(16).hex()
+    request.session['session_id'] = session_id
+    conversation_history = ConversationHistory(session_id=session_id)
+    await asyncio.to_thread(request.app.state.sessions.save, session_id, conversation_history)  # Initialize conversation history
+    print(f"New session initialized: {session_id}")
+    return session_id, conversation_history
+
+
+async def home(request):
+    if 'session_id' not in request.session:
+        await new_session(request)
+    return templates.TemplateResponse(request, 'index.html')
+
+
+async def chat(request):
+    sessions = request.app.state.sessions
+    session_id = request.session.get('session_id')
+    conversation_history = await asyncio.to_thread(sessions.get, session_id)
+    if conversation_history is None:
+        session_id, conversation_history = await new_session(request)
+
+    user_input = (await request.json()).get('message')
+    asker = (await aget_services())['asker']
+    bot_response, references, articles = await asker.aask(user_input, conversation_history = conversation_history)
+    if bot_response == "I could not find an answer.":
+        session_id, conversation_history = await new_session(request)
+        bot_response, references, articles = await asker.aask(user_input, conversation_history = conversation_history)
+
+    # aask has added the question and answer to the conversation history
+    await asyncio.to_thread(sessions.save, session_id, conversation_history)
+
+    log_entry = {
+        "session_id": session_id,
+        "timestamp": datetime.now().isoformat(),
+        "user_input": user_input,
+        "bot_response": bot_response
+    }
+    services['logger'].post_entry(log_entry)  # only queues the entry
+    return JSONResponse({"response": bot_response})
+
+
+async def chat_stream(request):
+    # Same events as /chat_stream in shellbot_flask.
+    sessions = request.app.state.sessions
+    session_id = request.session.get('session_id')
+    conversation_history = await asyncio.to_thread(sessions.get, session_id)
+    if conversation_history is None:
+        session_id, conversation_history = await new_session(request)
+
+    user_input = (await request.json()).get('message')
+    asker = (await aget_services())['asker']
+    logger = services['logger']
+
+    def generate():
+        # A plain generator, so Starlette iterates the blocking stream in its thread pool.
+        for event in asker.ask_stream(user_input, conversation_history = conversation_history):
+            if event["type"] == "done":
+                bot_response = event["response"]
+                yield f"event: done\ndata: {json.dumps({'references': event['references'], 'ttft': event['ttft']})}\n\n"
+            else:
+                yield f"data: {json.dumps({'content': event['content']})}\n\n"
+
+        # ask_stream has added the question and answer to the conversation history
+        sessions.save(session_id, conversation_history)
+        logger.post_entry({
+            "session_id": session_id,
+            "timestamp": datetime.now().isoformat(),
+            "user_input": user_input,
+            "bot_response": bot_response
+        })
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Plain functions, like these, run in Starlette's thread pool, so they can
+# wait for get_services.
+
+def stream_stats(request):
+    return JSONResponse(get_services()['asker'].ttft_summary())
+
+
+def cache_stats(request):
+    return JSONResponse(get_services()['asker'].answer_cache.stats())
+
+
+def retrieval_cache_stats(request):
+    return JSONResponse(get_services()['asker'].retrieval_cache.stats())
+
+
+def pool_stats(request):
+    return JSONResponse(pool_metrics())
+
+
+def metrics_page(request):
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+def ready(request):
+    # Starts warming up on the first call; 503 until the services are set up.
+    if 'asker' in services:
+        return JSONResponse({
+            "ready": True,
+            "startup_seconds": request.app.state.startup_seconds,
+            "warm_up_seconds": services['warm_up_seconds']
+        })
+    warm_up()
+    return JSONResponse({"ready": False, "error": services.get('error')}, status_code=503)
+
+
+def list_logs(request):
+    return JSONResponse(get_services()['logger'].get_entries())
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Start setting up the services without holding up the worker's startup.
+    warm_up()
+    yield
+
+
+def create_app():
+    app = Starlette(
+        routes=[
+            Route('/', home),
+            Route('/chat', chat, methods=['POST']),
+            Route('/chat_stream', chat_stream, methods=['POST']),
+            Route('/stream_stats', stream_stats),
+            Route('/cache_stats', cache_stats),
+            Route('/retrieval_cache_stats', retrieval_cache_stats),
+            Route('/pool_stats', pool_stats),
+            Route('/metrics', metrics_page),
+            Route('/ready', ready),
+            Route('/list_logs', list_logs),
+            Mount('/static', StaticFiles(directory='static'), name='static'),
+        ],
+        middleware=[
+            Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+            Middleware(SessionMiddleware, secret_key=os.getenv('SHELLBOT_SECRET_KEY', os.urandom(24).hex())),
+        ],
+        lifespan=lifespan,
+    )
+    # Conversation histories, shared by all workers through a sqlite file
+    app.state.sessions = SessionStore()
+    app.state.startup_seconds = time.perf_counter() - started
+    return app
+
+
+app = create_app()
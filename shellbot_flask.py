@@ -3,87 +3,147 @@ shellbot_flask.py:
 Runs a Flask-powered chatbot that answers questions using embeddings
 extracted from Sheldon Rampton's social media and emails.
 
+Nothing connects to OpenAI, Pinecone or Postgres until it is first needed,
+so creating the app is quick and opens no sockets. That makes it safe to
+preload in gunicorn, where workers then start by forking. /ready warms the
+services up and answers 200 once they can serve questions.
+
 To run:
 flask --app shellbot_flask run
+or
+gunicorn --preload --workers 4 'shellbot_flask:create_app()'
 """
 
-from flask import Flask, request, jsonify, session, render_template
+import time
+started = time.perf_counter()
+
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, session, render_template, stream_with_context
 from flask_session import Session  # Import Flask-Session
 from openai import OpenAI # for calling the OpenAI API
 from social_data import SocialData
-from chatbotter import Asker, ConversationLogger
+from chatbotter import Asker, AnswerCache, CompletionCache, ConversationHistory, ConversationLogger, RetrievalCache, SessionStore, metrics, pool_metrics
 from flask_cors import CORS
 import os
+import json
+import collections
+import threading
 from datetime import datetime
 
 
-# In-memory storage for session data and logs
-session_data = {}
-user_logs = []
-
-openai_client = OpenAI(
-  organization='org-M7JuSsksoyQIdQOGaTgA2wkk',
-  project='proj_E0H6uUDUEkSZfn0jdmqy206G',
-)
-sd = SocialData(
-    openai_client,
-    knowledge_db_name = 'shellbot_knowledge',
-    pinecone_index_name = "shellbot-embeddings2",
-)
-sd.setup_pinecone()
-
-asker = Asker(openai_client, storage = sd,
-    introduction = 'Use the below messages which were written by Sheldon Rampton to answer questions as though you are Sheldon Rampton. If the answer cannot be found in the articles, write "I could not find an answer."',
-    string_divider = 'Messages:'
-)
-logger = ConversationLogger()
-
-app = Flask(__name__)
-CORS(app)
-app.secret_key = os.urandom(24)  # Secret key for session management
-app.config['SESSION_TYPE'] = 'filesystem'  # You can also use 'redis', 'mongodb', etc.
-app.config['SESSION_PERMANENT'] = False  # Session won't be permanent
-Session(app)
-
-@app.route("/")
+# This worker's most recent log entries; the full log is in Postgres
+user_logs = collections.deque(maxlen=1000)
+
+# The Asker and the conversation logger, once set up
+services = {}
+services_lock = threading.Lock()
+warm_up_pid = None
+
+bp = Blueprint('shellbot', __name__)
+
+
+def get_services() -> dict:
+    """Sets up the clients, the vector store and the logger on first use."""
+    if 'asker' not in services:
+        with services_lock:
+            if 'asker' not in services:
+                start = time.perf_counter()
+                openai_client = OpenAI(
+                  organization='org-M7JuSsksoyQIdQOGaTgA2wkk',
+                  project='proj_E0H6uUDUEkSZfn0jdmqy206G',
+                )
+                sd = SocialData(
+                    openai_client,
+                    knowledge_db_name = 'shellbot_knowledge',
+                    pinecone_index_name = "shellbot-embeddings2",
+                    vector_store = os.getenv('SHELLBOT_VECTOR_STORE', 'pinecone'),
+                    auto_filter = True,
+                )
+                if sd.vector_store == 'pgvector':
+                    sd.setup_pgvector()
+                else:
+                    sd.setup_pinecone()
+                services['logger'] = ConversationLogger(write_behind = True)
+                services['asker'] = Asker(openai_client, storage = sd,
+                    introduction = 'Use the below messages which were written by Sheldon Rampton to answer questions as though you are Sheldon Rampton. If the answer cannot be found in the articles, write "I could not find an answer."',
+                    string_divider = 'Messages:',
+                    answer_cache = AnswerCache(),
+                    completion_cache = CompletionCache(),
+                    retrieval_cache = RetrievalCache()
+                )
+                services['warm_up_seconds'] = time.perf_counter() - start
+    return services
+
+
+def get_sessions() -> SessionStore:
+    """Conversation histories, shared by all workers through a sqlite file."""
+    return current_app.extensions['shellbot_sessions']
+
+
+def warm_up():
+    """Sets up the services in the background, once per worker process."""
+    global warm_up_pid
+    with services_lock:
+        if warm_up_pid == os.getpid():
+            return
+        warm_up_pid = os.getpid()
+
+    def run():
+        global warm_up_pid
+        try:
+            get_services()
+        except Exception as e:
+            services['error'] = repr(e)
+            print(f"Warm-up failed: {e}")
+            warm_up_pid = None  # let the next /ready try again
+
+    threading.Thread(target=run, name="shellbot warm-up", daemon=True).start()
+
+
+def create_app():
+    app = Flask(__name__)
+    CORS(app)
+    app.secret_key = os.getenv('SHELLBOT_SECRET_KEY', os.urandom(24).hex())  # Secret key for session management
+    app.config['SESSION_TYPE'] = 'filesystem'  # You can also use 'redis', 'mongodb', etc.
+    app.config['SESSION_PERMANENT'] = False  # Session won't be permanent
+    Session(app)
+    app.extensions['shellbot_sessions'] = SessionStore()
+    app.register_blueprint(bp)
+    app.config['STARTUP_SECONDS'] = time.perf_counter() - started
+    return app
+
+def new_session():
+    session.clear()  # This clears the session data on the server
+    session_id = os.urandom(16).hex()
+    session['session_id'] = session_id
+    conversation_history = ConversationHistory(session_id=session_id)
+    get_sessions().save(session_id, conversation_history)  # Initialize conversation history
+    print(f"New session initialized: {session_id}")
+    return session_id, conversation_history
+
+@bp.route("/")
 def home():
     if 'session_id' not in session:
-        session.clear()  # This clears the session data on the server
-        session_id = os.urandom(16).hex()
-        session['session_id'] = session_id
-        session_data[session_id] = []  # Initialize conversation history
-        print(f"New session initialized: {session_id}")
+        new_session()
     return render_template('index.html')
 
-@app.route('/chat', methods=['POST'])
+@bp.route('/chat', methods=['POST'])
 def chat():
-    # Check if the session ID exists
+    # Retrieve conversation history
     session_id = session.get('session_id')
-    
-    if not session_id or session_id not in session_data:
-        # If no session ID or session ID is not in the session_data, reinitialize
-        session.clear()  # This clears the session data on the server
-        session_id = os.urandom(16).hex()
-        session['session_id'] = session_id
-        session_data[session_id] = []  # Initialize conversation history
-        print(f"New session initialized: {session_id}")
+    conversation_history = get_sessions().get(session_id)
+    if conversation_history is None:
+        # No session, or it has expired, so reinitialize
+        session_id, conversation_history = new_session()
     
     user_input = request.json.get('message')
-    # Retrieve conversation history
-    conversation_history = session_data[session_id]
+    asker = get_services()['asker']
     bot_response, references, articles = asker.ask(user_input, conversation_history = conversation_history)
     if bot_response == "I could not find an answer.":
-        session.clear()  # This clears the session data on the server
-        session_id = os.urandom(16).hex()
-        session['session_id'] = session_id
-        session_data[session_id] = []  # Initialize conversation history
-        print(f"New session initialized: {session_id}")
+        session_id, conversation_history = new_session()
         bot_response, references, articles = asker.ask(user_input, conversation_history = conversation_history)
 
-    conversation_history.append({"role": "user", "content": user_input})
-
-    # Append bot response to the conversation history
-    conversation_history.append({"role": "assistant", "content": bot_response})
+    # ask has added the question and answer to the conversation history
+    get_sessions().save(session_id, conversation_history)
 
     # Log the conversation (if necessary)
     log_entry = {
@@ -93,19 +153,102 @@ def chat():
         "bot_response": bot_response
     }
     user_logs.append(log_entry)
-    logger.post_entry(log_entry)
+    get_services()['logger'].post_entry(log_entry)
 
     return jsonify({"response": bot_response})
 
-@app.route('/get_logs', methods=['GET'])
+@bp.route('/chat_stream', methods=['POST'])
+def chat_stream():
+    """
+    Streams the answer as Server-Sent Events: a "delta" event per chunk of
+    text, then a "done" event with the references. The conversation is
+    logged once the stream has finished. Unlike /chat, an "I could not find
+    an answer." reply is not retried in a new session, since it has already
+    been sent by the time it is complete.
+    """
+    # The session has to be settled before streaming starts, because the
+    # session cookie goes out with the response headers.
+    sessions = get_sessions()
+    session_id = session.get('session_id')
+    conversation_history = sessions.get(session_id)
+    if conversation_history is None:
+        session_id, conversation_history = new_session()
+
+    user_input = request.json.get('message')
+    asker = get_services()['asker']
+    logger = get_services()['logger']
+
+    def generate():
+        for event in asker.ask_stream(user_input, conversation_history = conversation_history):
+            if event["type"] == "done":
+                bot_response = event["response"]
+                yield f"event: done\ndata: {json.dumps({'references': event['references'], 'ttft': event['ttft']})}\n\n"
+            else:
+                yield f"data: {json.dumps({'content': event['content']})}\n\n"
+
+        # ask_stream has added the question and answer to the conversation history
+        sessions.save(session_id, conversation_history)
+        log_entry = {
+            "session_id": session_id,
+            "timestamp": datetime.now().isoformat(),
+            "user_input": user_input,
+            "bot_response": bot_response
+        }
+        user_logs.append(log_entry)
+        logger.post_entry(log_entry)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/stream_stats', methods=['GET'])
+def stream_stats():
+    # Time to first token of recent streamed answers, in seconds.
+    return jsonify(get_services()['asker'].ttft_summary())
+
+@bp.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    # Hit rate of this worker's answer cache.
+    return jsonify(get_services()['asker'].answer_cache.stats())
+
+@bp.route('/retrieval_cache_stats', methods=['GET'])
+def retrieval_cache_stats():
+    # How often this worker reused or extended a conversation's previous matches,
+    # and the retrieval time that saved.
+    return jsonify(get_services()['asker'].retrieval_cache.stats())
+
+@bp.route('/pool_stats', methods=['GET'])
+def pool_stats():
+    # Postgres connection pool checkouts and wait times for this worker.
+    return jsonify(pool_metrics())
+
+@bp.route('/metrics', methods=['GET'])
+def metrics_page():
+    # Stage latency histograms, cache counters and pool gauges, for Prometheus to scrape.
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/ready', methods=['GET'])
+def ready():
+    # Starts warming up on the first call; 503 until the services are set up.
+    if 'asker' in services:
+        return jsonify({
+            "ready": True,
+            "startup_seconds": current_app.config['STARTUP_SECONDS'],
+            "warm_up_seconds": services['warm_up_seconds']
+        })
+    warm_up()
+    return jsonify({"ready": False, "error": services.get('error')}), 503
+
+@bp.route('/get_logs', methods=['GET'])
 def get_logs():
-    return jsonify(user_logs)
+    return jsonify(list(user_logs))
 
-@app.route('/list_logs', methods=['GET'])
+@bp.route('/list_logs', methods=['GET'])
 def list_logs():
-    logs = logger.get_entries()
+    logs = get_services()['logger'].get_entries()
     return jsonify(logs)
 
 
+app = create_app()
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,5 +1,7 @@
 from openai import OpenAI # for calling the OpenAI API
+import calendar
 import datetime
+import math
 import re
 from bs4 import BeautifulSoup
 import os
@@ -7,7 +9,10 @@ import pandas as pd
 import tiktoken  # for counting tokens
 from itertools import islice
 from pinecone import Pinecone, ServerlessSpec
-from chatbotter import BatchGenerator, Asker
+from chatbotter import (BatchGenerator, Asker, ContentCompressor, EmbeddingEngine, pack_content_metadata,
+    unpack_content_metadata, truncate_embedding, rerank_matches, mmr_matches, shared_pool,
+    embedding_dimensions, cached_index_host, save_index_host, PineconeIndex, stage_timer)
+import numpy as np
 import warnings
 import hashlib
 import time
@@ -47,7 +52,61 @@ sanitizations = [
     "adultfriendfinder"
 ]
 
+def pgvector_literal(embedding) -> str:
+    """Formats an embedding as a pgvector literal, for use with %s::vector."""
+    return "[" + ",".join(f"{float(x):.8g}" for x in embedding) + "]"
+
+
+# Knowledge table columns that are also stored as Pinecone metadata, and so can be filtered on.
+FILTER_COLUMNS = ('platform', 'unix_timestamp', 'title')
+SQL_OPERATORS = {"$eq": "=", "$ne": "<>", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+# Words that refer to the same platform, mapped to one name. Both the words
+# of a question and the platform names in the knowledge table ("Tweet",
+# "Twitter") go through this map before they are compared.
+PLATFORM_WORDS = {
+    "tweet": "twitter", "tweets": "twitter", "tweeted": "twitter", "tweeting": "twitter",
+    "retweet": "twitter", "retweets": "twitter",
+    "emails": "email", "emailed": "email", "mail": "email", "gmail": "email",
+}
+MONTHS = {name.lower(): number for number, name in enumerate(calendar.month_name) if name}
+MONTHS.update({name.lower(): number for number, name in enumerate(calendar.month_abbr) if name})
+
+
+def filter_to_sql(filter: dict) -> tuple[str, list]:
+    """
+    Translates a Pinecone metadata filter on the knowledge table's
+    FILTER_COLUMNS into a SQL condition with %s placeholders, and its parameters.
+    """
+    conditions, params = [], []
+    for key, condition in filter.items():
+        if key in ("$and", "$or"):
+            parts = [filter_to_sql(f) for f in condition]
+            if parts:
+                conditions.append("(" + (" AND " if key == "$and" else " OR ").join(p[0] for p in parts) + ")")
+                params += [param for p in parts for param in p[1]]
+            continue
+        if key not in FILTER_COLUMNS:
+            raise ValueError(f"Can't filter on {key}; filterable fields are {', '.join(FILTER_COLUMNS)}")
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, operand in condition.items():
+            if op in ("$in", "$nin"):
+                conditions.append(f"{'NOT ' if op == '$nin' else ''}{key} = ANY(%s)")
+                params.append(list(operand))
+            elif op in SQL_OPERATORS:
+                conditions.append(f"{key} {SQL_OPERATORS[op]} %s")
+                params.append(operand)
+            else:
+                raise ValueError(f"Unsupported filter operator {op}")
+    return " AND ".join(conditions) or "TRUE", params
+
+
 class SocialData:
+    # corpus_version() reads the stored version at most this often, in seconds.
+    corpus_version_ttl = 30
+    corpus_version_cache = None
+    corpus_version_checked = 0
+
     def __init__(self,
         openai_client,
         batch_size = 1000,
@@ -65,6 +124,17 @@ class SocialData:
         gpt_model: str = "gpt-4o",  # selects which tokenizer to use
         pinecone_index_name = "shellbot-embeddings2",
         overwrite_pinecone = False,
+        vector_store = "pinecone",
+        pgvector_index = "hnsw",
+        metadata_content = False,
+        compress_content = False,
+        dimensions: int = None,
+        rerank = False,
+        rerank_multiplier: int = 4,
+        mmr = False,
+        mmr_lambda: float = 0.7,
+        auto_filter = False,
+        embedding_concurrency: int = 8,
         limit = 0,
         debug = False
     ) -> None:
@@ -86,100 +156,278 @@ class SocialData:
         self.gpt_model = gpt_model
         self.pinecone_index_name = pinecone_index_name
         self.overwrite_pinecone = overwrite_pinecone
+        # "pinecone" or "pgvector". With pgvector the embedding lives in the
+        # knowledge table itself and one SQL query does both the similarity
+        # search and the hydration.
+        self.vector_store = vector_store
+        # IVFFlat clusters the rows already there, so its index is built by
+        # backfill_pgvector, upsert_data and ingest rather than setup_pgvector.
+        self.pgvector_index = pgvector_index
+        self.ivfflat_index_lists = None
+        # When True, message text is stored as Pinecone metadata and returned
+        # with each match, so queries skip the per-id Postgres lookup.
+        self.metadata_content = metadata_content
+        # When True, message text is stored zstd-compressed in content_z
+        # using a dictionary trained on the corpus.
+        self.compress_content = compress_content
+        self.compressor = None
+        self.content_z_column = None
+        self.full_embedding_column = None
+        self.metadata_db_name = knowledge_db_name + '_metadata'
+        # Reduced embedding size for the Pinecone index (None for the model's
+        # full size). With rerank, a shortlist of rerank_multiplier * top_n
+        # matches is rescored against full-size vectors kept in Postgres.
+        self.dimensions = dimensions
+        self.rerank = rerank
+        self.rerank_multiplier = rerank_multiplier
+        # With mmr, matches are reordered by Maximal Marginal Relevance, so
+        # the same email quoted in several replies doesn't crowd out other
+        # messages; mmr_lambda trades relevance (1) against diversity (0).
+        self.mmr = mmr
+        self.mmr_lambda = mmr_lambda
+        # With auto_filter, questions that name a platform or a date ("what
+        # did you tweet about tennis in 2019") are searched with a matching
+        # metadata filter; see extract_filter.
+        self.auto_filter = auto_filter
+        self.platform_names = None
+        self.pgvector_extension_version = None
+        # fetch_data embeds messages in token-packed requests, this many at a time.
+        self.embedding_concurrency = embedding_concurrency
         # self.overwrite_db = overwrite_db
         self.debug = debug
         self.limit = limit
   
     def database_connection(self):
-        conn = psycopg2.connect(
+        # conn.close() hands the connection back to the shared pool.
+        conn = shared_pool(
             dbname=self.logs_database_name,
             user=self.logs_user,
             password=self.logs_password,
             host=self.db_host,
             port=self.db_port,
             sslmode='allow'
-        )
+        ).connection()
         cur = conn.cursor()
         return conn, cur
 
-    def fetch_data(self):
+    def setup_compression(self):
         """
-        Retrieves the contents of the social_media and gmail databases
-        and combines them into a single 
+        Adds the content_z column to the knowledge table and creates the
+        table that holds the compression dictionary, if they don't exist yet.
         """
+        conn, cur = self.database_connection()
+        cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS content_z BYTEA").format(
+            sql.Identifier(self.knowledge_db_name)))
+        conn.commit()
+        conn.close()
+        self.setup_metadata()
+        self.content_z_column = True
 
-        # Connect to the Postgres databases
+    def setup_metadata(self):
+        """Creates the key/value table for the compression dictionary and corpus version."""
         conn, cur = self.database_connection()
-        
-        # SQL query for SocialPosts table
-        query_social = f"""
-        SELECT 'social' AS source, id, platform, platform_id AS title,
-        CAST(timestamp AS INTEGER) AS unix_timestamp, content, url
-        FROM {self.social_db_name}
-        """
-        if self.limit > 0:
-            query_social += " LIMIT " + str(self.limit)
-        # Execute the queries
-        cur.execute(query_social)  # Execute the query
-        social_results = cur.fetchall()  # Fetch all the results
-        # Load the results into a Pandas DataFrame
-        df_social = pd.DataFrame(social_results, columns=[
-            'source', 'id', 'platform', 'title', 'unix_timestamp',
-            'content', 'url'
-        ])
-        df_social['content'] = df_social.apply(lambda row: row['url'] if row['content'] == '' else row['content'], axis=1)
-        df_social['title'] = df_social['content'].apply(lambda x: x.split('\n')[0])
-        df_social['title'] = df_social['title'].apply(lambda x: self.truncated_string(x, max_tokens=30))
-
-        # SQL query for GmailMessages table
-        query_gmail = f"""
-        SELECT 'gmail' AS source, id, 'Email' as platform, subject as title,
-        CAST(timestamp AS INTEGER) AS unix_timestamp,
-        message as content, from_email, to_emails 
-        FROM {self.gmail_db_name} 
-        """
-        if self.limit > 0:
-            query_gmail += " LIMIT " + str(self.limit)
-        cur.execute(query_gmail)  # Execute the query
-        gmail_results = cur.fetchall()  # Fetch all the results
-        # Load the results into a Pandas DataFrame
-        df_gmail = pd.DataFrame(gmail_results, columns=[
-            'source', 'id', 'platform', 'title', 'unix_timestamp',
-            'content', 'from_email', 'to_emails'
-        ])
-        df_gmail = df_gmail[~df_gmail['content'].isin(self.sanitizations)]
-        pattern = '|'.join(self.sanitizations)
-        # Remove rows where the "content" column contains any of the strings in the list
-        df_gmail = df_gmail[~df_gmail['content'].str.contains(pattern, na=False)]
-
-        # Combine 'from_email' and 'to_emails' into a single column named 'url'
-        df_gmail['url'] = df_gmail['from_email'] + ', ' + df_gmail['to_emails']
-        # Drop the original 'from_email' and 'to_emails' columns as they are no longer needed
-        df_gmail = df_gmail.drop(columns=['from_email', 'to_emails'])
-
-        # # Now df has the combined 'participants' column
-        df_combined = pd.concat([df_gmail, df_social], ignore_index=True)
-
-        df_combined['datetime'] = df_combined['unix_timestamp'].apply(self.format_timestamp)
-        df_combined['title'] = df_combined['datetime'] + " " + df_combined['platform'] + ": " + df_combined['title']
-
-        # Close the database connections
+        cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value BYTEA)").format(
+            sql.Identifier(self.metadata_db_name)))
+        conn.commit()
         conn.close()
-        
-        df = df_combined.sort_values(by='unix_timestamp', ascending=True)
-        # Remove duplicate content
-        df = df.drop_duplicates(subset='content', keep='first')
 
-        # Apply cleanup_email() to 'content' column where 'platform' is "Email"
-        df.loc[df['platform'] == 'Email', 'content'] = df.loc[df['platform'] == 'Email', 'content'].apply(self.cleanup_email)
+    def corpus_version(self) -> str:
+        """
+        Identifies the data loaded into the knowledge table, for caches of
+        answers drawn from it. upsert_data changes it, and other processes
+        see the change within corpus_version_ttl seconds.
+        """
+        if time.monotonic() - self.corpus_version_checked > self.corpus_version_ttl:
+            conn, cur = self.database_connection()
+            try:
+                cur.execute(sql.SQL("SELECT value FROM {} WHERE key = 'corpus_version'").format(
+                    sql.Identifier(self.metadata_db_name)))
+                row = cur.fetchone()
+            except psycopg2.Error:
+                row = None  # no metadata table yet
+            conn.close()
+            self.corpus_version_cache = bytes(row[0]).decode('utf-8') if row else ""
+            self.corpus_version_checked = time.monotonic()
+        return self.corpus_version_cache
+
+    def bump_corpus_version(self):
+        version = str(time.time_ns())
+        self.setup_metadata()
+        conn, cur = self.database_connection()
+        cur.execute(sql.SQL('''
+            INSERT INTO {} (key, value) VALUES ('corpus_version', %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+        ''').format(sql.Identifier(self.metadata_db_name)), (version.encode('utf-8'), ))
+        conn.commit()
+        conn.close()
+        self.corpus_version_cache = version
+        self.corpus_version_checked = time.monotonic()
+
+    def get_compressor(self, samples = None):
+        """
+        Returns the ContentCompressor for the knowledge table, loading its
+        dictionary from Postgres. If there is none yet and samples are given,
+        a new dictionary is trained on them and saved.
+        """
+        if self.compressor is not None:
+            return self.compressor
+        conn, cur = self.database_connection()
+        try:
+            cur.execute(sql.SQL("SELECT value FROM {} WHERE key = 'zstd_dictionary'").format(
+                sql.Identifier(self.metadata_db_name)))
+            row = cur.fetchone()
+        except psycopg2.Error:
+            conn.rollback()
+            row = None  # no metadata table, so nothing was ever compressed
+        if row is not None:
+            self.compressor = ContentCompressor(bytes(row[0]) if row[0] else None)
+        elif samples is not None:
+            self.compressor = ContentCompressor.train(samples)
+            cur.execute(sql.SQL('''
+                INSERT INTO {} (key, value) VALUES ('zstd_dictionary', %s)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+            ''').format(sql.Identifier(self.metadata_db_name)), (self.compressor.dictionary, ))
+            conn.commit()
+        conn.close()
+        return self.compressor
+
+    def compress_knowledge_table(self):
+        """
+        Compresses the content of every row already in the knowledge table
+        with a dictionary trained on that content.
+        """
+        self.compress_content = True
+        self.setup_compression()
+        conn, cur = self.database_connection()
+        cur.execute(sql.SQL("SELECT vector_id, content FROM {} WHERE content IS NOT NULL").format(
+            sql.Identifier(self.knowledge_db_name)))
+        rows = cur.fetchall()
+        compressor = self.get_compressor(samples=[content for vector_id, content in rows])
+        cur.executemany(sql.SQL("UPDATE {} SET content = NULL, content_z = %s WHERE vector_id = %s").format(
+            sql.Identifier(self.knowledge_db_name)),
+            [(compressor.compress(content), vector_id) for vector_id, content in rows])
+        conn.commit()
+        conn.close()
+        if self.debug:
+            print(f"Compressed {len(rows)} rows in {self.knowledge_db_name}.")
+
+    def source_query(self) -> tuple[str, list]:
+        """
+        Returns the SQL, and its parameters, that reads the social_media and
+        gmail tables as one stream of messages, oldest first. The steps that
+        need the whole corpus are done by Postgres: emails containing any of
+        the sanitizations are left out, and of messages with the same
+        content only the oldest is kept.
+        """
+        limit = f" LIMIT {int(self.limit)}" if self.limit > 0 else ""
+        params = []
+        where = ""
+        if self.sanitizations:
+            where = " WHERE COALESCE(message, '') !~ %s"
+            params.append('|'.join(self.sanitizations))
+        query = f"""
+        SELECT platform, title, unix_timestamp, content, url FROM (
+            SELECT DISTINCT ON (content) platform, title, unix_timestamp, content, url FROM (
+                (SELECT platform, platform_id AS title,
+                CAST(timestamp AS INTEGER) AS unix_timestamp,
+                CASE WHEN content = '' THEN url ELSE content END AS content, url
+                FROM {self.social_db_name}{limit})
+                UNION ALL
+                (SELECT 'Email' AS platform, subject AS title,
+                CAST(timestamp AS INTEGER) AS unix_timestamp,
+                message AS content, from_email || ', ' || to_emails AS url
+                FROM {self.gmail_db_name}{where}{limit})
+            ) AS messages
+            ORDER BY content, unix_timestamp
+        ) AS distinct_messages
+        ORDER BY unix_timestamp
+        """
+        return query, params
+
+    def source_batches(self, batch_size: int = None):
+        """
+        Yields the messages from source_query as DataFrames of up to
+        batch_size rows (the instance's batch_size by default). They are
+        read through a named, server-side cursor, so only one page is held
+        in memory at a time however large the mailbox is.
+        """
+        batch_size = batch_size or self.batch_size
+        query, params = self.source_query()
+        conn, cur = self.database_connection()
+        cur.close()
+        try:
+            with conn.cursor(name=f"{self.knowledge_db_name}_source") as cur:
+                cur.itersize = batch_size
+                cur.execute(query, params)
+                while rows := cur.fetchmany(batch_size):
+                    yield pd.DataFrame(rows, columns=['platform', 'title', 'unix_timestamp', 'content', 'url'])
+        finally:
+            conn.close()
+
+    def clean_batch(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Titles, cleans and truncates a batch of messages from source_batches.
+        Social posts are titled by their first line, emails by their subject.
+        """
+        social = df['platform'] != 'Email'
+        df.loc[social, 'title'] = df.loc[social, 'content'].apply(
+            lambda x: self.truncated_string(x.split('\n')[0], max_tokens=30))
+        df['datetime'] = df['unix_timestamp'].apply(self.format_timestamp)
+        df['title'] = df['datetime'] + " " + df['platform'] + ": " + df['title']
+        df.loc[~social, 'content'] = df.loc[~social, 'content'].apply(self.cleanup_email)
         df['content'] = df['content'].apply(lambda x: self.truncated_string(x))
         df['url'] = df['url'].fillna('')
         df['title'] = df['title'].fillna('No title')
-        df["embedding"] = df.apply(lambda row: self.openai_client.embeddings.create(model=self.embedding_model, input=row['content']).data[0].embedding, axis=1)
+        return df
+
+    def embed_batch(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Adds the embedding and vector_id columns to a cleaned batch."""
+        extra_args = {}
+        if self.dimensions and not self.rerank:
+            extra_args['dimensions'] = self.dimensions
+        df["embedding"] = self.embedding_engine().embed(df['content'], **extra_args)
         df["vector_id"] = df.apply(lambda row: self.generate_vector_id(str(row['title']) + str(row['content'])), axis=1)
-        self.df = df.drop(columns=['source', 'id'])
         return df
 
+    def fetch_data(self):
+        """
+        Retrieves the contents of the social_media and gmail databases,
+        cleans and embeds them, and combines them into a single DataFrame
+        in self.df for upsert_data. This holds the whole corpus in memory;
+        ingest does the same work a batch at a time.
+        """
+        batches = [self.embed_batch(self.clean_batch(df)) for df in self.source_batches()]
+        if batches:
+            self.df = pd.concat(batches, ignore_index=True)
+        else:
+            self.df = pd.DataFrame(columns=['platform', 'title', 'unix_timestamp', 'content', 'url',
+                'datetime', 'embedding', 'vector_id'])
+        return self.df
+
+    def ingest(self, batch_size: int = None) -> int:
+        """
+        Streams the social_media and gmail databases into the knowledge
+        table and vector store. Each batch of batch_size messages is read,
+        cleaned, embedded and stored before the next is read, so peak
+        memory depends on the batch size, not the size of the mailbox.
+        With compress_content and no dictionary yet, one is trained on the
+        first batch. Returns the number of messages stored.
+        """
+        if self.compress_content:
+            self.setup_compression()
+        count = 0
+        for df in self.source_batches(batch_size):
+            df = self.embed_batch(self.clean_batch(df))
+            if self.compress_content:
+                self.get_compressor(samples=list(df.content))
+            self.store_batch(df)
+            count += len(df)
+            if self.debug:
+                print(f"Stored {count} messages.")
+        self.build_ivfflat_index()
+        self.bump_corpus_version()
+        return count
+
     def is_html(self, content):
         """
         Returns true of the content is HTML, false otherwise.
@@ -345,7 +593,7 @@ class SocialData:
 
     def compile_embeddings(self, strings, df):
         embeddings = []
-        df["embedding"] = df.apply(lambda row: self.openai_client.embeddings.create(row['text']), axis=1)
+        df["embedding"] = self.embedding_engine().embed(df['text'])
         df["vector_id"] = df.apply(lambda row: self.generate_vector_id(row['title'] + row['text']), axis=1)
 
         if self.debug:
@@ -362,63 +610,293 @@ class SocialData:
         # Check whether the index with the same name already exists - if so, delete it
         pinecone_api_key = os.environ.get('PINECONE_API_KEY')
         pinecone = Pinecone(api_key=pinecone_api_key)
-        if self.pinecone_index_name in pinecone.list_indexes() and self.overwrite_pinecone:
-            pinecone.delete_index(self.pinecone_index_name)
-
-        # Creates index if it doesn't already exist.
-        if self.pinecone_index_name not in pinecone.list_indexes().names():
-            # if does not exist, create index
-            spec = ServerlessSpec(
-                cloud="aws",
-                region="us-east-1"
-            )
-            # Calculate length of embedding based on the embedding model.
-            response = self.openai_client.embeddings.create(
-              input="Hello!",
-              model=self.embedding_model
-            )
-            embedding_length = len(response.data[0].embedding)
-            pinecone.create_index(
-                self.pinecone_index_name,
-                dimension=embedding_length,
-                metric='cosine',
-                spec=spec
-            )
-            # wait for index to be initialized
-            while not pinecone.describe_index(self.pinecone_index_name).status['ready']:
-                time.sleep(1)
+        # A known index host means the index exists; skip the control plane.
+        host = None if self.overwrite_pinecone else cached_index_host(self.pinecone_index_name)
+        if host is None:
+            index_names = pinecone.list_indexes().names()
+            if self.pinecone_index_name in index_names and self.overwrite_pinecone:
+                pinecone.delete_index(self.pinecone_index_name)
+                index_names.remove(self.pinecone_index_name)
+
+            # Creates index if it doesn't already exist.
+            if self.pinecone_index_name not in index_names:
+                # if does not exist, create index
+                spec = ServerlessSpec(
+                    cloud="aws",
+                    region="us-east-1"
+                )
+                embedding_length = self.embedding_length()
+                pinecone.create_index(
+                    self.pinecone_index_name,
+                    dimension=embedding_length,
+                    metric='cosine',
+                    spec=spec
+                )
+                # wait for index to be initialized
+                while not pinecone.describe_index(self.pinecone_index_name).status['ready']:
+                    time.sleep(1)
+            host = pinecone.describe_index(self.pinecone_index_name).host
+            save_index_host(self.pinecone_index_name, host)
 
         # connect to index
-        self.pinecone_index = pinecone.Index(self.pinecone_index_name)
-        time.sleep(1)
+        self.pinecone_index = PineconeIndex(pinecone, self.pinecone_index_name, host)
         if self.debug:
             # view index stats
             print(self.pinecone_index.describe_index_stats())
             # Confirm our index was created
             print(pinecone.list_indexes())
 
+    def embedding_length(self) -> int:
+        return embedding_dimensions(self.openai_client, self.embedding_model, self.dimensions)
+
+    def setup_pgvector(self):
+        """
+        Sets up the knowledge table for pgvector retrieval: enables the vector
+        extension, adds an embedding column and builds an HNSW cosine index
+        on it, plus a b-tree index on platform and timestamp for filtered
+        queries. With pgvector_index = "ivfflat" the vector index is left to
+        build_ivfflat_index, once there is data to cluster. Use this instead
+        of setup_pinecone when vector_store is "pgvector".
+        """
+        conn, cur = self.database_connection()
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS embedding vector({})").format(
+            sql.Identifier(self.knowledge_db_name), sql.Literal(self.embedding_length())))
+        if self.pgvector_index != "ivfflat":
+            cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING hnsw (embedding vector_cosine_ops)").format(
+                sql.Identifier(self.knowledge_db_name + '_embedding_idx'),
+                sql.Identifier(self.knowledge_db_name)))
+        # With a selective platform or date filter, Postgres can find the few
+        # matching rows through this index and rank just those exactly.
+        cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} (platform, unix_timestamp)").format(
+            sql.Identifier(self.knowledge_db_name + '_platform_timestamp_idx'),
+            sql.Identifier(self.knowledge_db_name)))
+        conn.commit()
+        conn.close()
+
+    def build_ivfflat_index(self):
+        """
+        (Re)builds the IVFFlat index over the embeddings now in the knowledge
+        table, with pgvector's suggested number of lists: rows / 1000, or
+        sqrt(rows) past a million rows. Does nothing unless pgvector_index
+        is "ivfflat" or there are no embeddings yet.
+        """
+        if self.vector_store != "pgvector" or self.pgvector_index != "ivfflat":
+            return
+        conn, cur = self.database_connection()
+        cur.execute(sql.SQL("SELECT count(*) FROM {} WHERE embedding IS NOT NULL").format(
+            sql.Identifier(self.knowledge_db_name)))
+        rows = cur.fetchone()[0]
+        if rows == 0:
+            conn.close()
+            return
+        lists = max(1, rows // 1000 if rows <= 1000000 else int(rows ** 0.5))
+        index = sql.Identifier(self.knowledge_db_name + '_embedding_idx')
+        cur.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(index))
+        cur.execute(sql.SQL("CREATE INDEX {} ON {} USING ivfflat (embedding vector_cosine_ops) WITH (lists = {})").format(
+            index, sql.Identifier(self.knowledge_db_name), sql.Literal(lists)))
+        conn.commit()
+        conn.close()
+        self.ivfflat_index_lists = lists
+        if self.debug:
+            print(f"Built an IVFFlat index with {lists} lists over {rows} embeddings.")
+
+    def ivfflat_lists(self) -> int:
+        """The number of lists in the IVFFlat index, looked up once; None if there is no index yet."""
+        if self.ivfflat_index_lists is None:
+            conn, cur = self.database_connection()
+            cur.execute("SELECT reloptions FROM pg_class WHERE relname = %s",
+                (self.knowledge_db_name + '_embedding_idx', ))
+            row = cur.fetchone()
+            conn.close()
+            options = dict(option.split('=', 1) for option in (row[0] or [])) if row else {}
+            if 'lists' in options:
+                self.ivfflat_index_lists = int(options['lists'])
+        return self.ivfflat_index_lists
+
+    def pgvector_version(self) -> tuple:
+        """The installed vector extension's version, e.g. (0, 8, 0), looked up once."""
+        if self.pgvector_extension_version is None:
+            conn, cur = self.database_connection()
+            try:
+                cur.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+                row = cur.fetchone()
+            except psycopg2.Error:
+                row = None
+            conn.close()
+            self.pgvector_extension_version = tuple(int(part) for part in re.findall(r"\d+", row[0])) if row else ()
+        return self.pgvector_extension_version
+
+    def search_settings(self, limit: int, filtered: bool) -> list[tuple[str, tuple]]:
+        """
+        The SET LOCAL statements, with their parameters, that let a pgvector
+        query return limit rows. HNSW returns at most ef_search candidates
+        and a WHERE clause is applied to those afterwards, so with a filter
+        pgvector 0.8 and later keep scanning the graph until limit rows
+        match (iterative_scan); older versions get the largest ef_search.
+        IVFFlat searches sqrt(lists) of its lists rather than the default
+        one; with a filter, 0.8 and later scan further lists as needed, and
+        older versions search them all.
+        """
+        if self.pgvector_index == "ivfflat":
+            lists = self.ivfflat_lists() or 1
+            probes = max(1, math.ceil(math.sqrt(lists)))
+            settings = []
+            if filtered:
+                if self.pgvector_version() >= (0, 8):
+                    # IVFFlat only scans iteratively in relaxed order; the rows are re-sorted.
+                    settings.append(("SET LOCAL ivfflat.iterative_scan = relaxed_order", ()))
+                else:
+                    probes = lists
+            settings.append(("SET LOCAL ivfflat.probes = %s", (probes, )))
+            return settings
+        # ef_search defaults to 40 and can't be set above 1000.
+        ef_search = min(max(40, limit), 1000)
+        settings = []
+        if filtered:
+            if self.pgvector_version() >= (0, 8):
+                settings.append(("SET LOCAL hnsw.iterative_scan = strict_order", ()))
+            else:
+                ef_search = 1000
+        settings.append(("SET LOCAL hnsw.ef_search = %s", (ef_search, )))
+        return settings
+
+    def backfill_pgvector(self, batch_size = 100):
+        """
+        Copies embeddings for rows that don't have one yet from the Pinecone
+        index into the embedding column, so an existing knowledge table can
+        switch to pgvector without re-embedding. Needs setup_pinecone first.
+        """
+        conn, cur = self.database_connection()
+        cur.execute(f"SELECT vector_id FROM {self.knowledge_db_name} WHERE embedding IS NULL")
+        vector_ids = [row[0] for row in cur.fetchall()]
+        for start in range(0, len(vector_ids), batch_size):
+            batch = vector_ids[start:start + batch_size]
+            vectors = self.pinecone_index.fetch(ids=batch, namespace='content').vectors
+            cur.executemany(f"UPDATE {self.knowledge_db_name} SET embedding = %s::vector WHERE vector_id = %s",
+                [(pgvector_literal(vector.values), vector_id) for vector_id, vector in vectors.items()])
+            conn.commit()
+            if self.debug:
+                print(f"Backfilled {start + len(batch)} of {len(vector_ids)} embeddings.")
+        conn.close()
+        self.build_ivfflat_index()
+
+    def embedding_engine(self) -> EmbeddingEngine:
+        return EmbeddingEngine(self.openai_client, self.embedding_model,
+            concurrency=self.embedding_concurrency, debug=self.debug)
+
+    def embedding_args(self) -> dict:
+        """
+        Extra embeddings.create arguments for queries: full size when
+        reranking (the vector is shortened locally for the index query),
+        otherwise the index's size.
+        """
+        if self.dimensions and not self.rerank:
+            return {'dimensions': self.dimensions}
+        return {}
+
+    def embed_query(self, query: str) -> list[float]:
+        with stage_timer("embed"):
+            res = self.openai_client.embeddings.create(input=[query], model=self.embedding_model, **self.embedding_args())
+        return res.data[0].embedding
+
+    def index_vector(self, embedding) -> list[float]:
+        """Shortens a full-size embedding to the index's dimensions if needed."""
+        if self.dimensions and len(embedding) > self.dimensions:
+            return truncate_embedding(embedding, self.dimensions)
+        return embedding
+
+    def save_full_embeddings(self, vector_ids, embeddings):
+        """Keeps full-size vectors in the knowledge table for reranking reduced-dimension matches."""
+        conn, cur = self.database_connection()
+        cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS full_embedding BYTEA").format(
+            sql.Identifier(self.knowledge_db_name)))
+        cur.executemany(sql.SQL("UPDATE {} SET full_embedding = %s WHERE vector_id = %s").format(
+            sql.Identifier(self.knowledge_db_name)),
+            [(np.asarray(embedding, dtype=np.float32).tobytes(), vector_id)
+                for vector_id, embedding in zip(vector_ids, embeddings)])
+        conn.commit()
+        conn.close()
+        self.full_embedding_column = True
+
+    def get_full_embeddings(self, unique_ids) -> dict:
+        """Returns a dict mapping each vector_id that has a full-size vector to that vector."""
+        vectors = {}
+        if len(unique_ids) == 0:
+            return vectors
+        conn, cur = self.database_connection()
+        try:
+            cur.execute(f'''
+                SELECT vector_id, full_embedding FROM {self.knowledge_db_name}
+                WHERE vector_id = ANY(%s) AND full_embedding IS NOT NULL
+            ''', (list(unique_ids), ))
+            for vector_id, blob in cur.fetchall():
+                vectors[vector_id] = np.frombuffer(blob, dtype=np.float32)
+        except psycopg2.Error as e:
+            print(f"An error occurred: {e}")
+        conn.close()
+        return vectors
+
     def upsert_data(self):
         # Upsert content vectors in content namespace - this can take a few minutes
         if self.debug:
             print("Uploading vectors to content namespace..")
+        if self.compress_content:
+            self.setup_compression()
+            self.get_compressor(samples=list(self.df.content))
+        self.store_batch(self.df)
+        self.build_ivfflat_index()
+        self.bump_corpus_version()
+        if self.debug:
+            print("Records inserted successfully.")
+            if self.vector_store == "pinecone":
+                # Check index size for each namespace to confirm all of our docs have loaded
+                print(self.pinecone_index.describe_index_stats())
+
+    def store_batch(self, df: pd.DataFrame):
+        """
+        Upserts embedded messages from embed_batch into the vector store and
+        inserts them into the knowledge table, committing once at the end.
+        """
+        if len(df) == 0:
+            return
+        if self.compress_content:
+            compressor = self.get_compressor()
+        columns = ['vector_id', 'platform', 'title', 'unix_timestamp', 'formatted_datetime', 'url',
+            'content_z' if self.compress_content else 'content']
+        placeholders = ['%s'] * len(columns)
+        if self.vector_store == "pgvector":
+            columns.append('embedding')
+            placeholders.append('%s::vector')
+        insert_query = f'''
+        INSERT INTO {self.knowledge_db_name} ({', '.join(columns)})
+        VALUES ({', '.join(placeholders)})
+        '''
         conn, cur = self.database_connection()
         df_batcher = BatchGenerator(200)
-        for batch_df in df_batcher(self.df):
-            self.pinecone_index.upsert(vectors=zip(
-                batch_df.vector_id, batch_df.embedding,
-                [{**a, **b} for a, b in zip(
-                    [{ "title": t } for t in batch_df.title ],
-                    [{ "url": u } for u in batch_df.url ])
-                ]
-            ), namespace='content')
+        for batch_df in df_batcher(df):
+            if self.vector_store == "pinecone":
+                if self.metadata_content:
+                    metadatas = [pack_content_metadata(t, u, x) for t, u, x in zip(
+                        batch_df.title, batch_df.url, batch_df.content)]
+                else:
+                    metadatas = [{**a, **b} for a, b in zip(
+                        [{ "title": t } for t in batch_df.title ],
+                        [{ "url": u } for u in batch_df.url ])
+                    ]
+                for metadata, platform, unix_timestamp in zip(metadatas, batch_df.platform, batch_df.unix_timestamp):
+                    metadata.update(self.filter_metadata(platform, unix_timestamp))
+                self.pinecone_index.upsert(vectors=list(zip(
+                    batch_df.vector_id, [self.index_vector(e) for e in batch_df.embedding], metadatas
+                )), namespace='content')
             for rownum, row in batch_df.iterrows():
+                values = [row['vector_id'], row['platform'], row['title'], row['unix_timestamp'],
+                    row['datetime'], row['url'],
+                    compressor.compress(row['content']) if self.compress_content else row['content']]
+                if self.vector_store == "pgvector":
+                    values.append(pgvector_literal(self.index_vector(row['embedding'])))
                 try:
-                    cur.execute(f'''
-                    INSERT INTO {self.knowledge_db_name} (vector_id, platform, title, unix_timestamp, 
-                    formatted_datetime, content, url)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ''', (row['vector_id'], row['platform'], row['title'], row['unix_timestamp'],
-                    row['datetime'], row['content'], row['url']))
+                    cur.execute(insert_query, values)
                     if self.debug:
                         print("Inserted row ", rownum, row['vector_id'], row['title'])
                 except psycopg2.Error as e:
@@ -426,24 +904,117 @@ class SocialData:
                     print(row)
         conn.commit()
         conn.close()
-        if self.debug:
-            print("Records inserted successfully.")
-            # Check index size for each namespace to confirm all of our docs have loaded
-            print(self.pinecone_index.describe_index_stats())
+        if self.dimensions and len(df.embedding.iloc[0]) > self.dimensions:
+            # Full-size vectors were embedded; keep them for reranking.
+            self.save_full_embeddings(df.vector_id, df.embedding)
+
+    @staticmethod
+    def filter_metadata(platform, unix_timestamp) -> dict:
+        """The Pinecone metadata that filters match on."""
+        return {"platform": platform, "unix_timestamp": int(unix_timestamp)}
+
+    def backfill_filter_metadata(self):
+        """
+        Adds platform and unix_timestamp metadata, from the knowledge table,
+        to vectors upserted before they were stored, so filtered queries
+        find them. Needs setup_pinecone first; makes one update call per vector.
+        """
+        conn, cur = self.database_connection()
+        cur.execute(f"SELECT vector_id, platform, unix_timestamp FROM {self.knowledge_db_name}")
+        rows = cur.fetchall()
+        conn.close()
+        for count, (vector_id, platform, unix_timestamp) in enumerate(rows, 1):
+            self.pinecone_index.update(id=vector_id, set_metadata=self.filter_metadata(platform, unix_timestamp),
+                namespace='content')
+            if self.debug and count % 1000 == 0:
+                print(f"Backfilled metadata for {count} of {len(rows)} vectors.")
 
-    def query_article(self, query, namespace, top_k=5):
+    def platforms(self) -> list[str]:
+        """The platforms in the knowledge table, looked up once."""
+        if self.platform_names is None:
+            conn, cur = self.database_connection()
+            try:
+                cur.execute(f"SELECT DISTINCT platform FROM {self.knowledge_db_name}")
+                self.platform_names = [row[0] for row in cur.fetchall() if row[0]]
+            except psycopg2.Error:
+                conn.rollback()
+                self.platform_names = []
+            conn.close()
+        return self.platform_names
+
+    def extract_filter(self, query: str) -> dict:
+        """
+        Guesses a metadata filter from a question: the platforms it names,
+        matched on the first word of each platform's name with synonyms
+        folded together by PLATFORM_WORDS ("tweets" finds Tweet or Twitter,
+        "emailed" finds Email), and the time it asks about (see
+        extract_time_range). Returns None if the question names neither.
+        """
+        words = {PLATFORM_WORDS.get(word, word) for word in re.findall(r"[a-z]+", query.lower())}
+        platforms = [p for p in self.platforms()
+            if PLATFORM_WORDS.get(p.lower().split()[0], p.lower().split()[0]) in words]
+        conditions = []
+        if platforms:
+            conditions.append({"platform": {"$in": platforms}})
+        timestamps = self.extract_time_range(query)
+        if timestamps:
+            conditions.append({"unix_timestamp": timestamps})
+        if not conditions:
+            return None
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    @staticmethod
+    def extract_time_range(query: str) -> dict:
+        """
+        A unix_timestamp filter condition for the time a question asks
+        about, or None. Only explicit phrases count: "in 2019", "during
+        2019", "from 2019", "in March 2019", "between 2015 and 2017",
+        "from 2015 to 2017", "since 2020", "after 2020" and "before 2012".
+        A year on its own ("the 2008 financial crisis") is usually what the
+        question is about rather than when it was written, so it is ignored.
+        """
+        text = query.lower()
+        # Local time, like format_timestamp.
+        start_of = lambda year, month = 1: int(datetime.datetime(year, month, 1).timestamp())
+        year_pattern = r"((?:19|20)\d\d)"
+        match = re.search(r"\b(?:between|from)\s+" + year_pattern + r"\s+(?:and|to|-)\s+" + year_pattern + r"\b", text)
+        if match:
+            first, last = sorted(int(year) for year in match.groups())
+            return {"$gte": start_of(first), "$lt": start_of(last + 1)}
+        match = re.search(r"\b(since|after|before)\s+" + year_pattern + r"\b", text)
+        if match:
+            year = int(match.group(2))
+            if match.group(1) == "before":
+                return {"$lt": start_of(year)}
+            return {"$gte": start_of(year if match.group(1) == "since" else year + 1)}
+        match = re.search(r"\b(?:in|during|from)\s+(" + "|".join(MONTHS) + r")\.?\s+(?:of\s+)?" + year_pattern + r"\b", text)
+        if match:
+            year, month = int(match.group(2)), MONTHS[match.group(1)]
+            return {"$gte": start_of(year, month),
+                "$lt": start_of(year + 1, 1) if month == 12 else start_of(year, month + 1)}
+        match = re.search(r"\b(?:in|during|from)\s+" + year_pattern + r"\b", text)
+        if match:
+            year = int(match.group(1))
+            return {"$gte": start_of(year), "$lt": start_of(year + 1)}
+        return None
+
+    def query_article(self, query, namespace, top_k=5, filter: dict = None):
         '''Queries an article using its title in the specified
          namespace and prints results.'''
 
+        if self.vector_store == "pgvector":
+            return self.get_pgvector_matches(query, top_n=top_k, filter=filter)
+
         # Use the OpenAI client to create vector embeddings based on the title column
-        res = self.openai_client.embeddings.create(input=[query], model=self.embedding_model)
-        embedded_query = res.data[0].embedding
+        embedded_query = self.index_vector(self.embed_query(query))
 
         # Query namespace passed as parameter using title vector
         query_result = self.pinecone_index.query(
             namespace=namespace,
             vector=embedded_query,
-            top_k=top_k
+            top_k=top_k,
+            include_metadata=self.metadata_content,
+            filter=filter
         )
 
         # Print query results 
@@ -452,13 +1023,7 @@ class SocialData:
             if not query_result.matches:
                 print('no query result')
         
-        matches = query_result.matches
-        ids = [res.id for res in matches]
-        scores = [res.score for res in matches]
-        df = pd.DataFrame({'id':ids, 
-                           'score':scores
-                           })
-        df['title'], df['url'], df['content'] = zip(*df['id'].apply(lambda x: self.get_item(x)))
+        df = self.matches_to_df(query_result.matches)
         
         if self.debug:
             counter = 0
@@ -470,47 +1035,127 @@ class SocialData:
 
         return df
 
+    def has_content_z(self) -> bool:
+        """Returns True if the knowledge table has a content_z column (checked once)."""
+        if self.content_z_column is None:
+            conn, cur = self.database_connection()
+            cur.execute('''
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = %s AND column_name = 'content_z'
+            ''', (self.knowledge_db_name, ))
+            self.content_z_column = cur.fetchone() is not None
+            conn.close()
+        return self.content_z_column
+
+    def has_full_embedding(self) -> bool:
+        """Returns True if the knowledge table has a full_embedding column (checked once)."""
+        if self.full_embedding_column is None:
+            conn, cur = self.database_connection()
+            cur.execute('''
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = %s AND column_name = 'full_embedding'
+            ''', (self.knowledge_db_name, ))
+            self.full_embedding_column = cur.fetchone() is not None
+            conn.close()
+        return self.full_embedding_column
+
+    def select_items_query(self, where: str) -> str:
+        # content_z is only there once the table has been set up for compression.
+        if self.has_content_z():
+            return f"SELECT vector_id, title, url, content, content_z FROM {self.knowledge_db_name} WHERE {where}"
+        return f"SELECT vector_id, title, url, content, NULL FROM {self.knowledge_db_name} WHERE {where}"
+
+    def hydrate_row(self, row):
+        """Turns a selected row into (title, url, content), decompressing if needed."""
+        vector_id, title, url, content, content_z = row
+        if content_z is not None:
+            content = self.get_compressor().decompress(content_z)
+        return (title, url, content)
+
     def get_item(self, unique_id):
+        # Resolved before checking out a connection: has_content_z() and
+        # get_compressor() check out their own, and holding one while waiting
+        # for another can exhaust the pool.
+        query = self.select_items_query("vector_id = %s")
         conn, cur = self.database_connection()
         try:
             # SQL query to retrieve the row with the specified unique_id
-            query = f"SELECT title, url, content FROM {self.knowledge_db_name} WHERE vector_id = %s"
             cur.execute(query, (unique_id, ))
             row = cur.fetchone()
+        except psycopg2.Error as e:
+            print(f"An error occurred: {e}")
+            return None
+        finally:
             conn.close()
 
-            # Check if a row was found
-            if row:
-                return row
-            else:
-                print(f"No row found with unique_id = {unique_id}")
-                return ['', '', '']
+        # Check if a row was found
+        if row:
+            return self.hydrate_row(row)
+        else:
+            print(f"No row found with unique_id = {unique_id}")
+            return ['', '', '']
+
+    def get_items(self, unique_ids) -> dict:
+        """
+        Bulk version of get_item: fetches all of the given rows in one query
+        and returns a dict mapping each vector_id to (title, url, content).
+        The connection is given back before the rows are hydrated.
+        """
+        items = {}
+        if len(unique_ids) == 0:
+            return items
+        query = self.select_items_query("vector_id = ANY(%s)")
+        rows = []
+        conn, cur = self.database_connection()
+        try:
+            cur.execute(query, (list(unique_ids), ))
+            rows = cur.fetchall()
         except psycopg2.Error as e:
             print(f"An error occurred: {e}")
-            return None
+        conn.close()
+        for row in rows:
+            items[row[0]] = self.hydrate_row(row)
+        return items
 
     # search function
     def get_pinecone_matches(
         self,
         query: str,
-        top_n: int = 100
+        top_n: int = 100,
+        query_embedding = None,
+        filter: dict = None
     ) -> tuple[list[str], list[float]]:
-        """Returns a list of strings and relatednesses, sorted from most related to least."""
-        query_embedding_response = self.openai_client.embeddings.create(
-            model=self.embedding_model,
-            input=query,
-        )
-        query_embedding = query_embedding_response.data[0].embedding
-
-        res = self.openai_client.embeddings.create(input=[query], model=self.embedding_model)
-        embedded_query = res.data[0].embedding
+        """
+        Returns a list of strings and relatednesses, sorted from most related
+        to least. Given a filter (in Pinecone's syntax, on platform,
+        unix_timestamp or title), only the matching messages are searched,
+        in Pinecone or in Postgres. With auto_filter and no filter, one is
+        extracted from the query; if no message passes it, the search is
+        repeated without it.
+        """
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        if filter is None and self.auto_filter:
+            filter = self.extract_filter(query)
+            if filter is not None:
+                df = self.get_pinecone_matches(query, top_n=top_n, query_embedding=query_embedding, filter=filter)
+                if len(df) > 0:
+                    return df
+                filter = None
+        if self.vector_store == "pgvector":
+            return self.get_pgvector_matches(query, top_n=top_n, query_embedding=query_embedding, filter=filter)
 
         # Query namespace passed as parameter using title vector
-        query_result = self.pinecone_index.query(
-            namespace='content',
-            vector=embedded_query,
-            top_k=top_n
-        )
+        with stage_timer("vector_search"):
+            query_result = self.pinecone_index.query(
+                namespace='content',
+                vector=self.index_vector(query_embedding),
+                top_k=top_n * self.rerank_multiplier if self.rerank else top_n,
+                include_metadata=self.metadata_content,
+                # Without rerank, MMR uses the index's own vectors.
+                include_values=self.mmr and not self.rerank,
+                filter=filter
+            )
 
         # if self.debug:
         # print(f'\nMost similar results to {query} in "content" namespace:\n')
@@ -518,13 +1163,118 @@ class SocialData:
         #     print('no query result')
         
         matches = query_result.matches
+        if self.rerank:
+            with stage_timer("rerank"):
+                vectors = self.get_full_embeddings([m.id for m in matches])
+                matches = rerank_matches(matches, vectors, query_embedding, top_n)
+        if self.mmr:
+            with stage_timer("mmr"):
+                if self.rerank:
+                    matches = mmr_matches(matches, vectors, query_embedding, self.mmr_lambda)
+                else:
+                    matches = mmr_matches(matches, {m.id: m.values for m in matches if m.values},
+                        self.index_vector(query_embedding), self.mmr_lambda)
+        with stage_timer("hydrate"):
+            return self.matches_to_df(matches)
+
+    def get_pgvector_matches(
+        self,
+        query: str,
+        top_n: int = 100,
+        query_embedding = None,
+        filter: dict = None
+    ) -> pd.DataFrame:
+        """
+        Answers the similarity search and the hydration in a single SQL query
+        against the knowledge table's embedding column. With rerank, a
+        shortlist of rerank_multiplier * top_n rows is rescored against
+        full_embedding in Python. With mmr, the rows are then reordered by
+        Maximal Marginal Relevance over the same vectors. A filter becomes
+        part of the WHERE clause. Without a full_embedding column (nothing
+        was saved by save_full_embeddings yet), rerank is skipped.
+        """
+        if query_embedding is None:
+            query_embedding = self.embed_query(query)
+        rerank = self.rerank and self.has_full_embedding()
+        limit = top_n * self.rerank_multiplier if rerank else top_n
+        full_embedding = "full_embedding" if rerank else "NULL"
+        index_embedding = "embedding::real[]" if self.mmr and not rerank else "NULL"
+        content_z = "content_z" if self.has_content_z() else "NULL"
+        condition, filter_params = filter_to_sql(filter) if filter else ("TRUE", [])
+        settings = self.search_settings(limit, bool(filter))
+        with stage_timer("vector_search"):
+            conn, cur = self.database_connection()
+            try:
+                for statement, params in settings:
+                    cur.execute(statement, params)
+                cur.execute(f'''
+                    SELECT vector_id, 1 - (embedding <=> %s::vector) AS score, title, url, content,
+                    {content_z}, {full_embedding}, {index_embedding}
+                    FROM {self.knowledge_db_name}
+                    WHERE embedding IS NOT NULL AND {condition}
+                    ORDER BY embedding <=> %s::vector
+                    LIMIT %s
+                ''', (pgvector_literal(self.index_vector(query_embedding)), *filter_params,
+                    pgvector_literal(self.index_vector(query_embedding)), limit))
+                rows = cur.fetchall()
+            finally:
+                conn.close()  # back to the pool, rolling back the SET LOCALs
+        # An IVFFlat scan in relaxed order can return rows slightly out of order.
+        rows.sort(key=lambda row: row[1], reverse=True)
+        if rerank:
+            query_vector = np.asarray(query_embedding, dtype=np.float32)
+            query_vector = query_vector / np.linalg.norm(query_vector)
+            def rescored(row):
+                if row[6] is None:
+                    return row[1]
+                vector = np.frombuffer(row[6], dtype=np.float32)
+                return float(vector @ query_vector / np.linalg.norm(vector))
+            rows = sorted([(row[0], rescored(row), *row[2:]) for row in rows],
+                key=lambda row: row[1], reverse=True)[:top_n]
+        if self.mmr:
+            with stage_timer("mmr"):
+                if rerank:
+                    vectors = {row[0]: np.frombuffer(row[6], dtype=np.float32) for row in rows if row[6] is not None}
+                    rows = mmr_matches(rows, vectors, query_embedding, self.mmr_lambda, key=lambda row: row[0])
+                else:
+                    vectors = {row[0]: row[7] for row in rows if row[7] is not None}
+                    rows = mmr_matches(rows, vectors, self.index_vector(query_embedding), self.mmr_lambda,
+                        key=lambda row: row[0])
+        df = pd.DataFrame({'id': [row[0] for row in rows],
+                           'score': [row[1] for row in rows],
+                           })
+        with stage_timer("hydrate"):
+            hydrated = [self.hydrate_row((row[0], row[2], row[3], row[4], row[5])) for row in rows]
+        df['title'] = [h[0] for h in hydrated]
+        df['url'] = [h[1] for h in hydrated]
+        df['content'] = [h[2] for h in hydrated]
+        return df
+
+    def matches_to_df(self, matches) -> pd.DataFrame:
+        """
+        Turns Pinecone matches into a DataFrame of ids, scores, titles, urls
+        and content, taking the text from the match metadata when it is
+        there and from Postgres (in a single query) otherwise.
+        """
         ids = [res.id for res in matches]
         scores = [res.score for res in matches]
         df = pd.DataFrame({'id':ids, 
                            'score':scores,
                            })
-        
-        df['title'], df['url'], df['content'] = zip(*df['id'].apply(lambda x: self.get_item(x)))
+        if df.empty:
+            df['title'], df['url'], df['content'] = [], [], []
+            return df
+        rows = {}
+        for res in matches:
+            content = unpack_content_metadata(res.metadata) if self.metadata_content else None
+            if content is not None:
+                rows[res.id] = (res.metadata.get('title', ''), res.metadata.get('url', ''), content)
+        missing = [id for id in ids if id not in rows]
+        rows.update(self.get_items(missing))
+        for id in missing:
+            if id not in rows:
+                print(f"No row found with unique_id = {id}")
+        df['title'], df['url'], df['content'] = zip(*[rows.get(id, ('', '', '')) for id in ids])
         return df
 
 
@@ -550,7 +1300,9 @@ if __name__ == "__main__":
         limit = 10,
         debug = True
     )
-    df = sd.fetch_data()
+    sd.setup_pinecone()
+    sd.ingest()
+    # df = sd.fetch_data()
     # print(sd.df.head(50))
     # nan_rows = df[df['url'].isna()]
     # nan_rows = df[df['title'].isna()]
@@ -568,9 +1320,7 @@ if __name__ == "__main__":
         # for piece in pieces:
         #     print(piece)
 
-    sd.setup_pinecone()
     # sd.debug = False
-    sd.upsert_data()
     print(sd.query_article('Portage tennis','content'))
     print(sd.query_article('Expert in Artificial Intelligence','content'))
 
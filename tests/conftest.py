@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+import tiktoken
+
+# The library modules live at the top of the repository.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def tiktoken_encodings():
+    """Skips the test if tiktoken can't load its encoding files, which it downloads on first use."""
+    try:
+        for name in ["cl100k_base", "o200k_base"]:
+            tiktoken.get_encoding(name)
+    except Exception as e:
+        pytest.skip(f"tiktoken encodings unavailable: {e.__class__.__name__}")
@@ -0,0 +1,121 @@
+"""
+Tests for AnswerCache, and for how Asker keys it on the conversation.
+
+To run:
+python -m pytest tests/test_answer_cache.py
+"""
+
+import numpy as np
+import pandas as pd
+from openai import OpenAI
+
+from chatbotter import AnswerCache, Asker, ConversationHistory, LocalIndex
+from fake_services import FakeOpenAI
+
+
+ANSWER = ("The answer.", "<ul></ul>", {})
+
+
+def unit(*components) -> list[float]:
+    vector = np.asarray(components, dtype=np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def test_a_close_enough_question_gets_the_cached_answer():
+    cache = AnswerCache(threshold=0.95)
+    cache.store(unit(1, 0, 0), "v1", "gpt-4o", ANSWER)
+
+    assert cache.lookup(unit(1, 0.1, 0), "v1", "gpt-4o") == ANSWER  # cosine 0.995
+    assert cache.lookup(unit(1, 0.5, 0), "v1", "gpt-4o") is None  # cosine 0.89
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_answers_are_kept_apart_by_model_and_context():
+    cache = AnswerCache()
+    cache.store(unit(1, 0, 0), "v1", "gpt-4o", ANSWER, context="session a")
+
+    assert cache.lookup(unit(1, 0, 0), "v1", "gpt-4o-mini", context="session a") is None
+    assert cache.lookup(unit(1, 0, 0), "v1", "gpt-4o", context="session b") is None
+    assert cache.lookup(unit(1, 0, 0), "v1", "gpt-4o") is None
+    assert cache.lookup(unit(1, 0, 0), "v1", "gpt-4o", context="session a") == ANSWER
+
+
+def test_store_before_any_lookup_keeps_the_answer():
+    cache = AnswerCache()
+    cache.store(unit(1, 0, 0), "v1", "gpt-4o", ANSWER)
+
+    assert cache.corpus_version == "v1"
+    assert cache.lookup(unit(1, 0, 0), "v1", "gpt-4o") == ANSWER
+
+
+def test_a_new_corpus_version_drops_older_answers():
+    cache = AnswerCache()
+    cache.store(unit(1, 0, 0), "v1", "gpt-4o", ANSWER)
+
+    assert cache.lookup(unit(1, 0, 0), "v2", "gpt-4o") is None
+    assert cache.stats()["entries"] == 0
+    # An answer computed against the old version before the re-index is not kept.
+    cache.store(unit(1, 0, 0), "v1", "gpt-4o", ANSWER)
+    assert cache.stats()["entries"] == 0
+
+
+def test_expired_answers_are_not_served():
+    cache = AnswerCache(ttl=60)
+    cache.store(unit(1, 0, 0), "v1", "gpt-4o", ANSWER)
+    for entry in cache.entries.values():
+        entry["created"] -= 61
+
+    assert cache.lookup(unit(1, 0, 0), "v1", "gpt-4o") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_the_least_recently_used_answer_is_evicted():
+    cache = AnswerCache(max_entries=2)
+    cache.store(unit(1, 0, 0), "v1", "gpt-4o", ("first", "", {}))
+    cache.store(unit(0, 1, 0), "v1", "gpt-4o", ("second", "", {}))
+    assert cache.lookup(unit(1, 0, 0), "v1", "gpt-4o")[0] == "first"  # now the most recently used
+    cache.store(unit(0, 0, 1), "v1", "gpt-4o", ("third", "", {}))
+
+    assert cache.lookup(unit(0, 1, 0), "v1", "gpt-4o") is None
+    assert cache.lookup(unit(1, 0, 0), "v1", "gpt-4o")[0] == "first"
+    assert cache.lookup(unit(0, 0, 1), "v1", "gpt-4o")[0] == "third"
+
+
+def test_answer_context_follows_the_conversation():
+    assert Asker.answer_context(None) == ""
+    assert Asker.answer_context(ConversationHistory()) == ""
+
+    history = ConversationHistory()
+    history.add("user", "Where did you grow up?")
+    other = ConversationHistory()
+    other.add("user", "Where did you go to school?")
+    assert Asker.answer_context(history) != ""
+    assert Asker.answer_context(history) != Asker.answer_context(other)
+    assert Asker.answer_context(history) == Asker.answer_context(ConversationHistory.from_dict(history.to_dict()))
+
+    history.summary = "They talked about Wisconsin."
+    assert Asker.answer_context(history) != Asker.answer_context(ConversationHistory.from_dict(
+        {"messages": history.messages}))
+
+
+def test_asker_reuses_answers_only_within_the_same_context(tiktoken_encodings):
+    texts = ["Sheldon grew up in Wisconsin.", "Sheldon wrote books about public relations."]
+    with FakeOpenAI(completion_words=10) as fake_openai:
+        client = OpenAI(api_key="fake", base_url=fake_openai.url + "/v1")
+        asker = Asker(client, df=pd.DataFrame({"text": texts}), answer_cache=AnswerCache(), dedupe_distance=None)
+        asker.local_index = LocalIndex([e.embedding for e in client.embeddings.create(
+            model=asker.embedding_model, input=texts).data])
+
+        asker.ask("Where did Sheldon grow up?")
+        completions = fake_openai.usage["completions"]
+        asker.ask("Where did Sheldon grow up?")
+        assert fake_openai.usage["completions"] == completions  # a fresh conversation reuses it
+
+        # The same retrieval query, asked in a conversation, is answered afresh.
+        asker.standalone_query = lambda query, conversation_history = None: query
+        history = ConversationHistory(session_id="a")
+        history.add("user", "Tell me about Wisconsin.")
+        history.add("assistant", "It is a state.")
+        asker.ask("Where did Sheldon grow up?", conversation_history=history)
+        assert fake_openai.usage["completions"] == completions + 1
@@ -0,0 +1,77 @@
+"""
+Tests for Asker.ask_many, against the FakeOpenAI stand-in in
+fake_services.py and a LocalIndex over a handful of texts.
+
+To run:
+python -m pytest tests/test_ask_many.py
+"""
+
+import pandas as pd
+import pytest
+from openai import OpenAI
+
+from chatbotter import AnswerCache, Asker, LocalIndex
+from fake_services import FakeOpenAI
+
+
+TEXTS = [
+    "Sheldon grew up in Wisconsin and went to school in Madison.",
+    "Sheldon wrote books about public relations and propaganda.",
+    "Sheldon worked at the Center for Media and Democracy.",
+    "Sheldon wrote about mad cow disease.",
+]
+QUESTIONS = [
+    "Where did Sheldon grow up?",
+    "What did Sheldon write about?",
+    "Where did Sheldon grow up?",
+    "Where did Sheldon work?",
+    "What did Sheldon write about?",
+]
+
+
+@pytest.fixture
+def fake_openai():
+    with FakeOpenAI(completion_words=12) as fake_openai:
+        yield fake_openai
+
+
+def make_asker(fake_openai, **kwargs) -> Asker:
+    client = OpenAI(api_key="fake", base_url=fake_openai.url + "/v1")
+    asker = Asker(client, df=pd.DataFrame({"text": TEXTS}), **kwargs)
+    asker.local_index = LocalIndex([e.embedding for e in client.embeddings.create(
+        model=asker.embedding_model, input=TEXTS).data])
+    return asker
+
+
+def test_each_position_gets_the_answer_to_its_question(fake_openai, tiktoken_encodings):
+    asker = make_asker(fake_openai)
+    answers = dict(asker.ask_many(QUESTIONS, concurrency=3))
+
+    assert sorted(answers) == list(range(len(QUESTIONS)))
+    for position, question in enumerate(QUESTIONS):
+        assert answers[position] == asker.ask(question)
+
+
+def test_repeated_questions_are_answered_once(fake_openai, tiktoken_encodings):
+    asker = make_asker(fake_openai)
+    answers = dict(asker.ask_many(QUESTIONS))
+
+    assert fake_openai.usage["completions"] == len(set(QUESTIONS))
+    assert answers[0] is answers[2]
+    assert answers[1] is answers[4]
+
+
+def test_cached_answers_are_used_and_new_ones_stored(fake_openai, tiktoken_encodings):
+    asker = make_asker(fake_openai, answer_cache=AnswerCache())
+    first = dict(asker.ask_many(QUESTIONS))
+    completions = fake_openai.usage["completions"]
+    second = dict(asker.ask_many(QUESTIONS))
+
+    assert fake_openai.usage["completions"] == completions
+    assert second == first
+
+
+def test_no_questions_gives_no_answers(fake_openai):
+    asker = make_asker(fake_openai)
+
+    assert list(asker.ask_many([])) == []
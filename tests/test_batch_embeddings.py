@@ -0,0 +1,83 @@
+"""
+Tests for Embedder's Batch API path, against the files and batches
+endpoints of the FakeOpenAI stand-in in fake_services.py.
+
+To run:
+python -m pytest tests/test_batch_embeddings.py
+"""
+
+import random
+
+import numpy as np
+import pytest
+from openai import OpenAI
+
+from chatbotter import Embedder
+from fake_services import FakeOpenAI
+
+
+STRINGS = [f"Chunk {i}\nabout topic {i % 7} and detail {i}" for i in range(60)]
+
+
+def make_embedder(fake_openai, tmp_path, **kwargs) -> Embedder:
+    client = OpenAI(api_key="fake", base_url=fake_openai.url + "/v1")
+    return Embedder(client, use_batch_api=True, batch_dir=str(tmp_path), batch_file_requests=25,
+        poll_interval=0.01, max_poll_interval=0.05, **kwargs)
+
+
+def record_submissions(embedder) -> list[list[str]]:
+    """Wraps write_batch_files to record the custom_ids sent in each attempt."""
+    submissions = []
+    write_batch_files = embedder.write_batch_files
+    def recording(requests, attempt = 0):
+        submissions.append([request["custom_id"] for request in requests])
+        return write_batch_files(requests, attempt)
+    embedder.write_batch_files = recording
+    return submissions
+
+
+def test_batch_embeddings_match_sync_embeddings_in_order(tmp_path):
+    random.seed(0)
+    with FakeOpenAI(batch_failure_rate=0.3) as fake_openai:
+        embedder = make_embedder(fake_openai, tmp_path, max_batch_attempts=10)
+        submissions = record_submissions(embedder)
+        embeddings = embedder.batch_embeddings(STRINGS, {})
+        expected = [e.embedding for e in embedder.openai_client.embeddings.create(
+            model=embedder.embedding_model, input=STRINGS).data]
+
+    # The sync client asks for base64 and the batch results are JSON floats, so allow for rounding.
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-6, atol=1e-7)
+    assert len(submissions) > 1
+    assert submissions[0] == [f"chunk-{i}" for i in range(len(STRINGS))]
+
+
+def test_only_failed_requests_are_resubmitted(tmp_path):
+    random.seed(1)
+    with FakeOpenAI(batch_failure_rate=0.3) as fake_openai:
+        embedder = make_embedder(fake_openai, tmp_path, max_batch_attempts=10)
+        submissions = record_submissions(embedder)
+        succeeded = {}
+        read_batch_results = embedder.read_batch_results
+        def reading(batch, embeddings):
+            before = set(embeddings)
+            read_batch_results(batch, embeddings)
+            succeeded.setdefault(len(submissions), set()).update(set(embeddings) - before)
+        embedder.read_batch_results = reading
+        embedder.batch_embeddings(STRINGS, {})
+
+    for attempt in range(1, len(submissions)):
+        previous = submissions[attempt - 1]
+        assert submissions[attempt] == [custom_id for custom_id in previous
+            if custom_id not in succeeded[attempt]]
+        assert submissions[attempt]
+
+
+def test_gives_up_after_max_batch_attempts(tmp_path):
+    with FakeOpenAI(batch_failure_rate=1.0) as fake_openai:
+        embedder = make_embedder(fake_openai, tmp_path, max_batch_attempts=2)
+        submissions = record_submissions(embedder)
+        with pytest.raises(RuntimeError, match="after 2 Batch API submissions"):
+            embedder.batch_embeddings(STRINGS, {})
+
+    assert len(submissions) == 2
+    assert submissions[1] == submissions[0]
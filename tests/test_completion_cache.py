@@ -0,0 +1,101 @@
+"""
+Tests for CompletionCache and create_completion / acreate_completion,
+against the FakeOpenAI stand-in in fake_services.py.
+
+To run:
+python -m pytest tests/test_completion_cache.py
+"""
+
+import asyncio
+import time
+
+import pytest
+from openai import AsyncOpenAI, OpenAI
+
+from chatbotter import CompletionCache, acreate_completion, create_completion
+from fake_services import FakeOpenAI
+
+
+MESSAGES = [{"role": "user", "content": "Summarize the conversation so far."}]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CompletionCache(db_path=str(tmp_path / "completions.db"))
+
+
+@pytest.fixture
+def fake_openai():
+    with FakeOpenAI(completion_words=5) as fake_openai:
+        yield fake_openai
+
+
+def client(fake_openai) -> OpenAI:
+    return OpenAI(api_key="fake", base_url=fake_openai.url + "/v1")
+
+
+def test_keys_depend_on_model_messages_and_parameters():
+    key = CompletionCache.key("gpt-4o", MESSAGES, temperature=0)
+
+    assert key == CompletionCache.key("gpt-4o", [dict(m) for m in MESSAGES], temperature=0)
+    assert key != CompletionCache.key("gpt-4o-mini", MESSAGES, temperature=0)
+    assert key != CompletionCache.key("gpt-4o", MESSAGES + MESSAGES, temperature=0)
+    assert key != CompletionCache.key("gpt-4o", MESSAGES, temperature=0, max_tokens=100)
+
+
+def test_repeated_temperature_0_requests_are_answered_from_the_cache(cache, fake_openai):
+    first = create_completion(client(fake_openai), "gpt-4o", MESSAGES, cache=cache, temperature=0)
+    second = create_completion(client(fake_openai), "gpt-4o", MESSAGES, cache=cache, temperature=0)
+    create_completion(client(fake_openai), "gpt-4o", MESSAGES, cache=cache, temperature=0, max_tokens=10)
+
+    assert second == first
+    assert fake_openai.usage["completions"] == 2
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3}
+
+
+def test_other_temperatures_are_not_cached(cache, fake_openai):
+    for _ in range(2):
+        create_completion(client(fake_openai), "gpt-4o", MESSAGES, cache=cache, temperature=0.7)
+
+    assert fake_openai.usage["completions"] == 2
+    assert cache.stats()["hits"] + cache.stats()["misses"] == 0
+
+
+def test_the_async_version_shares_the_cache(cache, fake_openai):
+    content = create_completion(client(fake_openai), "gpt-4o", MESSAGES, cache=cache, temperature=0)
+    async_client = AsyncOpenAI(api_key="fake", base_url=fake_openai.url + "/v1")
+    cached = asyncio.run(acreate_completion(async_client, "gpt-4o", MESSAGES, cache=cache, temperature=0))
+
+    assert cached == content
+    assert fake_openai.usage["completions"] == 1
+
+
+def test_expired_completions_are_missed_and_pruned(cache):
+    cache.ttl = 60
+    cache.set("old", "stale")
+    cache.connection().execute("UPDATE Completions SET created = ?", (time.time() - 61, ))
+    cache.connection().commit()
+
+    assert cache.get("old") is None
+    cache.prune()
+    assert cache.connection().execute("SELECT COUNT(*) FROM Completions").fetchone()[0] == 0
+
+
+def test_the_least_recently_used_completions_are_pruned(cache):
+    cache.max_entries = 2
+    for key in ["a", "b", "c"]:
+        cache.set(key, key)
+    for age, key in enumerate(["c", "b", "a"]):
+        cache.connection().execute("UPDATE Completions SET last_used = ? WHERE key = ?", (time.time() - 10 * (age + 1), key))
+    cache.get("a")  # now the most recently used
+    cache.prune()
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "a"
+    assert cache.get("c") == "c"
+
+
+def test_entries_are_shared_through_the_file(cache):
+    cache.set("key", "content")
+
+    assert CompletionCache(db_path=cache.db_path).get("key") == "content"
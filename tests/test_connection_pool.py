@@ -0,0 +1,108 @@
+"""
+Tests for ConnectionPool and PooledConnection. Postgres is stood in for by
+replacing psycopg2.connect.
+
+To run:
+python -m pytest tests/test_connection_pool.py
+"""
+
+import threading
+import time
+
+import psycopg2
+import psycopg2.pool
+import pytest
+
+from chatbotter import ConnectionPool
+
+
+class Connection:
+    """Just enough of a psycopg2 connection for the pool."""
+    def __init__(self):
+        self.closed = 0
+        self.rollbacks = 0
+        self.broken = False
+
+    def cursor(self):
+        connection = self
+        class Cursor:
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc_info):
+                pass
+            def execute(self, query):
+                if connection.broken:
+                    raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        return Cursor()
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture(autouse=True)
+def fake_connect(monkeypatch):
+    monkeypatch.setattr(psycopg2, "connect", lambda **connect_args: Connection())
+
+
+def test_connections_are_reused_and_rolled_back_on_return():
+    pool = ConnectionPool(size=2, timeout=1)
+    conn = pool.connection()
+    raw = conn.conn
+    conn.close()
+    conn.close()  # a second close does nothing
+
+    again = pool.connection()
+    assert again.conn is raw
+    assert raw.rollbacks == 1
+    assert pool.metrics()["connections_opened"] == 1
+    assert pool.metrics()["checkouts"] == 2
+
+
+def test_a_dropped_connection_goes_back_to_the_pool():
+    pool = ConnectionPool(size=1, timeout=1)
+    conn = pool.connection()
+    del conn
+
+    pool.connection()
+    assert pool.metrics()["timeouts"] == 0
+
+
+def test_checkouts_wait_for_a_free_connection_and_time_out():
+    pool = ConnectionPool(size=1, timeout=0.1)
+    conn = pool.connection()
+    with pytest.raises(psycopg2.pool.PoolError):
+        pool.connection()
+    assert pool.metrics()["timeouts"] == 1
+
+    pool.timeout = 5
+    threading.Timer(0.05, conn.close).start()
+    pool.connection()
+    assert pool.metrics()["wait_seconds_max"] > 0
+
+
+def test_old_connections_are_replaced():
+    pool = ConnectionPool(size=1, max_lifetime=0)
+    conn = pool.connection()
+    raw = conn.conn
+    conn.close()
+    time.sleep(0.01)
+
+    assert pool.connection().conn is not raw
+    assert raw.closed
+    assert pool.metrics()["connections_recycled"] == 1
+
+
+def test_idle_connections_are_checked_before_reuse():
+    pool = ConnectionPool(size=1, health_check_after=0)
+    conn = pool.connection()
+    raw = conn.conn
+    conn.close()
+    raw.broken = True
+    time.sleep(0.01)
+
+    assert pool.connection().conn is not raw
+    assert pool.metrics()["health_check_failures"] == 1
+    assert pool.metrics()["open"] == 1
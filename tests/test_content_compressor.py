@@ -0,0 +1,75 @@
+"""
+Tests for ContentCompressor, the zstd compression of chunk text with a
+trained dictionary.
+
+To run:
+python -m pytest tests/test_content_compressor.py
+"""
+
+import random
+import threading
+
+import pytest
+
+pytest.importorskip("zstandard")
+
+from chatbotter import ContentCompressor
+
+
+def chunks(n: int) -> list[str]:
+    # Short chunks sharing boilerplate, like wiki sections and email footers.
+    rng = random.Random(0)
+    words = ["coal", "plant", "Wisconsin", "energy", "megawatts", "permit", "utility", "emissions", "Madison"]
+    return [
+        f"== Section {i} ==\n" + " ".join(rng.choice(words) for _ in range(30))
+        + "\n\nSent from my phone. To unsubscribe from this list, reply with REMOVE in the subject line."
+        for i in range(n)
+    ]
+
+
+def test_text_round_trips():
+    compressor = ContentCompressor.train(chunks(500))
+    for text in chunks(20) + ["", "ünïcödé ✓"]:
+        assert compressor.decompress(compressor.compress(text)) == text
+
+
+def test_a_trained_dictionary_compresses_short_chunks_better():
+    samples = chunks(500)
+    trained = ContentCompressor.train(samples, dict_size=16384)
+    plain = ContentCompressor()
+
+    assert trained.dictionary is not None
+    trained_size = sum(len(trained.compress(text)) for text in samples[:50])
+    plain_size = sum(len(plain.compress(text)) for text in samples[:50])
+    assert trained_size < plain_size * 0.7
+
+
+def test_a_compressor_rebuilt_from_the_dictionary_reads_the_same_data():
+    trained = ContentCompressor.train(chunks(500))
+    data = trained.compress(chunks(1)[0])
+
+    assert ContentCompressor(trained.dictionary).decompress(data) == chunks(1)[0]
+
+
+def test_too_few_samples_fall_back_to_plain_zstd():
+    compressor = ContentCompressor.train(["one short sample"])
+
+    assert compressor.dictionary is None
+    assert compressor.decompress(compressor.compress("text")) == "text"
+
+
+def test_threads_share_a_compressor():
+    compressor = ContentCompressor.train(chunks(500))
+    texts = chunks(200)
+    errors = []
+    def round_trips():
+        for text in texts:
+            if compressor.decompress(compressor.compress(text)) != text:
+                errors.append(text)
+    threads = [threading.Thread(target=round_trips) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
@@ -0,0 +1,108 @@
+"""
+Tests for ConversationHistory and for how Asker keeps it bounded
+(remember), rewrites follow-ups (standalone_query) and sends it along
+(chat_messages), against the FakeOpenAI stand-in in fake_services.py.
+
+To run:
+python -m pytest tests/test_conversation_history.py
+"""
+
+import pytest
+from openai import OpenAI
+
+from chatbotter import Asker, ConversationHistory
+from fake_services import FakeOpenAI
+
+
+@pytest.fixture
+def fake_openai():
+    with FakeOpenAI(completion_words=20) as fake_openai:
+        yield fake_openai
+
+
+def make_asker(fake_openai, **kwargs) -> Asker:
+    client = OpenAI(api_key="fake", base_url=fake_openai.url + "/v1")
+    return Asker(client, introduction="Answer as Sheldon.", gpt_model="gpt-4", **kwargs)
+
+
+def test_histories_round_trip_through_dicts():
+    history = ConversationHistory(summary="They talked about Wisconsin.", session_id="s")
+    history.add("user", "Where did you grow up?")
+    history.add("assistant", "In Wisconsin.")
+    restored = ConversationHistory.from_dict(history.to_dict())
+
+    assert restored.messages == history.messages
+    assert restored.summary == history.summary
+    assert restored.session_id is None  # SessionStore sets it from the key
+    assert history.to_dict(max_messages=1)["messages"] == history.messages[-1:]
+    assert ConversationHistory.from_dict(history.messages).messages == history.messages
+    assert history.transcript() == "user: Where did you grow up?\nassistant: In Wisconsin.\n"
+
+
+def test_an_empty_history_is_falsy():
+    assert not ConversationHistory()
+    assert ConversationHistory(summary="Earlier turns.")
+    assert ConversationHistory([{"role": "user", "content": "Hi"}])
+
+
+def test_chat_messages_send_the_summary_and_recent_turns(fake_openai):
+    asker = make_asker(fake_openai)
+    history = ConversationHistory(summary="They talked about Wisconsin.")
+    history.add("user", "Where did you grow up?")
+    history.add("assistant", "In Wisconsin.")
+
+    assert asker.chat_messages("Packed prompt", history) == [
+        {"role": "system", "content": "Answer as Sheldon."},
+        {"role": "system", "content": "Summary of the earlier conversation:\nThey talked about Wisconsin."},
+        {"role": "user", "content": "Where did you grow up?"},
+        {"role": "assistant", "content": "In Wisconsin."},
+        {"role": "user", "content": "Packed prompt"},
+    ]
+    assert asker.chat_messages("Packed prompt") == [
+        {"role": "system", "content": "Answer as Sheldon."},
+        {"role": "user", "content": "Packed prompt"},
+    ]
+
+
+def test_a_first_question_is_not_rewritten(fake_openai):
+    asker = make_asker(fake_openai)
+
+    assert asker.standalone_query("Where did you grow up?", ConversationHistory()) == "Where did you grow up?"
+    assert fake_openai.usage["completions"] == 0
+
+
+def test_a_follow_up_is_rewritten_with_the_condense_model(fake_openai):
+    asker = make_asker(fake_openai)
+    history = ConversationHistory()
+    history.add("user", "Where did you grow up?")
+    history.add("assistant", "In Wisconsin.")
+    standalone = asker.standalone_query("What was the weather like there?", history)
+
+    assert fake_openai.usage["completions"] == 1
+    assert standalone and standalone != "What was the weather like there?"
+
+
+def test_remember_folds_old_turns_into_the_summary(fake_openai, tiktoken_encodings):
+    asker = make_asker(fake_openai, history_window_tokens=60)
+    history = ConversationHistory()
+    for turn in range(10):
+        asker.remember(history, f"Question number {turn} about Wisconsin?", f"Answer number {turn} about Madison.")
+        assert sum(asker.num_tokens(m["content"]) for m in history.messages) <= 60
+
+    assert history.summary
+    assert history.messages[-2:] == [
+        {"role": "user", "content": "Question number 9 about Wisconsin?"},
+        {"role": "assistant", "content": "Answer number 9 about Madison."},
+    ]
+    # Folding goes down to half the window, so the summary isn't rewritten every turn.
+    assert fake_openai.usage["completions"] < 5
+
+
+def test_remember_does_not_summarize_when_only_the_latest_turn_is_over_budget(fake_openai, tiktoken_encodings):
+    asker = make_asker(fake_openai, history_window_tokens=5)
+    history = ConversationHistory()
+    asker.remember(history, "A question that is longer than the whole window?", "And a long answer to it.")
+
+    assert fake_openai.usage["completions"] == 0
+    assert len(history) == 2
+    assert history.summary == ""
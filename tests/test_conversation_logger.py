@@ -0,0 +1,156 @@
+"""
+Tests for ConversationLogger's write-behind mode: batching, the spool file
+and its replay, and keeping the writer thread alive. Postgres is stood in
+for by overriding insert_entries.
+
+To run:
+python -m pytest tests/test_conversation_logger.py
+"""
+
+import json
+import os
+import threading
+import time
+
+import psycopg2
+import pytest
+
+from chatbotter import ConversationLogger
+
+
+class RecordingLogger(ConversationLogger):
+    """
+    A write-behind logger whose inserts go to a list, or raise self.error
+    when it is set. Inserts wait while self.gate is cleared.
+    """
+    def __init__(self, **kwargs):
+        kwargs.setdefault("flush_interval_ms", 20)
+        super().__init__(write_behind=True, **kwargs)
+        self.inserted = []
+        self.error = None
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def insert_entries(self, entries):
+        self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        self.inserted.extend(entries)
+
+
+def entry(n: int) -> dict:
+    return {"session_id": "s", "timestamp": str(n), "user_input": f"question {n}", "bot_response": f"answer {n}"}
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def spooled(path) -> list[dict]:
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def spool_path(tmp_path):
+    return str(tmp_path / "spool.jsonl")
+
+
+def test_entries_are_written_in_batches(spool_path):
+    logger = RecordingLogger(spool_path=spool_path, flush_entries=10, flush_interval_ms=5000)
+    for n in range(25):
+        logger.post_entry(entry(n))
+    logger.close()
+
+    assert logger.inserted == [entry(n) for n in range(25)]
+    assert logger.stats["flushes"] == 3
+    assert not os.path.exists(spool_path)
+
+
+def test_failed_batches_are_spooled_and_replayed_after_the_next_write(spool_path):
+    logger = RecordingLogger(spool_path=spool_path)
+    logger.error = psycopg2.OperationalError("database is down")
+    logger.post_entry(entry(0))
+    wait_for(lambda: logger.stats["spooled"] == 1)
+    assert spooled(spool_path) == [entry(0)]
+
+    logger.error = None
+    logger.post_entry(entry(1))
+    wait_for(lambda: logger.stats["replayed"] == 1)
+    logger.close()
+
+    assert logger.inserted == [entry(1), entry(0)]
+    assert not os.path.exists(spool_path)
+
+
+def test_a_full_queue_spools_instead_of_waiting(spool_path):
+    logger = RecordingLogger(spool_path=spool_path, queue_size=1, flush_entries=1)
+    logger.gate.clear()  # the writer takes the first entry and waits in its insert
+    logger.post_entry(entry(0))
+    wait_for(logger.queue.empty)
+    logger.post_entry(entry(1))
+    logger.post_entry(entry(2))
+
+    assert spooled(spool_path) == [entry(2)]
+    logger.gate.set()
+    logger.close()
+    # The spooled entry is replayed after the write that follows it.
+    assert sorted(logger.inserted, key=lambda e: e["timestamp"]) == [entry(0), entry(1), entry(2)]
+
+
+def test_replay_skips_a_torn_line(spool_path, capsys):
+    with open(spool_path, "w") as f:
+        f.write(json.dumps(entry(0)) + "\n" + '{"session_id": "s", "tim' + "\n" + json.dumps(entry(1)) + "\n")
+    logger = RecordingLogger(spool_path=spool_path)
+    logger.replay_spool()
+
+    assert logger.inserted == [entry(0), entry(1)]
+    assert not os.path.exists(spool_path)
+    assert "unreadable line" in capsys.readouterr().out
+
+
+def test_entries_that_still_fail_on_replay_are_spooled_again(spool_path):
+    with open(spool_path, "w") as f:
+        f.write(json.dumps(entry(0)) + "\n")
+    logger = RecordingLogger(spool_path=spool_path)
+    logger.error = psycopg2.OperationalError("database is down")
+    logger.replay_spool()
+
+    assert spooled(spool_path) == [entry(0)]
+    assert [name for name in os.listdir(os.path.dirname(spool_path)) if name.endswith(".replay")] == []
+
+
+def test_the_writer_survives_errors_other_than_database_ones(spool_path):
+    logger = RecordingLogger(spool_path=spool_path)
+    logger.error = ValueError("can't adapt an entry")
+    logger.post_entry(entry(0))
+    wait_for(lambda: logger.stats["spooled"] == 1)
+    assert logger.writer.is_alive()
+
+    spool = logger.spool
+    def failing_spool(entries):
+        raise OSError("no space left on device")
+    logger.spool = failing_spool
+    logger.post_entry(entry(1))
+    time.sleep(0.1)
+    assert logger.writer.is_alive()
+
+    logger.spool = spool
+    logger.error = None
+    logger.post_entry(entry(2))
+    logger.close()
+    assert logger.inserted == [entry(2), entry(0)]
+
+
+def test_a_stopped_writer_is_restarted(spool_path):
+    logger = RecordingLogger(spool_path=spool_path)
+    logger.post_entry(entry(0))
+    logger.close()
+    assert not logger.writer.is_alive()
+
+    logger.post_entry(entry(1))
+    logger.close()
+    assert logger.inserted == [entry(0), entry(1)]
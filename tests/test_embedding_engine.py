@@ -0,0 +1,75 @@
+"""
+Tests for EmbeddingEngine's request packing, ordering and retries, against
+the FakeOpenAI stand-in in fake_services.py.
+
+To run:
+python -m pytest tests/test_embedding_engine.py
+"""
+
+import random
+
+import numpy as np
+import pytest
+from openai import OpenAI, RateLimitError
+
+from chatbotter import EmbeddingEngine
+from fake_services import FakeOpenAI
+
+
+TEXTS = [f"post {i} about topic {i % 5}" + " and more" * (i % 13) for i in range(300)]
+
+
+def make_engine(fake_openai, **kwargs) -> EmbeddingEngine:
+    client = OpenAI(api_key="fake", base_url=fake_openai.url + "/v1", max_retries=0)
+    return EmbeddingEngine(client, base_delay=0.001, max_delay=0.01, **kwargs)
+
+
+def test_requests_respect_the_input_and_token_limits(tiktoken_encodings):
+    engine = EmbeddingEngine(None, max_inputs=40, max_tokens=500)
+    prepared, batches = engine.pack(TEXTS)
+
+    assert batches[0][0] == 0 and batches[-1][1] == len(TEXTS)
+    assert all(end == start for (_, end), (start, _) in zip(batches, batches[1:]))
+    for start, end in batches:
+        assert end - start <= 40
+        assert sum(len(engine.encoding.encode(text)) for text in prepared[start:end]) <= 500
+
+
+def test_long_and_empty_texts_are_made_acceptable(tiktoken_encodings):
+    engine = EmbeddingEngine(None, max_input_tokens=10)
+    prepared, batches = engine.pack(["word " * 50, "", "   ", "short"])
+
+    assert len(engine.encoding.encode(prepared[0])) == 10
+    assert prepared[1:] == [" ", " ", "short"]
+    assert batches == [(0, 4)]
+
+
+def test_embeddings_come_back_in_the_order_of_the_texts(tiktoken_encodings):
+    with FakeOpenAI() as fake_openai:
+        engine = make_engine(fake_openai, max_inputs=16, concurrency=4)
+        embeddings = engine.embed(TEXTS)
+        expected = fake_openai.embed(TEXTS, engine.embedding_model)
+
+    assert engine.requests == len(engine.pack(TEXTS)[1]) > 1
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-6, atol=1e-7)
+
+
+def test_rate_limited_requests_are_retried(tiktoken_encodings):
+    random.seed(0)
+    with FakeOpenAI(rate_limit_rate=0.3) as fake_openai:
+        engine = make_engine(fake_openai, max_inputs=16, max_retries=10)
+        embeddings = engine.embed(TEXTS)
+        expected = fake_openai.embed(TEXTS, engine.embedding_model)
+
+    assert engine.retries > 0
+    assert engine.retries == fake_openai.usage["rate_limited"]
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-6, atol=1e-7)
+
+
+def test_a_request_that_keeps_failing_raises(tiktoken_encodings):
+    with FakeOpenAI(rate_limit_rate=1.0) as fake_openai:
+        engine = make_engine(fake_openai, max_retries=2)
+        with pytest.raises(RateLimitError):
+            engine.embed(TEXTS[:3])
+
+    assert engine.retries == 2
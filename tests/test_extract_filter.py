@@ -0,0 +1,77 @@
+"""
+Tests for SocialData.extract_filter and extract_time_range, which guess a
+metadata filter from the wording of a question.
+
+To run:
+python -m pytest tests/test_extract_filter.py
+"""
+
+import datetime
+
+import pytest
+
+from social_data import SocialData
+
+
+def start_of(year, month = 1):
+    return int(datetime.datetime(year, month, 1).timestamp())
+
+
+@pytest.fixture
+def social_data():
+    sd = SocialData(None)
+    # The platform names this corpus stores, so no database is needed.
+    sd.platform_names = ["Email", "Tweet", "Facebook post", "Facebook comment"]
+    return sd
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("What did you tweet about tennis in 2019", {"$gte": start_of(2019), "$lt": start_of(2020)}),
+    ("What were you doing during 2012?", {"$gte": start_of(2012), "$lt": start_of(2013)}),
+    ("Emails from 2015 about work", {"$gte": start_of(2015), "$lt": start_of(2016)}),
+    ("What did you write in March 2019?", {"$gte": start_of(2019, 3), "$lt": start_of(2019, 4)}),
+    ("What did you write in December of 2018?", {"$gte": start_of(2018, 12), "$lt": start_of(2019)}),
+    ("Facebook posts between 2017 and 2015", {"$gte": start_of(2015), "$lt": start_of(2018)}),
+    ("Your posts from 2010 to 2012", {"$gte": start_of(2010), "$lt": start_of(2013)}),
+    ("What have you emailed since 2020?", {"$gte": start_of(2020)}),
+    ("What have you said after 2020?", {"$gte": start_of(2021)}),
+    ("Anything before 2012?", {"$lt": start_of(2012)}),
+])
+def test_explicit_time_phrases(query, expected):
+    assert SocialData.extract_time_range(query) == expected
+
+
+@pytest.mark.parametrize("query", [
+    "What did you think about the 2008 financial crisis?",
+    "Tell me about the 2016 election and Trump",
+    "What do you think about tennis?",
+])
+def test_bare_years_are_not_dates(query):
+    assert SocialData.extract_time_range(query) is None
+
+
+@pytest.mark.parametrize("query, platforms", [
+    ("What did you tweet about tennis?", ["Tweet"]),
+    ("Show me your tweets about Obama", ["Tweet"]),
+    ("Anything on Twitter about Obama?", ["Tweet"]),
+    ("What have you emailed people about work?", ["Email"]),
+    ("Your Facebook comments about cats", ["Facebook post", "Facebook comment"]),
+])
+def test_platform_synonyms(social_data, query, platforms):
+    assert social_data.extract_filter(query) == {"platform": {"$in": platforms}}
+
+
+def test_twitter_platform_name(social_data):
+    social_data.platform_names = ["Email", "Twitter"]
+    assert social_data.extract_filter("What did you tweet?") == {"platform": {"$in": ["Twitter"]}}
+
+
+def test_platform_and_date(social_data):
+    assert social_data.extract_filter("What did you tweet about tennis in 2019") == {"$and": [
+        {"platform": {"$in": ["Tweet"]}},
+        {"unix_timestamp": {"$gte": start_of(2019), "$lt": start_of(2020)}},
+    ]}
+
+
+def test_no_filter(social_data):
+    assert social_data.extract_filter("What did you think about the 2008 financial crisis?") is None
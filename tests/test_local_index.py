@@ -0,0 +1,92 @@
+"""
+Tests for LocalIndex's quantized and reduced-dimension search with exact
+rescoring.
+
+To run:
+python -m pytest tests/test_local_index.py
+"""
+
+import numpy as np
+import pytest
+
+from chatbotter import LocalIndex
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((2000, 256)).astype(np.float32)
+
+
+@pytest.fixture(scope="module")
+def queries(vectors):
+    # Near-copies of some rows, so each has a clear nearest neighbour.
+    rng = np.random.default_rng(1)
+    return vectors[:50] + 0.3 * rng.standard_normal((50, vectors.shape[1])).astype(np.float32)
+
+
+def exact_top(vectors, query, k):
+    scores = LocalIndex.normalized(vectors) @ LocalIndex.normalized(query)
+    return np.argsort(-scores)[:k]
+
+
+@pytest.mark.parametrize("quantization, dimensions", [("float16", None), ("int8", None), (None, 128), ("int8", 128)])
+def test_rescored_search_finds_the_exact_neighbours(vectors, queries, tmp_path, quantization, dimensions):
+    index = LocalIndex(vectors, quantization=quantization, vectors_path=str(tmp_path / "vectors.npy"),
+        dimensions=dimensions)
+    # Each query's nearest neighbour is the row it was made from.
+    assert [index.search(query, top_n=10)[0][0] for query in queries] == list(range(len(queries)))
+    # Random vectors, unlike text-embedding-3 ones, don't keep most of their
+    # information in the leading components, so only full-width searches are
+    # expected to find the rest of the exact top 10.
+    if not dimensions:
+        recall = np.mean([
+            len(set(index.search(query, top_n=10)[0]) & set(exact_top(vectors, query, 10))) / 10
+            for query in queries
+        ])
+        assert recall >= 0.9
+    # The scores are exact cosine similarities, whatever was searched in memory.
+    indices, scores = index.search(queries[0], top_n=5)
+    expected = LocalIndex.normalized(vectors[indices]) @ LocalIndex.normalized(queries[0])
+    np.testing.assert_allclose(scores, expected, rtol=1e-5, atol=1e-6)
+    assert list(scores) == sorted(scores, reverse=True)
+
+
+def test_quantized_matrices_are_smaller(vectors, tmp_path):
+    full = LocalIndex(vectors)
+    int8 = LocalIndex(vectors, quantization="int8", vectors_path=str(tmp_path / "vectors.npy"))
+    reduced = LocalIndex(vectors, dimensions=64, vectors_path=str(tmp_path / "reduced.npy"))
+
+    assert int8.nbytes < full.nbytes / 3
+    assert reduced.nbytes == full.nbytes / 4
+
+
+def test_search_many_matches_search(vectors, queries, tmp_path):
+    index = LocalIndex(vectors, quantization="int8", vectors_path=str(tmp_path / "vectors.npy"))
+    index.query_block_size = 16  # more than one block
+    for query, (indices, scores) in zip(queries, index.search_many(queries, top_n=10)):
+        expected_indices, expected_scores = index.search(query, top_n=10)
+        assert list(indices) == list(expected_indices)
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+
+
+def test_an_index_loads_from_its_saved_vectors(vectors, queries, tmp_path):
+    path = str(tmp_path / "vectors.npy")
+    built = LocalIndex(vectors, quantization="float16", vectors_path=path)
+    loaded = LocalIndex(quantization="float16", vectors_path=path)
+
+    assert list(loaded.search(queries[0])[0]) == list(built.search(queries[0])[0])
+
+
+def test_quantization_needs_a_vectors_path(vectors):
+    with pytest.raises(ValueError):
+        LocalIndex(vectors, quantization="int8")
+    with pytest.raises(ValueError):
+        LocalIndex(vectors, quantization="int4", vectors_path="unused.npy")
+
+
+def test_an_empty_index_finds_nothing():
+    index = LocalIndex(np.zeros((0, 8), dtype=np.float32))
+
+    assert len(index.search(np.ones(8))[0]) == 0
+    assert [len(indices) for indices, scores in index.search_many(np.ones((2, 8)))] == [0, 0]
@@ -0,0 +1,67 @@
+"""
+Tests for mmr_order and mmr_matches, the Maximal Marginal Relevance
+reordering of retrieved chunks.
+
+To run:
+python -m pytest tests/test_mmr.py
+"""
+
+import types
+
+import numpy as np
+
+from chatbotter import mmr_matches, mmr_order
+
+
+QUERY = np.array([1.0, 0.0, 0.0])
+# Two near-copies of the most relevant vector, and a less relevant but different one.
+VECTORS = np.array([
+    [0.9, 0.1, 0.0],
+    [0.9, 0.11, 0.0],
+    [0.6, 0.0, 0.8],
+])
+
+
+def reference_order(query, vectors, diversity_lambda):
+    """MMR written out directly, one candidate at a time."""
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    query = query / np.linalg.norm(query)
+    chosen, remaining = [], list(range(len(vectors)))
+    while remaining:
+        def score(i):
+            redundancy = max((vectors[i] @ vectors[j] for j in chosen), default=0)
+            return diversity_lambda * (vectors[i] @ query) - (1 - diversity_lambda) * redundancy
+        best = max(remaining, key=score)
+        chosen.append(best)
+        remaining.remove(best)
+    return chosen
+
+
+def test_a_near_duplicate_moves_below_a_different_candidate():
+    assert list(mmr_order(QUERY, VECTORS, diversity_lambda=0.5)) == [0, 2, 1]
+
+
+def test_lambda_1_orders_by_relevance_alone():
+    assert list(mmr_order(QUERY, VECTORS, diversity_lambda=1.0)) == [0, 1, 2]
+
+
+def test_the_order_matches_a_direct_implementation():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((40, 16))
+    query = rng.standard_normal(16)
+    for diversity_lambda in [0.3, 0.7, 0.9]:
+        assert list(mmr_order(query, vectors, diversity_lambda)) == reference_order(query, vectors, diversity_lambda)
+
+
+def test_k_limits_the_candidates_returned():
+    assert list(mmr_order(QUERY, VECTORS, diversity_lambda=0.5, k=2)) == [0, 2]
+    assert len(mmr_order(QUERY, np.zeros((0, 3)))) == 0
+
+
+def test_matches_without_vectors_keep_their_order_at_the_end():
+    matches = [types.SimpleNamespace(id=name) for name in ["a", "b", "missing", "c"]]
+    vectors = {"a": VECTORS[0], "b": VECTORS[1], "c": VECTORS[2]}
+    ordered = mmr_matches(matches, vectors, QUERY, diversity_lambda=0.5)
+
+    assert [match.id for match in ordered] == ["a", "c", "b", "missing"]
+    assert mmr_matches(matches, {}, QUERY) == matches
@@ -0,0 +1,58 @@
+"""
+Tests for simhash and for the near-duplicate collapse in Asker.pack_message.
+
+To run:
+python -m pytest tests/test_near_duplicates.py
+"""
+
+from chatbotter import Asker, hamming_distance, simhash
+
+
+# simhash is built on Python's hash(), which is seeded per process, so the
+# distances vary from run to run; near-duplicates here differ by about 3
+# bits and unrelated texts by about 32, and 12 keeps the tests clear of both tails.
+DISTANCE = 12
+
+POST = ("We are launching a campaign to get money out of politics in Wisconsin. "
+    "Please sign the petition and share it with your friends before the deadline on Friday. "
+    "Every signature tells the legislature that voters want small donors, not corporations and "
+    "billionaires, to decide who wins our elections. We will deliver the petitions to the capitol "
+    "in Madison next month, and we need volunteers to help us carry the boxes up the steps.")
+REPOST = "RT " + POST + " #wipolitics"
+OTHER = ("The Center for Media and Democracy publishes SourceWatch, a wiki about the people "
+    "and groups shaping the public agenda, written by volunteers and staff.")
+
+
+def test_near_duplicates_have_close_fingerprints():
+    assert hamming_distance(simhash(POST), simhash(POST.upper())) == 0
+    assert hamming_distance(simhash(POST), simhash(REPOST)) <= DISTANCE
+    assert hamming_distance(simhash(POST), simhash(OTHER)) > DISTANCE
+
+
+def test_short_texts_still_get_a_fingerprint():
+    assert simhash("Hello") == simhash("hello")
+    assert simhash("Hello") != simhash("Goodbye")
+
+
+def test_pack_message_leaves_out_near_duplicates_but_keeps_their_references(tiktoken_encodings):
+    asker = Asker(None, introduction="Answer from the posts.", string_divider="Post:", gpt_model="gpt-4",
+        dedupe_distance=DISTANCE)
+    articles = {}
+    message = asker.pack_message("What is the campaign?", [
+        (POST, "Post", "https://example.com/post"),
+        (REPOST, "Repost", "https://example.com/repost"),
+        (OTHER, "SourceWatch", "https://example.com/sourcewatch"),
+    ], token_budget=1000, articles=articles)
+
+    assert message.count("Post:") == 2
+    assert OTHER in message
+    assert "#wipolitics" not in message
+    assert list(articles) == ["Post", "Repost", "SourceWatch"]
+
+
+def test_pack_message_keeps_near_duplicates_without_dedupe_distance(tiktoken_encodings):
+    asker = Asker(None, introduction="Answer from the posts.", string_divider="Post:", gpt_model="gpt-4",
+        dedupe_distance=None)
+    message = asker.pack_message("What is the campaign?", [(POST, None, None), (REPOST, None, None)], 1000)
+
+    assert message.count("Post:") == 2
@@ -0,0 +1,175 @@
+"""
+Tests for SocialData's pgvector retrieval. The tests marked as needing a
+database run against a local Postgres with the vector extension, and are
+skipped when there is none. Start one with:
+
+docker run --name shellbot-pg -e POSTGRES_PASSWORD=postgres -p 5432:5432 -d pgvector/pgvector:pg16
+
+Set SHELLBOT_TEST_DB_HOST, SHELLBOT_TEST_DB_PORT, SHELLBOT_TEST_DB_NAME,
+SHELLBOT_TEST_DB_USER and SHELLBOT_TEST_DB_PASSWORD to use another server.
+
+To run:
+python -m pytest tests/test_pgvector.py
+"""
+
+import os
+
+import numpy as np
+import psycopg2
+import pytest
+
+from social_data import SocialData, pgvector_literal
+
+
+DIMENSIONS = 8
+ROWS = 3000
+TOP_N = 20
+
+
+@pytest.fixture
+def social_data():
+    return SocialData(None, vector_store="pgvector")
+
+
+def test_unfiltered_search_settings(social_data):
+    social_data.pgvector_extension_version = (0, 8, 0)
+    assert social_data.search_settings(20, filtered=False) == [("SET LOCAL hnsw.ef_search = %s", (40, ))]
+    assert social_data.search_settings(400, filtered=False) == [("SET LOCAL hnsw.ef_search = %s", (400, ))]
+    assert social_data.search_settings(5000, filtered=False) == [("SET LOCAL hnsw.ef_search = %s", (1000, ))]
+
+
+def test_filtered_search_scans_iteratively(social_data):
+    social_data.pgvector_extension_version = (0, 8, 0)
+    assert social_data.search_settings(20, filtered=True) == [
+        ("SET LOCAL hnsw.iterative_scan = strict_order", ()),
+        ("SET LOCAL hnsw.ef_search = %s", (40, )),
+    ]
+
+
+def test_filtered_search_before_iterative_scans(social_data):
+    social_data.pgvector_extension_version = (0, 7, 4)
+    assert social_data.search_settings(20, filtered=True) == [("SET LOCAL hnsw.ef_search = %s", (1000, ))]
+
+
+def test_ivfflat_probes(social_data):
+    social_data.pgvector_index = "ivfflat"
+    social_data.pgvector_extension_version = (0, 8, 0)
+    social_data.ivfflat_index_lists = 100
+    assert social_data.search_settings(20, filtered=False) == [("SET LOCAL ivfflat.probes = %s", (10, ))]
+    assert social_data.search_settings(20, filtered=True) == [
+        ("SET LOCAL ivfflat.iterative_scan = relaxed_order", ()),
+        ("SET LOCAL ivfflat.probes = %s", (10, )),
+    ]
+    social_data.pgvector_extension_version = (0, 7, 4)
+    assert social_data.search_settings(20, filtered=True) == [("SET LOCAL ivfflat.probes = %s", (100, ))]
+
+
+@pytest.fixture
+def database():
+    """Connection arguments for a Postgres with pgvector, and a knowledge table to fill."""
+    args = {
+        "host": os.getenv("SHELLBOT_TEST_DB_HOST", "localhost"),
+        "port": os.getenv("SHELLBOT_TEST_DB_PORT", "5432"),
+        "dbname": os.getenv("SHELLBOT_TEST_DB_NAME", "postgres"),
+        "user": os.getenv("SHELLBOT_TEST_DB_USER", "postgres"),
+        "password": os.getenv("SHELLBOT_TEST_DB_PASSWORD", "postgres"),
+    }
+    try:
+        conn = psycopg2.connect(connect_timeout=3, **args)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"No Postgres to test against: {e}")
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    except psycopg2.Error as e:
+        conn.close()
+        pytest.skip(f"Postgres has no vector extension: {e}")
+    table = f"test_knowledge_{os.getpid()}"
+    cur.execute(f"DROP TABLE IF EXISTS {table}")
+    cur.execute(f"""
+        CREATE TABLE {table} (
+            vector_id TEXT PRIMARY KEY,
+            platform TEXT,
+            title TEXT,
+            unix_timestamp INT,
+            formatted_datetime TEXT,
+            content TEXT,
+            url TEXT
+        )
+    """)
+    yield args, table, cur
+    cur.execute(f"DROP TABLE IF EXISTS {table}")
+    conn.close()
+
+
+def make_social_data(database, **kwargs) -> SocialData:
+    args, table, cur = database
+    return SocialData(None, vector_store="pgvector", dimensions=DIMENSIONS, knowledge_db_name=table,
+        logs_database_name=args["dbname"], logs_user=args["user"], logs_password=args["password"],
+        db_host=args["host"], db_port=args["port"], **kwargs)
+
+
+def load_rows(database) -> np.ndarray:
+    """Fills the knowledge table with random embeddings; every tenth row is an email from 2019."""
+    args, table, cur = database
+    vectors = np.random.default_rng(0).standard_normal((ROWS, DIMENSIONS)).astype(np.float32)
+    for i, vector in enumerate(vectors):
+        email = i % 10 == 0
+        cur.execute(f"""
+            INSERT INTO {table} (vector_id, platform, title, unix_timestamp, content, url, embedding)
+            VALUES (%s, %s, %s, %s, %s, '', %s::vector)
+        """, (str(i), "Email" if email else "Tweet", f"title {i}", 1560000000 if email else 1400000000,
+            f"content {i}", pgvector_literal(vector)))
+    return vectors
+
+
+def exact_top(vectors, query, ids = None) -> list[str]:
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = normalized @ (query / np.linalg.norm(query))
+    order = [i for i in np.argsort(-scores) if ids is None or i in ids]
+    return [str(i) for i in order[:TOP_N]]
+
+
+EMAILS_2019 = {"$and": [{"platform": {"$in": ["Email"]}},
+    {"unix_timestamp": {"$gte": 1546300800, "$lt": 1577836800}}]}
+
+
+@pytest.mark.parametrize("index", ["hnsw", "ivfflat"])
+def test_pgvector_matches(database, index):
+    sd = make_social_data(database, pgvector_index=index)
+    sd.setup_pgvector()
+    vectors = load_rows(database)
+    sd.build_ivfflat_index()
+    query = np.random.default_rng(1).standard_normal(DIMENSIONS).astype(np.float32)
+
+    df = sd.get_pgvector_matches("", top_n=TOP_N, query_embedding=query)
+    assert len(df) == TOP_N
+    assert list(df.score) == sorted(df.score, reverse=True)
+    assert len(set(df.id) & set(exact_top(vectors, query))) >= TOP_N * 0.8
+
+    # Only one row in ten matches the filter; the search still fills top_n.
+    df = sd.get_pgvector_matches("", top_n=TOP_N, query_embedding=query, filter=EMAILS_2019)
+    assert len(df) == TOP_N
+    assert all(int(i) % 10 == 0 for i in df.id)
+    assert len(set(df.id) & set(exact_top(vectors, query, ids=set(range(0, ROWS, 10))))) >= TOP_N * 0.8
+
+
+def test_ivfflat_index_is_built_after_loading(database):
+    sd = make_social_data(database, pgvector_index="ivfflat")
+    sd.setup_pgvector()
+    assert sd.ivfflat_lists() is None
+    load_rows(database)
+    sd.build_ivfflat_index()
+    sd.ivfflat_index_lists = None
+    assert sd.ivfflat_lists() == ROWS // 1000
+
+
+def test_rerank_without_full_embedding_column(database):
+    sd = make_social_data(database, rerank=True)
+    sd.setup_pgvector()
+    load_rows(database)
+    query = np.random.default_rng(1).standard_normal(DIMENSIONS).astype(np.float32)
+    df = sd.get_pgvector_matches("", top_n=TOP_N, query_embedding=query)
+    assert len(df) == TOP_N
+    assert sd.full_embedding_column is False
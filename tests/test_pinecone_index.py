@@ -0,0 +1,66 @@
+"""
+Tests for PineconeIndex, which recovers from a stale entry in the index
+host cache, against the FakePinecone stand-in in fake_services.py.
+
+To run:
+python -m pytest tests/test_pinecone_index.py
+"""
+
+import types
+
+import pytest
+from pinecone import Pinecone
+from pinecone.exceptions import NotFoundException
+
+import chatbotter
+from fake_services import FakePinecone
+
+
+@pytest.fixture
+def host_cache(tmp_path, monkeypatch):
+    path = str(tmp_path / "pinecone_indexes.json")
+    monkeypatch.setattr(chatbotter, "PINECONE_INDEX_CACHE", path)
+    return path
+
+
+class ControlPlane:
+    """A Pinecone client whose describe_index answers with a given host, without the network."""
+    def __init__(self, host):
+        self.client = Pinecone(api_key="fake")
+        self.host = host
+        self.describes = 0
+
+    def Index(self, name, host):
+        return self.client.Index(name, host=host)
+
+    def describe_index(self, name):
+        self.describes += 1
+        if self.host is None:
+            raise NotFoundException(status=404, reason="Not Found")
+        return types.SimpleNamespace(host=self.host)
+
+
+def test_stale_host_is_looked_up_again(host_cache):
+    with FakePinecone() as fake_pinecone:
+        stale = fake_pinecone.url + "/deleted-index"
+        chatbotter.save_index_host("test", stale)
+        control_plane = ControlPlane(fake_pinecone.url)
+        index = chatbotter.PineconeIndex(control_plane, "test", chatbotter.cached_index_host("test"))
+
+        index.upsert(vectors=[("a", [1.0, 0.0]), ("b", [0.0, 1.0])], namespace="content")
+        result = index.query(vector=[1.0, 0.1], top_k=1, namespace="content")
+
+    assert result.matches[0].id == "a"
+    assert control_plane.describes == 1
+    assert chatbotter.cached_index_host("test") == fake_pinecone.url
+
+
+def test_deleted_index_is_forgotten(host_cache):
+    with FakePinecone() as fake_pinecone:
+        chatbotter.save_index_host("test", fake_pinecone.url + "/deleted-index")
+        control_plane = ControlPlane(None)
+        index = chatbotter.PineconeIndex(control_plane, "test", chatbotter.cached_index_host("test"))
+        with pytest.raises(NotFoundException):
+            index.query(vector=[1.0, 0.0], top_k=1, namespace="content")
+
+    assert chatbotter.cached_index_host("test") is None
@@ -0,0 +1,87 @@
+"""
+Tests for RetrievalCache, which reuses a conversation's matches across
+follow-up turns.
+
+To run:
+python -m pytest tests/test_retrieval_cache.py
+"""
+
+import numpy as np
+import pandas as pd
+
+from chatbotter import RetrievalCache
+
+
+def unit(*components) -> list[float]:
+    vector = np.asarray(components, dtype=np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class Search:
+    """Stands in for storage: returns n matches with ids starting at offset, and counts calls."""
+    def __init__(self, offset: int = 0):
+        self.offset = offset
+        self.calls = []
+
+    def __call__(self, n: int) -> pd.DataFrame:
+        self.calls.append(n)
+        ids = [f"id{self.offset + i}" for i in range(n)]
+        return pd.DataFrame({"id": ids, "score": np.linspace(1, 0.5, n)})
+
+
+def test_a_close_follow_up_reuses_the_matches():
+    cache = RetrievalCache(reuse_threshold=0.95)
+    search = Search()
+    first = cache.matches("s", unit(1, 0, 0), "v1", search, top_n=10)
+    again = cache.matches("s", unit(1, 0.1, 0), "v1", search, top_n=10)
+
+    assert search.calls == [10]
+    assert again is first
+    assert cache.stats()["reused"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_a_related_follow_up_refreshes_only_the_best_matches():
+    cache = RetrievalCache(reuse_threshold=0.95, extend_threshold=0.8, extend_top_n=3)
+    cache.matches("s", unit(1, 0, 0), "v1", Search(), top_n=10)
+    search = Search(offset=8)
+    df = cache.matches("s", unit(1, 0.5, 0), "v1", search, top_n=10)  # cosine 0.89
+
+    assert search.calls == [3]
+    # The fresh matches come first, then the earlier ones that weren't found again.
+    assert list(df["id"]) == ["id8", "id9", "id10"] + [f"id{i}" for i in range(7)]
+    assert cache.stats()["extended"] == 1
+
+
+def test_a_change_of_topic_searches_again():
+    cache = RetrievalCache()
+    cache.matches("s", unit(1, 0, 0), "v1", Search(), top_n=10)
+    search = Search()
+    cache.matches("s", unit(0, 1, 0), "v1", search, top_n=10)
+
+    assert search.calls == [10]
+    assert cache.stats()["misses"] == 2
+
+
+def test_matches_are_not_reused_across_sessions_versions_or_scopes():
+    cache = RetrievalCache()
+    search = Search()
+    cache.matches("s", unit(1, 0, 0), "v1", search, top_n=5, scope={"platform": "Tweet"})
+    cache.matches("t", unit(1, 0, 0), "v1", search, top_n=5, scope={"platform": "Tweet"})
+    cache.matches("s", unit(1, 0, 0), "v2", search, top_n=5, scope={"platform": "Tweet"})
+    cache.matches("s", unit(1, 0, 0), "v2", search, top_n=5, scope={"platform": "Email"})
+
+    assert search.calls == [5, 5, 5, 5]
+
+
+def test_expired_and_evicted_sessions_search_again():
+    cache = RetrievalCache(ttl=60, max_sessions=2)
+    search = Search()
+    cache.matches("a", unit(1, 0, 0), "v1", search, top_n=5)
+    cache.entries["a"]["created"] -= 61
+    cache.matches("a", unit(1, 0, 0), "v1", search, top_n=5)
+    assert search.calls == [5, 5]
+
+    cache.matches("b", unit(1, 0, 0), "v1", search, top_n=5)
+    cache.matches("c", unit(1, 0, 0), "v1", search, top_n=5)
+    assert list(cache.entries) == ["b", "c"]
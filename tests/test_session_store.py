@@ -0,0 +1,98 @@
+"""
+Tests for SessionStore, the sqlite-backed store of conversation histories.
+
+To run:
+python -m pytest tests/test_session_store.py
+"""
+
+import threading
+import time
+
+import pytest
+
+from chatbotter import ConversationHistory, SessionStore
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "sessions.db")
+
+
+def history(turns: int, summary: str = "") -> ConversationHistory:
+    conversation = ConversationHistory(summary=summary)
+    for turn in range(turns):
+        conversation.add("user", f"question {turn}")
+        conversation.add("assistant", f"answer {turn}")
+    return conversation
+
+
+def age(store: SessionStore, session_id: str, seconds: float):
+    store.connection().execute("UPDATE Sessions SET last_used = ? WHERE session_id = ?",
+        (time.time() - seconds, session_id))
+    store.connection().commit()
+
+
+def test_a_saved_history_comes_back_with_its_summary_and_session_id(db_path):
+    store = SessionStore(db_path)
+    store.save("s", history(2, summary="Earlier they talked about Wisconsin."))
+    restored = store.get("s")
+
+    assert restored.session_id == "s"
+    assert restored.summary == "Earlier they talked about Wisconsin."
+    assert restored.messages == history(2).messages
+    assert store.get("missing") is None
+    assert store.get(None) is None
+
+
+def test_only_the_last_max_messages_are_kept(db_path):
+    store = SessionStore(db_path, max_messages=4)
+    store.save("s", history(5))
+
+    assert store.get("s").messages == history(5).messages[-4:]
+
+
+def test_sessions_are_shared_through_the_file(db_path):
+    SessionStore(db_path).save("s", history(1))
+    found = []
+    thread = threading.Thread(target=lambda: found.append(SessionStore(db_path).get("s")))
+    thread.start()
+    thread.join()
+
+    assert found[0].messages == history(1).messages
+
+
+def test_expired_sessions_are_gone(db_path):
+    store = SessionStore(db_path, ttl=60)
+    store.save("old", history(1))
+    store.save("new", history(1))
+    age(store, "old", 61)
+
+    assert store.get("old") is None
+    store.prune()
+    assert len(store) == 1
+
+
+def test_the_least_recently_used_sessions_are_pruned(db_path):
+    store = SessionStore(db_path, max_sessions=2, prune_every=3)
+    store.save("a", history(1))
+    store.save("b", history(1))
+    age(store, "a", 20)
+    age(store, "b", 10)
+    store.get("a")  # now the most recently used
+    store.save("c", history(1))  # the third write prunes
+
+    assert len(store) == 2
+    assert store.get("b") is None
+    assert store.get("a") is not None
+
+
+def test_sessions_saved_as_plain_lists_still_load(db_path):
+    store = SessionStore(db_path)
+    messages = history(1).messages
+    store.connection().execute("INSERT INTO Sessions (session_id, history, last_used) VALUES (?, ?, ?)",
+        ("legacy", store.encoder.encode(messages), time.time()))
+    store.connection().commit()
+    restored = store.get("legacy")
+
+    assert restored.messages == messages
+    assert restored.summary == ""